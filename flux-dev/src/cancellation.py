@@ -0,0 +1,180 @@
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.request
+
+import torch
+
+# Response status of a job stopped by cancel() or its deadline
+CANCELLED = "cancelled"
+# Job states, as reported by the status source, that cancel a running job
+CANCELLED_STATES = ("CANCELLED", "TIMED_OUT")
+
+
+class JobCancelled(RuntimeError):
+    """The job was cancelled, or ran past its deadline, before it finished."""
+
+    def __init__(self, reason):
+        super().__init__(f"Job stopped: {reason}")
+        self.reason = reason
+
+
+def job_deadline(input_data):
+    """Deadline of a job as Unix time: its `deadline` input, else JOB_TIMEOUT_SECONDS from now (0 = none)."""
+    deadline = input_data.get("deadline")
+    if deadline is not None:
+        if isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline <= 0:
+            raise ValueError("Invalid deadline. Must be a Unix timestamp in seconds.")
+        return float(deadline)
+    timeout = float(os.getenv("JOB_TIMEOUT_SECONDS", "0"))
+    return time.time() + timeout if timeout > 0 else None
+
+
+class CancelToken:
+    """Cancellation flag and optional deadline (Unix time) of one job, checked cooperatively.
+
+    cancel() may be called from any thread. The GPU thread calls check(),
+    which raises JobCancelled, on every denoising step (step_callback),
+    before the VAE decode and before upload.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self._event = threading.Event()
+
+    def cancel(self, reason="cancelled"):
+        if self.reason is None:
+            self.reason = reason
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and time.time() >= self.deadline:
+            self.cancel("deadline exceeded")
+        return self.reason is not None
+
+    def wait(self, timeout=None):
+        """Blocks until cancel() is called or timeout seconds pass; True when cancelled."""
+        return self._event.wait(timeout)
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled(self.reason)
+
+    def step_callback(self, pipe, i, t, callback_kwargs):
+        """callback_on_step_end: stops the denoising loop as soon as the job is cancelled."""
+        self.check()
+        return {}
+
+    async def guard(self, awaitable):
+        """Awaits `awaitable`; if the awaiting task is cancelled (the job was abandoned) the token is cancelled too."""
+        try:
+            return await awaitable
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+
+class CancelGroup(CancelToken):
+    """The jobs of one batch: cancelled only once every one of them is, so none is dropped for a neighbour."""
+
+    def __init__(self, tokens):
+        super().__init__()
+        self.tokens = list(tokens)
+
+    @property
+    def cancelled(self):
+        if self.reason is None and self.tokens and all(token.cancelled for token in self.tokens):
+            self.cancel(self.tokens[0].reason)
+        return self.reason is not None
+
+
+def release_memory(error=None):
+    """Frees what an interrupted job held on the GPU: the locals of its unwound frames, then the CUDA cache."""
+    if error is not None:
+        traceback.clear_frames(error.__traceback__)
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+@contextlib.contextmanager
+def release_on_cancel():
+    """Releases GPU memory as soon as JobCancelled leaves the block (or decorated function), then re-raises."""
+    try:
+        yield
+    except JobCancelled as e:
+        release_memory(e)
+        raise
+
+
+def runpod_status(job_id):
+    """Status of a job from the runpod API (RUNPOD_API_KEY, RUNPOD_ENDPOINT_ID)."""
+    url = f"https://api.runpod.ai/v2/{os.environ['RUNPOD_ENDPOINT_ID']}/status/{job_id}"
+    request = urllib.request.Request(url, headers={"Authorization": f"Bearer {os.environ['RUNPOD_API_KEY']}"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response).get("status")
+
+
+class CancelWatcher:
+    """Polls the status of running jobs and cancels the tokens of jobs cancelled upstream.
+
+    status(job_id) returns the job's state; CANCELLED_STATES cancel its
+    token. By default it is the runpod status API, polled every
+    CANCEL_POLL_SECONDS (0, the default, turns polling off) when
+    RUNPOD_API_KEY and RUNPOD_ENDPOINT_ID are set.
+    """
+
+    def __init__(self, status=None, interval=None):
+        self.interval = interval if interval is not None else float(os.getenv("CANCEL_POLL_SECONDS", "0"))
+        if status is None and not (os.getenv("RUNPOD_API_KEY") and os.getenv("RUNPOD_ENDPOINT_ID")):
+            self.interval = 0
+        self.status = status or runpod_status
+        self.polls = 0
+        self.cancelled = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    @contextlib.contextmanager
+    def watch(self, job_id, token):
+        """Cancels `token` if the job is cancelled upstream while the block runs."""
+        if not self.enabled or job_id is None:
+            yield token
+            return
+        with self._lock:
+            self._jobs[job_id] = token
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cancel-watcher", daemon=True)
+                self._thread.start()
+        try:
+            yield token
+        finally:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                jobs = list(self._jobs.items())
+            for job_id, token in jobs:
+                try:
+                    state = self.status(job_id)
+                except Exception as e:
+                    print(f"Could not poll the status of job {job_id}: {e}")
+                    continue
+                self.polls += 1
+                if state in CANCELLED_STATES and not token.cancelled:
+                    self.cancelled += 1
+                    token.cancel(state.lower())
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from cancellation import JobCancelled
+
+
+class QueueFull(RuntimeError):
+    """Raised by submit() when the GPU queue is at capacity."""
+
+
+class Job:
+    __slots__ = ("fn", "args", "kwargs", "future", "arrival")
+
+    def __init__(self, fn=None, args=(), kwargs=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.future = Future()
+        self.arrival = time.monotonic()
+
+
+class GPUExecutor:
+    """One GPU thread fed by a bounded queue, so handlers only await results.
+
+    submit() raises QueueFull (counted as rejected) once GPU_QUEUE_SIZE jobs
+    are waiting. Jobs that raise JobCancelled are counted as cancelled and
+    never retried. concurrency_modifier() sizes the runpod concurrency from the
+    measured time per job: as many jobs as can finish within
+    GPU_TARGET_LATENCY_SECONDS, never more than the queue holds. runpod
+    stops taking jobs until the worker is idle whenever that value changes,
+    so it only moves once the measurement is a whole job away from it.
+    """
+
+    def __init__(self, max_queue=None, target_latency=None, initial_concurrency=None):
+        self.max_queue = max_queue or int(os.getenv("GPU_QUEUE_SIZE", "16"))
+        self.target_latency = target_latency or float(os.getenv("GPU_TARGET_LATENCY_SECONDS", "30"))
+        self.initial_concurrency = initial_concurrency or int(os.getenv("GPU_INITIAL_CONCURRENCY", "2"))
+        self.running = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.seconds_per_job = None  # moving average, per job even when batched
+        self.concurrency = None  # last value handed to runpod once measured
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gpu-executor", daemon=True)
+                self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) for the GPU thread; returns a concurrent Future."""
+        return self._admit(Job(fn, args, kwargs))
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    @property
+    def queued(self):
+        return len(self._pending)
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "queued": len(self._pending),
+                "running": self.running,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "seconds_per_job": round(self.seconds_per_job, 3) if self.seconds_per_job else None,
+            }
+
+    def concurrency_modifier(self, current_concurrency):
+        """Jobs this worker should hold at once to meet the latency target."""
+        if self.seconds_per_job is None:
+            return self.initial_concurrency
+        fits = min(self.max_queue, self.target_latency / self.seconds_per_job)
+        # Hysteresis: latency noise around a boundary (7.9 <-> 8.1 jobs) keeps the current value
+        if self.concurrency is None or abs(fits - self.concurrency) >= 1:
+            self.concurrency = max(1, int(fits))
+        return self.concurrency
+
+    def _admit(self, job):
+        self.start()
+        with self._cond:
+            if len(self._pending) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(f"GPU queue is full ({self.max_queue} jobs waiting)")
+            self._pending.append(job)
+            self._cond.notify()
+        return job.future
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            return [self._pending.pop(0)]
+
+    def _execute(self, batch):
+        for job in batch:
+            job.future.set_result(job.fn(*job.args, **job.kwargs))
+
+    def _fail(self, batch, error):
+        """Fail every job of the batch that doesn't have its result yet."""
+        for job in batch:
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    def _record(self, batch, seconds, timed=True):
+        """Count each job of a finished batch by how its future ended.
+
+        Only batches that ran once (timed) with every job succeeding feed the
+        time per job, so fast failures don't raise the concurrency while the
+        GPU is erroring.
+        """
+        errors = [job.future.exception() for job in batch]
+        per_job = seconds / len(batch)
+        with self._cond:
+            self.running = 0
+            self.completed += errors.count(None)
+            self.cancelled += sum(isinstance(e, JobCancelled) for e in errors)
+            self.failed += sum(e is not None and not isinstance(e, JobCancelled) for e in errors)
+            if not timed or any(errors):
+                return
+            if self.seconds_per_job is None:
+                self.seconds_per_job = per_job
+            else:
+                self.seconds_per_job = 0.8 * self.seconds_per_job + 0.2 * per_job
+
+    def _run(self):
+        while True:
+            batch = [job for job in self._next_batch() if job.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            with self._cond:
+                self.running = len(batch)
+            start = time.monotonic()
+            timed = True
+            try:
+                self._execute(batch)
+            except JobCancelled as e:
+                # Only raised once every job of the batch is cancelled
+                for job in batch:
+                    job.future.set_exception(e)
+            except Exception as e:
+                timed = False
+                self._fail(batch, e)
+            self._record(batch, time.monotonic() - start, timed)
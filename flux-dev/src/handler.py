@@ -1,38 +1,154 @@
+import os
+import weakref
 import runpod
-from txt2img_flux_dev import FluxDevGenerator
+from txt2img_flux_dev import DEFAULT_STRENGTH, VARIANTS, FluxDevGenerator
+from uploader import image_options
 from utils import calculate_cost
+from result_cache import ResultCache
+from previews import PreviewStream, preview_settings
+from decode import decode_quality
+from gpu_executor import GPUExecutor
+from warmup import run_warmup, snap_size, warmup_buckets
+from torch_compile import compile_enabled, compile_with_warmup
+from loader import ReadinessGate
+from placement import GB, device_bytes
+from residency import ModelResidency
+from image_fetch import ImageFetchError, ImageFetcher
+from step_cache import step_cache_threshold
+from cancellation import CANCELLED, CancelToken, CancelWatcher, JobCancelled, job_deadline
 
 
-flux_dev = FluxDevGenerator()
+result_cache = ResultCache()
+# img2img inputs: pooled downloads, decoded images cached by URL and ETag
+fetcher = ImageFetcher()
+# (width, height, steps) sizes generated once at startup so their kernels are primed
+warm_buckets = warmup_buckets(default="1360x768x2,1024x1024x2")
+# Models this worker serves; the `model` input picks one, the first is the default
+models = [name.strip() for name in os.getenv("MODELS", "flux-dev").split(",") if name.strip()]
+if unknown := [name for name in models if name not in VARIANTS]:
+    raise ValueError(f"Unknown MODELS {unknown}. Must be from {', '.join(VARIANTS)}.")
+if len(models) == 1:
+    # One model: placed once at load time, offloading only what doesn't fit
+    generators = {models[0]: FluxDevGenerator(models[0])}
+    acquire = generators.__getitem__
+else:
+    # Several: loaded on first use, whole pipelines swapped in and out of the GPU,
+    # text encoders, tokenizers and VAEs loaded once for all of them
+    shared = weakref.WeakValueDictionary()
+    generators = {name: FluxDevGenerator(name, shared=shared, place=False) for name in models}
+    working = float(os.getenv("PLACEMENT_WORKING_GB", str(FluxDevGenerator.WORKING_GB))) * GB
+    residency = ModelResidency(generators, budget_bytes=int(device_bytes() - working))
+    acquire = residency.acquire
+# Generation runs on one GPU thread; handlers only await it
+gpu = GPUExecutor()
+# Cancels the token of a running job once it is cancelled upstream (CANCEL_POLL_SECONDS)
+watcher = CancelWatcher()
 
-async def handler(job):
+def validate(job):
     job_input = job.get("input")
     if not job_input:
         raise ValueError("No input provided")
-    image_format = job_input.get("image_format", "png")
-    if image_format not in ["png", "jpeg", "jpg"]:
-        raise ValueError("Invalid image format. Supported formats are 'png' and 'jpg'.")
-    
-    mime_type = "image/jpeg" if image_format in ["jpeg", "jpg"] else "image/png"
+    if job_input.setdefault("model", models[0]) not in generators:
+        raise ValueError(f"Invalid model. Must be one of {', '.join(models)}.")
+    image_options(job_input)
+    if not 0 < job_input.get("strength", DEFAULT_STRENGTH) <= 1:
+        raise ValueError("Invalid strength. Must be between 0 and 1.")
+    decode_quality(job_input, default="full")
+    step_cache_threshold(job_input)
+    job_deadline(job_input)
+    if "width" in job_input and "height" in job_input:
+        job_input["width"], job_input["height"] = snap_size(job_input["width"], job_input["height"], warm_buckets)
+    preview_settings(job_input, default_every=5)
+    return job_input
+
+async def run_job(job_input, on_preview=None, job_id=None):
+    token = CancelToken(job_deadline(job_input))
     try:
-        img_url = flux_dev.generate(job_input)
+        await gate.wait()
+        # Downloaded here, so the GPU thread never waits on the network
+        image = await fetcher.fetch(job_input["image_url"]) if job_input.get("image_url") else None
+        if image is not None:
+            print(f"Image fetch: {fetcher.stats()}")
+        # Seeded requests are deterministic: reuse the URL of an identical earlier job
+        key = generators[job_input["model"]].cache_key(job_input, image=image) if result_cache.enabled else None
+        cached_urls = result_cache.get(key) if key else None
+        skipped_steps = None
+        if cached_urls:
+            img_url = cached_urls[0]
+        else:
+            # Stops at the next denoising step once the job is cancelled or past its deadline.
+            # The URL is cached once its upload is confirmed, not when it's queued
+            on_uploaded = (lambda url: result_cache.put(key, [url])) if key else None
+            with watcher.watch(job_id, token):
+                img_url, skipped_steps = await token.guard(
+                    gpu.run(
+                        generate, job_input, on_preview=on_preview, image=image, cancel=token, on_uploaded=on_uploaded
+                    )
+                )
+            print(f"GPU queue: {gpu.metrics()}")
+        if key:
+            print(f"Result cache: {result_cache.stats()}")
         return {
             "image_url": img_url,
+            "model": job_input["model"],
+            "cached": bool(cached_urls),
             "cost": calculate_cost(
                 job_input["width"], job_input["height"]
             ),
+            # Denoising steps served from the step cache; None when the result cache answered
+            "skipped_steps": skipped_steps,
             # "image": base64_img,
             # "data_url": f"data:{mime_type};base64,{base64_img}",
         }
-    except RuntimeError as e:
+    except JobCancelled as e:
+        return {
+            "status": CANCELLED,
+            "message": str(e),
+        }
+    except (RuntimeError, ImageFetchError) as e:
         return {
             "status": "error",
             "message": str(e),
         }
 
+def generate(job_input, on_preview=None, image=None, cancel=None, on_uploaded=None):
+    """Runs on the GPU thread: swaps the requested model in if needed (not for a cancelled job), then generates."""
+    cancel.check()
+    return acquire(job_input["model"]).generate(
+        job_input, on_preview=on_preview, image=image, cancel=cancel, on_uploaded=on_uploaded
+    )
+
+async def handler(job):
+    return await run_job(validate(job), job_id=job.get("id"))
+
+async def stream_handler(job):
+    """Yields low-resolution previews while denoising, then the final result."""
+    job_input = validate(job)
+    stream = PreviewStream(lambda on_preview: run_job(job_input, on_preview, job_id=job.get("id")))
+    async for preview in stream:
+        yield preview
+    yield await stream.result()
+
+def startup():
+    """Load the default model and warm up; with TORCH_COMPILE=1 warmup also compiles each bucket.
+
+    Other models are loaded when first requested, and run eagerly.
+    """
+    generator = acquire(models[0])
+    generator.initialize()
+    if compile_enabled():
+        compile_with_warmup(generator.pipe.transformer, generator.warmup, warm_buckets)
+    else:
+        run_warmup(generator.warmup, warm_buckets)
+
+# Starts loading at process start; no job is pulled until it's done
+gate = ReadinessGate().start(startup)
+
 runpod.serverless.start(
     {
-        "handler": handler,
+        # Generator handlers change /run output to the list of yielded items, so opt in
+        "handler": stream_handler if os.getenv("PREVIEW_STREAMING", "0") == "1" else handler,
+        "concurrency_modifier": gate.concurrency_modifier(gpu.concurrency_modifier),
         "return_aggregate_stream": True,
     }
 )
@@ -0,0 +1,123 @@
+import asyncio
+import glob
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# diffusers and transformers patch process-wide state while they build a model
+# (default dtype, nn.Module.register_parameter, torch.nn.init), so two builds
+# at once can leave each other's patches in place. Torch modules load one at a
+# time; everything else (file reads, tokenizers, schedulers) runs alongside.
+_module_lock = threading.Lock()
+
+
+def weight_files(*directories):
+    """Safetensors files under the given component directories, largest first."""
+    paths = [p for d in directories for p in glob.glob(os.path.join(d, "**", "*.safetensors"), recursive=True)]
+    return sorted(paths, key=os.path.getsize, reverse=True)
+
+
+def prefetch_file(path, chunk_bytes=64 * 2**20):
+    """Read a file once so the model load that follows is served from the page cache."""
+    buffer = bytearray(chunk_bytes)
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def load_components(modules, light=None, prefetch=(), max_workers=None):
+    """Load pipeline components concurrently; returns ({name: component}, {name: seconds}).
+
+    `modules` and `light` map component names to zero-argument loaders.
+    Module loaders (anything that builds a torch module) run one at a time in
+    the given order, while `light` loaders (tokenizers, schedulers) and reads
+    of the `prefetch` files run in parallel with them, so disk or network
+    volume I/O overlaps with checkpoint conversion and dtype casts.
+    LOAD_PREFETCH=0 skips the reads (e.g. when weights exceed host RAM) and
+    LOAD_WORKERS bounds the thread pool. Each component's time is logged,
+    along with the wall time against the serial sum.
+    """
+    light = light or {}
+    if os.getenv("LOAD_PREFETCH", "1") != "1":
+        prefetch = ()
+    max_workers = max_workers or int(os.getenv("LOAD_WORKERS", "0")) or len(modules) + len(light) + len(prefetch)
+    timings = {}
+
+    def timed(name, load, lock=None):
+        start = time.perf_counter()
+        if lock is None:
+            component = load()
+        else:
+            with lock:
+                # Time spent waiting for the lock is not this component's load time
+                start = time.perf_counter()
+                component = load()
+        timings[name] = time.perf_counter() - start
+        print(f"Loaded {name}: {timings[name]:.2f}s")
+        return component
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="loader") as pool:
+        # Module loads are queued first so they start while files are still being read
+        futures = {name: pool.submit(timed, name, load, _module_lock) for name, load in modules.items()}
+        futures.update({name: pool.submit(timed, name, load) for name, load in light.items()})
+        reads = [
+            pool.submit(timed, f"prefetch {os.path.basename(path)}", lambda path=path: prefetch_file(path))
+            for path in prefetch
+        ]
+        components = {name: future.result() for name, future in futures.items()}
+        for read in reads:
+            read.result()
+    wall = time.perf_counter() - start
+    serial = sum(seconds for name, seconds in timings.items() if name in components)
+    print(f"Loaded {len(components)} components in {wall:.2f}s ({serial:.2f}s one after another)")
+    return components, timings
+
+
+class ReadinessGate:
+    """Runs worker startup (loading, warmup) in the background and opens once it is done.
+
+    The worker can register with runpod immediately: concurrency_modifier()
+    reports 0 until the gate opens, so no job is pulled before the model is
+    ready. wait() holds a job that got here anyway (local --test_input runs).
+    If startup fails the gate still opens and wait() raises, so jobs fail
+    with the startup error instead of hanging.
+    """
+
+    def __init__(self):
+        self.error = None
+        self.seconds = None
+        self._open = threading.Event()
+
+    def start(self, startup):
+        def run():
+            start = time.perf_counter()
+            try:
+                startup()
+            except Exception as e:
+                traceback.print_exc()
+                self.error = e
+            self.seconds = time.perf_counter() - start
+            print(f"{'Startup failed' if self.error else 'Ready'} after {self.seconds:.2f}s")
+            self._open.set()
+
+        threading.Thread(target=run, name="startup", daemon=True).start()
+        return self
+
+    @property
+    def ready(self):
+        return self._open.is_set() and self.error is None
+
+    def concurrency_modifier(self, modifier):
+        """Wrap a runpod concurrency_modifier so it reports 0 until the gate opens."""
+        def gated(current_concurrency):
+            return modifier(current_concurrency) if self._open.is_set() else 0
+        return gated
+
+    async def wait(self):
+        if not self._open.is_set():
+            await asyncio.get_running_loop().run_in_executor(None, self._open.wait)
+        if self.error is not None:
+            raise RuntimeError(f"Worker failed to start: {self.error}")
@@ -0,0 +1,188 @@
+import itertools
+import os
+
+import torch
+
+RESIDENT = "resident"
+MIXED = "mixed"
+MODEL_OFFLOAD = "model_offload"
+SEQUENTIAL_OFFLOAD = "sequential_offload"
+STRATEGIES = (RESIDENT, MIXED, MODEL_OFFLOAD, SEQUENTIAL_OFFLOAD)
+
+GB = 2**30
+
+
+def module_bytes(module):
+    return sum(t.numel() * t.element_size() for t in itertools.chain(module.parameters(), module.buffers()))
+
+
+def component_sizes(pipe, extra=None):
+    """Bytes of weights per torch component of a diffusers pipeline, plus the `extra` modules."""
+    components = {name: c for name, c in pipe.components.items() if isinstance(c, torch.nn.Module)}
+    return {name: module_bytes(c) for name, c in {**components, **(extra or {})}.items()}
+
+
+def device_bytes():
+    """Device memory available for weights and activations: PLACEMENT_DEVICE_GB, else free CUDA memory."""
+    if os.getenv("PLACEMENT_DEVICE_GB"):
+        return int(float(os.getenv("PLACEMENT_DEVICE_GB")) * GB)
+    if not torch.cuda.is_available():
+        return 0
+    free, _ = torch.cuda.mem_get_info()
+    return free
+
+
+class PlacementPlan:
+    """Where each pipeline component lives, and what that costs per request.
+
+    transfer_bytes is the host-to-device weight traffic of one request (an
+    upper bound: cached prompts skip the text encoders). offload_peak_bytes is
+    the largest offloaded component, which still has to fit on the device
+    while it runs.
+    """
+
+    def __init__(self, strategy, resident, offloaded, transfer_bytes, offload_peak_bytes, available_bytes):
+        self.strategy = strategy
+        self.resident = resident
+        self.offloaded = offloaded
+        self.transfer_bytes = transfer_bytes
+        self.offload_peak_bytes = offload_peak_bytes
+        self.available_bytes = available_bytes
+
+    def describe(self):
+        return (
+            f"Placement: {self.strategy}, resident {self.resident or '-'}, offloaded {self.offloaded or '-'}, "
+            f"~{self.transfer_bytes / GB:.1f} GB host-to-device per request "
+            f"({self.available_bytes / GB:.1f} GB device memory)"
+        )
+
+
+def plan_placement(sizes, available, working, priority=(), pinned=(), denoiser=None, steps=1, strategy=None):
+    """Pick the cheapest placement whose peak fits into `available` bytes with `working` left for activations.
+
+    sizes maps component name to bytes. Components are kept resident in
+    `priority` order (then largest first) as long as the resident set plus
+    the largest remaining offloaded component still fits, since model offload
+    only holds one offloaded component on the device at a time. `pinned`
+    components (e.g. already-quantized on the GPU) are always resident. If
+    not even one component fits, weights are streamed per submodule and the
+    denoiser's move once per step. PLACEMENT_STRATEGY (or `strategy`) forces
+    a strategy.
+    """
+    strategy = strategy or os.getenv("PLACEMENT_STRATEGY") or None
+    if strategy is not None and strategy not in STRATEGIES:
+        raise ValueError(f"Invalid placement strategy {strategy!r}. Must be one of {', '.join(STRATEGIES)}.")
+    budget = available - working
+    pinned = [name for name in pinned if name in sizes]
+    movable = [name for name in priority if name in sizes and name not in pinned]
+    movable += sorted((name for name in sizes if name not in movable and name not in pinned), key=lambda n: -sizes[n])
+
+    def plan(kind, resident, offloaded, transfer):
+        peak = max((sizes[name] for name in offloaded), default=0) if kind in (MIXED, MODEL_OFFLOAD) else 0
+        return PlacementPlan(kind, resident, offloaded, transfer, peak, available)
+
+    if strategy == RESIDENT or (strategy is None and sum(sizes.values()) <= budget):
+        return plan(RESIDENT, pinned + movable, [], 0)
+
+    if strategy in (None, MIXED, MODEL_OFFLOAD):
+        resident, offloaded = list(pinned), list(movable)
+        if strategy != MODEL_OFFLOAD:
+            for name in movable:
+                rest = [n for n in offloaded if n != name]
+                peak = sum(sizes[n] for n in resident) + sizes[name] + max((sizes[n] for n in rest), default=0)
+                if peak <= budget:
+                    resident.append(name)
+                    offloaded = rest
+        peak = sum(sizes[n] for n in resident) + max((sizes[n] for n in offloaded), default=0)
+        if strategy is not None or peak <= budget:
+            kind = MIXED if len(resident) > len(pinned) else MODEL_OFFLOAD
+            return plan(kind, resident, offloaded, sum(sizes[n] for n in offloaded))
+
+    transfer = sum(sizes[n] for n in movable)
+    if denoiser in movable:
+        transfer += (steps - 1) * sizes[denoiser]
+    return plan(SEQUENTIAL_OFFLOAD, list(pinned), movable, transfer)
+
+
+def apply_plan(pipe, plan, device="cuda", extra=None, after=None):
+    """Place the pipeline's components, and the `extra` modules, as planned.
+
+    Mixed and model-offload plans use accelerate hooks directly instead of
+    enable_model_cpu_offload(): diffusers re-applies that after every call
+    and moves every component to the CPU when it does, resident ones
+    included. Each offloaded component goes back to the CPU as soon as the
+    next component in the pipeline runs, resident ones included (also
+    through their encode()/decode()).
+
+    `extra` maps names to modules that a second pipeline sharing this one's
+    components runs (e.g. the SDXL refiner's UNet); in the offload order
+    they follow the `after` component.
+    """
+    extra = extra or {}
+    if plan.strategy == SEQUENTIAL_OFFLOAD:
+        pipe.enable_sequential_cpu_offload(device=device)
+        if extra:
+            from accelerate import cpu_offload
+
+            for module in extra.values():
+                cpu_offload(module, device)
+        return pipe
+    components = {name: c for name, c in pipe.components.items() if isinstance(c, torch.nn.Module)}
+    components.update(extra)
+    if plan.strategy == RESIDENT:
+        for name, component in components.items():
+            if not getattr(component, "is_quantized", False):
+                component.to(device)
+        return pipe
+
+    from accelerate import cpu_offload_with_hook
+    from accelerate.hooks import ModelHook, add_hook_to_module
+
+    class OffloadPrevious(ModelHook):
+        # An accelerate hook rather than a forward pre-hook, so it also fires for
+        # the encode()/decode() calls diffusers routes through _hf_hook
+        def __init__(self, previous):
+            self.previous = previous
+
+        def pre_forward(self, module, *args, **kwargs):
+            self.previous.offload()
+            return args, kwargs
+
+    order = [name for name in pipe.model_cpu_offload_seq.split("->") if name in components]
+    at = order.index(after) + 1 if after in order else len(order)
+    order[at:at] = [name for name in extra if name not in order]
+    order += [name for name in components if name not in order]
+    first = previous = last = None
+    for name in order:
+        component = components[name]
+        if name in plan.offloaded:
+            _, previous = cpu_offload_with_hook(component, device, prev_module_hook=previous)
+            first, last = first or previous, previous
+            continue
+        if not getattr(component, "is_quantized", False):
+            component.to(device)
+        if previous is not None:
+            add_hook_to_module(component, OffloadPrevious(previous))
+            previous = None
+    if first is not last:
+        # Close the loop: the next request's first offloaded component evicts the
+        # last one, whatever resident components follow it
+        first.hook.prev_module_hook = last
+    return pipe
+
+
+def place_pipeline(pipe, working_gb, priority=(), pinned=(), denoiser=None, steps=1, device="cuda", extra=None):
+    """Plan placement from measured component sizes and device memory, log the plan and apply it.
+
+    working_gb (PLACEMENT_WORKING_GB overrides it) is kept free for
+    activations at the default resolution. `extra` modules are planned
+    alongside the pipeline's own and run after the denoiser.
+    """
+    working = float(os.getenv("PLACEMENT_WORKING_GB", str(working_gb))) * GB
+    plan = plan_placement(
+        component_sizes(pipe, extra), device_bytes(), working,
+        priority=priority, pinned=pinned, denoiser=denoiser, steps=steps,
+    )
+    print(plan.describe())
+    apply_plan(pipe, plan, device=device, extra=extra, after=denoiser)
+    return plan
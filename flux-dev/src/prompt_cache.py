@@ -0,0 +1,69 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+def _nbytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+class PromptCache:
+    """Memory-bounded LRU of text-encoder outputs, keyed by model and normalized prompt.
+
+    Values are tuples of tensors kept on the CPU, so the cache costs no VRAM
+    and survives model offload; get_or_encode() moves them to `device` on the
+    way out. Least recently used entries are dropped once the total exceeds
+    PROMPT_CACHE_MB (default 512). PROMPT_CACHE=0 turns it off.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or int(float(os.getenv("PROMPT_CACHE_MB", "512")) * 2**20)
+        self.enabled = os.getenv("PROMPT_CACHE", "1") == "1"
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_id, prompt, *options):
+        """Whitespace-only differences share an entry; the CLIP and T5 tokenizers collapse it anyway."""
+        return (model_id, " ".join((prompt or "").split()), *options)
+
+    def get_or_encode(self, key, encode, device=None):
+        """Cached tensors for `key`, calling encode() -> tuple of tensors on a miss."""
+        with self._lock:
+            tensors = self._entries.get(key)
+            if tensors is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if tensors is None:
+            tensors = tuple(t.detach().to("cpu") if t is not None else None for t in encode())
+            self._put(key, tensors)
+        return tuple(t.to(device) if t is not None and device is not None else t for t in tensors)
+
+    def _put(self, key, tensors):
+        size = _nbytes(tensors)
+        with self._lock:
+            self.misses += 1
+            if not self.enabled or size > self.max_bytes or key in self._entries:
+                return
+            self._entries[key] = tensors
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= _nbytes(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,120 @@
+import os
+import time
+from collections import OrderedDict
+
+import torch
+
+from placement import GB, module_bytes
+
+OFFLOAD_TARGETS = ("cpu", "disk")
+
+
+class ModelResidency:
+    """Keeps the most recently used models on the GPU within a memory budget.
+
+    `generators` maps model names to generators with initialize(),
+    modules() -> {name: torch module} and unload(). acquire() loads a model
+    on first use, moves its modules to the device and evicts least recently
+    used models until it fits in `budget_bytes`. Modules shared between
+    generators (the same object) are counted once and stay on the device
+    while any resident model uses them.
+
+    Evicted models go to host memory (RESIDENCY_OFFLOAD=cpu, the default),
+    or are unloaded and read from disk again on their next use
+    (RESIDENCY_OFFLOAD=disk), for hosts without RAM for every model.
+    RESIDENCY_BUDGET_GB overrides the budget. acquire() is not thread-safe:
+    call it from the GPU thread only.
+    """
+
+    def __init__(self, generators, budget_bytes, device="cuda", offload=None):
+        self.generators = generators
+        self.budget_bytes = int(float(os.getenv("RESIDENCY_BUDGET_GB", "0")) * GB) or budget_bytes
+        self.device = device
+        self.offload = offload or os.getenv("RESIDENCY_OFFLOAD", "cpu")
+        if self.offload not in OFFLOAD_TARGETS:
+            raise ValueError(f"Invalid RESIDENCY_OFFLOAD {self.offload!r}. Must be cpu or disk.")
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.swap_ms = []
+        self._resident = OrderedDict()
+
+    def _modules(self, names):
+        """Unique modules of the given models, by identity."""
+        modules = {}
+        for name in names:
+            for module in self.generators[name].modules().values():
+                modules[id(module)] = module
+        return modules
+
+    def resident_bytes(self):
+        return sum(module_bytes(m) for m in self._modules(self._resident).values())
+
+    def acquire(self, name):
+        """The generator for `name`, with its weights on the device."""
+        generator = self.generators[name]
+        if name in self._resident:
+            self._resident.move_to_end(name)
+            self.hits += 1
+            return generator
+        self.misses += 1
+        start = time.perf_counter()
+        if not generator.initialized:
+            generator.initialize()
+            self.loads += 1
+        modules = self._modules([name])
+        size = sum(module_bytes(m) for m in modules.values())
+        if size > self.budget_bytes:
+            raise RuntimeError(
+                f"{name} needs {size / GB:.1f} GB, more than the {self.budget_bytes / GB:.1f} GB residency budget"
+            )
+        while self._resident:
+            on_device = self._modules(self._resident)
+            needed = sum(module_bytes(m) for key, m in modules.items() if key not in on_device)
+            if self.resident_bytes() + needed <= self.budget_bytes:
+                break
+            self._evict(next(iter(self._resident)), keep=modules)
+        for module in modules.values():
+            if not getattr(module, "is_quantized", False):
+                module.to(self.device)
+        self._resident[name] = True
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.swap_ms.append((time.perf_counter() - start) * 1000)
+        print(f"Swapped in {name} in {self.swap_ms[-1]:.0f} ms; residency: {self.stats()}")
+        return generator
+
+    def _evict(self, name, keep=()):
+        """Move `name` off the device, except modules that `keep` or another resident model still uses."""
+        del self._resident[name]
+        if self.offload == "disk":
+            # Dropping the references frees the device memory; shared modules live on in their other users
+            self.generators[name].unload()
+        else:
+            still_used = {**self._modules(self._resident), **dict(keep)}
+            for key, module in self._modules([name]).items():
+                if key not in still_used and not getattr(module, "is_quantized", False):
+                    module.to("cpu")
+        self.evictions += 1
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"Evicted {name} to {self.offload}")
+
+    def resident(self):
+        """Resident model names, least recently used first."""
+        return list(self._resident)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "resident": self.resident(),
+            "resident_gb": round(self.resident_bytes() / GB, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 3) if requests else 0.0,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "swap_in_ms_mean": round(sum(self.swap_ms) / len(self.swap_ms), 1) if self.swap_ms else None,
+            "swap_in_ms_max": round(max(self.swap_ms), 1) if self.swap_ms else None,
+        }
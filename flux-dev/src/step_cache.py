@@ -0,0 +1,133 @@
+import contextlib
+import os
+
+# Polynomial (highest power first) that maps the relative change of Flux's
+# modulated input to the relative change of its output, fitted by TeaCache on
+# FLUX.1-dev; thresholds then read as accumulated output change
+FLUX_COEFFICIENTS = (4.98651651e02, -2.83781631e02, 5.58554382e01, -3.82021401e00, 2.64230861e-01)
+
+
+def step_cache_threshold(input_data):
+    """The `step_cache` input: accumulated change under which a step reuses the cached residual, 0 = off."""
+    threshold = input_data.get("step_cache", float(os.getenv("STEP_CACHE_THRESHOLD", "0")))
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or threshold < 0:
+        raise ValueError("Invalid step_cache. Must be a non-negative number.")
+    return float(threshold)
+
+
+class StepCacheRun:
+    """Skip decisions and cached residual of one pipeline call."""
+
+    def __init__(self, threshold, steps, coefficients):
+        self.threshold = threshold
+        self.steps = steps
+        self.coefficients = coefficients
+        self.calls = 0
+        self.skipped = 0
+        self.skipping = False
+        self._accumulated = 0.0
+        self._previous = None
+        self._inputs = None
+        self._residual = None
+
+    def _change(self, modulated):
+        """Relative L1 change of the modulated input since the previous step, rescaled by the coefficients."""
+        change = ((modulated - self._previous).abs().mean() / self._previous.abs().mean()).item()
+        if self.coefficients:
+            change = sum(c * change ** power for power, c in enumerate(reversed(self.coefficients)))
+        return change
+
+    def _decide(self, modulated):
+        """Whether this step reuses the residual. The first and last steps always run the blocks."""
+        edge = self.calls == 0 or (self.steps is not None and self.calls >= self.steps - 1)
+        if edge or self._residual is None or self._previous.shape != modulated.shape:
+            reuse = False
+        else:
+            self._accumulated += self._change(modulated)
+            reuse = self._accumulated < self.threshold
+        if not reuse:
+            self._accumulated = 0.0
+        self._previous = modulated
+        self.calls += 1
+        self.skipped += reuse
+        return reuse
+
+    def wrap(self, block, forward, head, tail):
+        """forward of one transformer block: the first decides, the rest pass their inputs through when skipping."""
+        def block_forward(*args, **kwargs):
+            hidden_states, encoder_hidden_states = kwargs["hidden_states"], kwargs["encoder_hidden_states"]
+            if head:
+                self.skipping = self._decide(block.norm1(hidden_states, emb=kwargs["temb"])[0])
+                if self.skipping:
+                    hidden_residual, encoder_residual = self._residual
+                    encoder_out = encoder_hidden_states + encoder_residual if encoder_residual is not None else None
+                    return encoder_out, hidden_states + hidden_residual
+                self._inputs = (hidden_states, encoder_hidden_states)
+            elif self.skipping:
+                return encoder_hidden_states, hidden_states
+            encoder_out, hidden_out = forward(*args, **kwargs)
+            if tail:
+                hidden_in, encoder_in = self._inputs
+                # The last block of SD3 drops the text stream
+                encoder_residual = encoder_out - encoder_in if encoder_out is not None else None
+                self._residual = (hidden_out - hidden_in, encoder_residual)
+            return encoder_out, hidden_out
+        return block_forward
+
+    def stats(self):
+        return {"threshold": self.threshold, "steps": self.calls, "skipped": self.skipped}
+
+
+class StepCache:
+    """TeaCache-style step cache for Flux and SD3 transformers.
+
+    Adjacent denoising steps change the transformer's output only a little.
+    While run() is active, the first block compares its modulated input with
+    the previous step's (relative L1, accumulated across steps) and, while
+    that stays under the threshold, the whole stack of blocks is skipped:
+    their output is the input plus the residual (output minus input) of the
+    last step that ran them. Embeddings and the output projection always run.
+
+    Blocks are wrapped only inside run(), so calls without a threshold run
+    the model untouched. The transformer must be called from one thread.
+    """
+
+    def __init__(self, transformer, coefficients=None):
+        blocks = list(transformer.transformer_blocks) + list(getattr(transformer, "single_transformer_blocks", ()))
+        self.blocks = blocks
+        self.coefficients = coefficients
+        self.runs = 0
+        self.steps = 0
+        self.skipped = 0
+
+    @contextlib.contextmanager
+    def run(self, threshold, steps=None):
+        """Cache between the steps of one pipeline call of `steps` steps; yields its StepCacheRun."""
+        run = StepCacheRun(threshold, steps, self.coefficients)
+        if threshold <= 0:
+            yield run
+            return
+        saved = [block.__dict__.get("forward") for block in self.blocks]
+        last = len(self.blocks) - 1
+        for index, block in enumerate(self.blocks):
+            # Offload hooks install their own forward on the instance; it is wrapped, then restored
+            block.forward = run.wrap(block, block.forward, head=index == 0, tail=index == last)
+        try:
+            yield run
+        finally:
+            for block, forward in zip(self.blocks, saved):
+                if forward is None:
+                    del block.forward
+                else:
+                    block.forward = forward
+            self.runs += 1
+            self.steps += run.calls
+            self.skipped += run.skipped
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "steps": self.steps,
+            "skipped": self.skipped,
+            "skip_rate": round(self.skipped / self.steps, 3) if self.steps else 0.0,
+        }
@@ -0,0 +1,114 @@
+import os
+import time
+
+import torch
+from torch._dynamo.utils import counters
+
+DYNAMIC = {"auto": None, "1": True, "0": False}
+
+
+def compile_enabled():
+    return os.getenv("TORCH_COMPILE", "0") == "1"
+
+
+def compile_module(module):
+    """Compile a denoiser in place (module.forward stays the entry point).
+
+    TORCH_COMPILE_DYNAMIC: "auto" (default) specializes on the first size and
+    switches to dynamic shapes once a second bucket shows up, "1" is dynamic
+    from the start, "0" keeps one static graph per bucket. TORCH_COMPILE_MODE
+    is passed through to torch.compile.
+    """
+    dynamic = os.getenv("TORCH_COMPILE_DYNAMIC", "auto")
+    if dynamic not in DYNAMIC:
+        raise ValueError("Invalid TORCH_COMPILE_DYNAMIC. Must be auto, 1 or 0.")
+    # One graph per warmed bucket (and batch size) must not hit the recompile limit
+    torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 32)
+    module.compile(mode=os.getenv("TORCH_COMPILE_MODE") or None, dynamic=DYNAMIC[dynamic])
+    return module
+
+
+class CompileCache:
+    """Keeps inductor's FX graph, autotuning and Triton caches under one persistent directory.
+
+    TORCH_COMPILE_CACHE_DIR defaults to the network volume when one is
+    mounted, so every worker's cold start reuses the first one's work. The
+    portable artifact bundle (torch.compiler.save_cache_artifacts) is written
+    there as well, so the directory can also be baked into an image.
+    """
+
+    def __init__(self, directory=None):
+        default = "/runpod-volume/torch-compile-cache" if os.path.isdir("/runpod-volume") else "/tmp/torch-compile-cache"
+        self.directory = directory or os.getenv("TORCH_COMPILE_CACHE_DIR", default)
+        self.artifacts_path = os.path.join(self.directory, "cache_artifacts.bin")
+        self.loaded_artifacts = False
+
+    def configure(self):
+        os.makedirs(self.directory, exist_ok=True)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(self.directory, "inductor")
+        os.environ["TRITON_CACHE_DIR"] = os.path.join(self.directory, "triton")
+        torch._inductor.config.fx_graph_cache = True
+        torch._inductor.config.autotune_local_cache = True
+        if os.path.exists(self.artifacts_path):
+            with open(self.artifacts_path, "rb") as f:
+                self.loaded_artifacts = torch.compiler.load_cache_artifacts(f.read()) is not None
+        return self
+
+    def save(self):
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return
+        tmp_path = f"{self.artifacts_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(artifacts[0])
+        os.replace(tmp_path, self.artifacts_path)
+
+    @staticmethod
+    def stats():
+        return {
+            "fx_graph_hits": counters["inductor"]["fxgraph_cache_hit"],
+            "fx_graph_misses": counters["inductor"]["fxgraph_cache_miss"],
+        }
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def compile_with_warmup(module, warm, buckets, cache=None):
+    """Compile `module` and prime it on every (width, height, steps) bucket via warm(width, height, steps).
+
+    The first bucket is run eagerly twice for reference. Each bucket is then
+    run twice compiled: the first run pays for compilation (or a cache load),
+    the second is steady state. Logs and returns compile seconds and ms per
+    step per bucket, the per-step speedup over eager and the cache hits and
+    misses, then saves the cache.
+    """
+    cache = (cache or CompileCache()).configure()
+    eager = None
+    if buckets:
+        _timed(warm, *buckets[0])
+        eager = _timed(warm, *buckets[0])
+    compile_module(module)
+    report = {"buckets": {}}
+    for width, height, steps in buckets:
+        first = _timed(warm, width, height, steps)
+        steady = _timed(warm, width, height, steps)
+        report["buckets"][(width, height, steps)] = {
+            "compile_seconds": max(0.0, first - steady),
+            "step_ms": steady / steps * 1000,
+        }
+        if eager is not None:
+            report["speedup"] = eager / steady
+            eager = None
+        print(f"torch.compile {width}x{height}: {first - steady:.2f}s compiling, {steady / steps * 1000:.1f} ms/step")
+    report.update(cache.stats(), loaded_artifacts=cache.loaded_artifacts)
+    print(
+        f"torch.compile: {report.get('speedup', 0):.2f}x per step vs eager, "
+        f"FX graph cache {report['fx_graph_hits']} hits / {report['fx_graph_misses']} misses"
+        f"{' (artifacts loaded)' if cache.loaded_artifacts else ''}, cache at {cache.directory}"
+    )
+    cache.save()
+    return report
@@ -1,90 +1,335 @@
 import torch
 import base64
 import io
-from diffusers import FluxPipeline, FluxTransformer2DModel
+import os
+from diffusers import (
+    AutoencoderKL,
+    AutoencoderTiny,
+    FlowMatchEulerDiscreteScheduler,
+    FluxImg2ImgPipeline,
+    FluxPipeline,
+    FluxTransformer2DModel,
+)
+from transformers import CLIPTextModel, CLIPTokenizer, T5EncoderModel, T5TokenizerFast
 from PIL import Image
-from utils import upload_to_r2
+from uploader import image_options, submit_image
+from result_cache import cache_key, normalize_prompt
+from prompt_cache import PromptCache
+from placement import GB, place_pipeline
+from loader import load_components, weight_files
+from previews import chain_callbacks, preview_callback, preview_settings, tiny_vae_preview
+from decode import Decoder, decode_quality
+from image_fetch import ByteLRU, image_latents
+from step_cache import FLUX_COEFFICIENTS, StepCache, step_cache_threshold
+from cancellation import CancelToken, release_on_cancel
 import uuid
 from datetime import datetime, timedelta
 from nanoid import generate
 
+DEFAULTS = {
+    "prompt": "A photo of a cat",
+    "negative_prompt": "",
+    "height": 768,
+    "width": 1360,
+    "num_inference_steps": 30,
+    "guidance_scale": 3.5,
+    "max_sequence_length": 512,
+    "image_format": "png",
+    "decode_quality": "full",
+}
+# How far an input image (image_url) is noised before denoising, 0-1
+DEFAULT_STRENGTH = 0.6
+
+# Weights and defaults per model. FLUX.1-schnell is distilled from FLUX.1-dev
+# and uses the same text encoders, tokenizers and VAE, so only its transformer
+# and scheduler are its own; everything else is read from the dev download
+VARIANTS = {
+    "flux-dev": {
+        "model_id": "black-forest-labs/FLUX.1-dev:flux1-dev-fp8",
+        "model_path": "/models/flux-dev",
+        "fp8_transformer_path": "/models/fp8_transformer/flux1-dev-fp8.safetensors",
+        # Converted to diffusers' layout and bf16 by download_model.py
+        "converted_transformer_path": "/models/fp8_transformer/flux1-dev-fp8-diffusers",
+        "defaults": DEFAULTS,
+    },
+    "flux-schnell": {
+        "model_id": "black-forest-labs/FLUX.1-schnell:flux1-schnell-fp8-e4m3fn",
+        "model_path": "/models/flux-schnell",
+        "fp8_transformer_path": "/models/fp8_transformer/flux1-schnell-fp8-e4m3fn.safetensors",
+        "converted_transformer_path": "/models/fp8_transformer/flux1-schnell-fp8-e4m3fn-diffusers",
+        "defaults": {**DEFAULTS, "num_inference_steps": 4, "guidance_scale": 0.0, "max_sequence_length": 256},
+    },
+}
+# Components loaded once per process and handed to every variant
+SHARED_COMPONENTS = ("text_encoder", "text_encoder_2", "tokenizer", "tokenizer_2", "vae", "tiny_vae")
+SHARED_MODEL_PATH = "/models/flux-dev"
+
 class FluxDevGenerator:
-    def __init__(self):
+    """FLUX.1-dev, or another Flux variant from VARIANTS.
+
+    `shared` (a WeakValueDictionary) deduplicates SHARED_COMPONENTS across
+    the generators of one process. With place=False nothing is moved to the
+    GPU; a ModelResidency does that instead.
+    """
+    # Activation headroom at the default resolution, GB
+    WORKING_GB = 6
+
+    def __init__(self, variant="flux-dev", shared=None, place=True):
+        self.variant = variant
+        self.model_id = VARIANTS[variant]["model_id"]
+        self.defaults = VARIANTS[variant]["defaults"]
+        self.shared = shared
+        self.place = place
         self.pipe = None
         self.initialized = False
+        self.placement = None
+        self.load_timings = {}
+        self.tiny_vae = None
+        self.decoder = None
+        self.step_cache = None
+        self.prompt_cache = PromptCache()
+        # VAE latents of img2img inputs, so edits of the same image skip the encode
+        self.latent_cache = ByteLRU(int(float(os.getenv("LATENT_CACHE_MB", "256")) * 2**20))
     
     def initialize(self):
-        """Initialize the Flux-dev model with optimizations for both memory and speed."""
+        """Initialize the Flux model with optimizations for both memory and speed."""
         if self.initialized:
             return
         
         # Model path
-        flux_model_path = "/models/flux-dev"
-        fp8_transformer_path = "/models/fp8_transformer/flux1-dev-fp8.safetensors"
+        variant = VARIANTS[self.variant]
+        flux_model_path = variant["model_path"]
+        fp8_transformer_path = variant["fp8_transformer_path"]
+        tiny_vae_path = "/models/taef1"
+        converted_transformer_path = variant["converted_transformer_path"]
         
-        # Load the Flux pipeline with optimizations
-        self.pipe = FluxPipeline.from_pretrained(
-            flux_model_path,
-            transformer=None,
-            # text_encoder_2=None,
-            torch_dtype=torch.bfloat16,
-        )
+        def subfolder(cls, name, **kwargs):
+            path = SHARED_MODEL_PATH if name in SHARED_COMPONENTS else flux_model_path
+            return lambda: cls.from_pretrained(path, subfolder=name, **kwargs)
+
+        if os.path.exists(os.path.join(converted_transformer_path, "config.json")):
+            load_transformer = lambda: FluxTransformer2DModel.from_pretrained(
+                converted_transformer_path,
+                torch_dtype=torch.bfloat16
+            )
+            transformer_files = weight_files(converted_transformer_path)
+        else:
+            # Images built before the conversion step: convert at load time
+            load_transformer = lambda: FluxTransformer2DModel.from_single_file(
+                fp8_transformer_path,
+                torch_dtype=torch.bfloat16
+            )
+            transformer_files = [fp8_transformer_path]
+
+        modules = {
+            "transformer": load_transformer,
+            "text_encoder_2": subfolder(T5EncoderModel, "text_encoder_2", torch_dtype=torch.bfloat16),
+            "text_encoder": subfolder(CLIPTextModel, "text_encoder", torch_dtype=torch.bfloat16),
+            "vae": subfolder(AutoencoderKL, "vae", torch_dtype=torch.bfloat16),
+            # taef1: tiny autoencoder for Flux's 16-channel latents (fast decode and previews)
+            "tiny_vae": lambda: AutoencoderTiny.from_pretrained(tiny_vae_path, torch_dtype=torch.bfloat16),
+        }
+        light = {
+            "tokenizer": subfolder(CLIPTokenizer, "tokenizer"),
+            "tokenizer_2": subfolder(T5TokenizerFast, "tokenizer_2"),
+            "scheduler": subfolder(FlowMatchEulerDiscreteScheduler, "scheduler"),
+        }
+        component_paths = {
+            **{name: os.path.join(SHARED_MODEL_PATH, name) for name in ("text_encoder_2", "text_encoder", "vae")},
+            "tiny_vae": tiny_vae_path,
+        }
+        # Components another variant already loaded are reused, not loaded again
+        shared = self.shared if self.shared is not None else {}
+        reused = {name: component for name in SHARED_COMPONENTS if (component := shared.get(name)) is not None}
         
-        transformer = FluxTransformer2DModel.from_single_file(
-            fp8_transformer_path, 
-            torch_dtype=torch.bfloat16
+        # Load the components concurrently: weight files are read ahead while
+        # the torch modules are built and the encoders are cast to bf16
+        components, self.load_timings = load_components(
+            {name: load for name, load in modules.items() if name not in reused},
+            light={name: load for name, load in light.items() if name not in reused},
+            prefetch=transformer_files + weight_files(
+                *(path for name, path in component_paths.items() if name not in reused)
+            ),
         )
-        self.pipe.transformer = transformer
-        self.pipe.enable_model_cpu_offload()
+        components.update(reused)
+        if self.shared is not None:
+            self.shared.update({name: components[name] for name in SHARED_COMPONENTS})
+        tiny_vae = components.pop("tiny_vae")
+        self.pipe = FluxPipeline(**components)
+        
+        if self.place:
+            # Keep as much resident as the card allows; offload only what doesn't fit
+            self.placement = place_pipeline(
+                self.pipe,
+                working_gb=self.WORKING_GB,
+                priority=("transformer", "vae", "text_encoder", "text_encoder_2"),
+                denoiser="transformer",
+                steps=self.defaults["num_inference_steps"],
+            )
+            # A few MB: always resident, so fast decodes and previews never wait for offloaded weights
+            tiny_vae = tiny_vae.to(self.pipe._execution_device)
+        self.tiny_vae = tiny_vae
+        self.decoder = Decoder(self.pipe.vae, self.tiny_vae, self.pipe.image_processor)
+        self.step_cache = StepCache(self.pipe.transformer, coefficients=FLUX_COEFFICIENTS)
         
         self.initialized = True
         
-    def generate(self, input_data):
-        """Generate an image based on the input and return as base64 string."""
+    def modules(self):
+        """Torch modules of the loaded model, for ModelResidency."""
+        modules = {name: c for name, c in self.pipe.components.items() if isinstance(c, torch.nn.Module)}
+        modules["tiny_vae"] = self.tiny_vae
+        return modules
+
+    def unload(self):
+        """Drop the model; the next generation loads it again (shared components may still be alive elsewhere)."""
+        self.pipe = None
+        self.tiny_vae = None
+        self.decoder = None
+        self.step_cache = None
+        self.placement = None
+        self.initialized = False
+
+    def cache_key(self, input_data, image=None):
+        """Result-cache key for a seeded request, or None when the output isn't deterministic.
+
+        For img2img, `image` (the FetchedImage) keys on the input's content, not just its URL.
+        """
+        if input_data.get("seed") is None:
+            return None
+        params = {name: input_data.get(name, default) for name, default in self.defaults.items()}
+        if image is not None:
+            params["image"] = list(image.key)
+            params["strength"] = input_data.get("strength", DEFAULT_STRENGTH)
+        if threshold := step_cache_threshold(input_data):
+            params["step_cache"] = threshold
+        params["prompt"] = normalize_prompt(params["prompt"])
+        params["negative_prompt"] = normalize_prompt(params["negative_prompt"])
+        params["seed"] = input_data["seed"]
+        params.update(image_options(input_data))
+        return cache_key(self.model_id, params)
+
+    def encode_prompt(self, prompt, max_sequence_length):
+        """(prompt_embeds, pooled_prompt_embeds) for one prompt, from the LRU cache when possible."""
+        key = PromptCache.key(self.model_id, prompt, max_sequence_length)
+        def encode():
+            prompt_embeds, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+                prompt=prompt,
+                prompt_2=None,
+                max_sequence_length=max_sequence_length,
+            )
+            return prompt_embeds, pooled_prompt_embeds
+        return self.prompt_cache.get_or_encode(key, encode, device=self.pipe._execution_device)
+
+    def warmup(self, width, height, steps):
+        """One throwaway generation at this size, so kernels and allocator are primed; nothing is uploaded."""
+        if not self.initialized:
+            self.initialize()
+        max_sequence_length = self.defaults["max_sequence_length"]
+        prompt_embeds, pooled_prompt_embeds = self.encode_prompt(self.defaults["prompt"], max_sequence_length)
+        self.pipe(
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            num_inference_steps=steps,
+            height=height,
+            width=width,
+            guidance_scale=self.defaults["guidance_scale"],
+            generator=torch.Generator("cpu").manual_seed(0),
+            max_sequence_length=max_sequence_length,
+        )
+
+    @release_on_cancel()
+    def generate(self, input_data, on_preview=None, image=None, cancel=None, on_uploaded=None):
+        """Generate an image based on the input; returns its URL and the number of steps the step cache skipped.
+
+        When on_preview is given it is called with a low-resolution preview
+        every `preview_every` denoising steps. With `image` (a FetchedImage)
+        it is used as the starting point (img2img), noised by `strength`.
+        Raises JobCancelled as soon as `cancel` (a CancelToken) is cancelled:
+        checked on every denoising step, before decoding and before upload.
+        on_uploaded(url) is called once the image is actually in R2.
+        """
         if not self.initialized:
             self.initialize()
+        cancel = cancel or CancelToken()
+        cancel.check()
         
         # Extract parameters from input data
-        prompt = input_data.get("prompt", "A photo of a cat")
-        negative_prompt = input_data.get("negative_prompt", "")
-        height = input_data.get("height", 768)
-        width = input_data.get("width", 1360)
-        steps = input_data.get("num_inference_steps", 30)
-        guidance_scale = input_data.get("guidance_scale", 3.5)
+        prompt = input_data.get("prompt", self.defaults["prompt"])
+        height = input_data.get("height", self.defaults["height"])
+        width = input_data.get("width", self.defaults["width"])
+        steps = input_data.get("num_inference_steps", self.defaults["num_inference_steps"])
+        guidance_scale = input_data.get("guidance_scale", self.defaults["guidance_scale"])
         seed = input_data.get("seed", None)
-        img_format = input_data.get("image_format", "png")
-        if img_format not in ["png", "jpeg", "jpg"]:
-            raise ValueError("Invalid image format. Supported formats are 'png' and 'jpg'.")
+        max_sequence_length = input_data.get("max_sequence_length", self.defaults["max_sequence_length"])
+        img_format = input_data.get("image_format", self.defaults["image_format"])
+        encode_options = image_options(input_data)
+        quality = decode_quality(input_data, self.defaults["decode_quality"])
+        threshold = step_cache_threshold(input_data)
         
         # Set up generator if seed is provided
         generator = None
         if seed is not None:
             generator = torch.Generator("cpu").manual_seed(seed)
         
-        # Generate the image
-        image = self.pipe(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            num_inference_steps=steps,
-            height=height,
-            width=width,
-            guidance_scale=guidance_scale,
-            generator=generator,
-        ).images[0]
-        
-        # Convert to base64
-        buffered = io.BytesIO()
+        # Object key (and so the public URL) is fixed before generation starts
         now = datetime.now()
         filename = f"{now.month}/{now.day}/{generate(size=10)}/{uuid.uuid4()}.{img_format}"
-        if img_format == "png":
-            image.save(buffered, format="PNG")
-            content_type = "image/png"
-        elif img_format == "jpeg" or img_format == "jpg":
-            image.convert("RGB")
-            # Convert to RGB for JPEG
-            image.save(buffered, format="JPEG")
-            content_type = "image/jpeg"
-        buffered.seek(0)
-        url = upload_to_r2(buffered.getvalue(), filename, content_type)
         
-        return url
+        # Low-resolution previews through the step-end callback
+        callback = None
+        if on_preview is not None:
+            preview_every, preview_size = preview_settings(input_data, default_every=5)
+            if preview_every:
+                def decode(pipe, latents):
+                    latents = pipe._unpack_latents(latents, height, width, pipe.vae_scale_factor)
+                    return tiny_vae_preview(self.tiny_vae, latents, preview_size)
+                callback = preview_callback(decode, steps, preview_every, on_preview)
+        
+        # Text encoder outputs come from the prompt cache; the (unused without
+        # true CFG) negative prompt is not encoded at all
+        prompt_embeds, pooled_prompt_embeds = self.encode_prompt(prompt, max_sequence_length)
+        print(f"Prompt cache: {self.prompt_cache.stats()}")
+        
+        pipe, img2img, denoise_steps = self.pipe, {}, steps
+        if image is not None:
+            # Same components, img2img denoising loop; the input's latents come from the cache when possible
+            pipe = FluxImg2ImgPipeline(**self.pipe.components)
+            img2img = {
+                "image": image_latents(
+                    self.pipe.vae, self.pipe.image_processor, image, height, width,
+                    device=self.pipe._execution_device, cache=self.latent_cache,
+                ),
+                "strength": input_data.get("strength", DEFAULT_STRENGTH),
+            }
+            # Only the last `strength` of the schedule runs, as in FluxImg2ImgPipeline.get_timesteps
+            denoise_steps = steps - int(steps - steps * img2img["strength"])
+            print(f"Latent cache: {self.latent_cache.stats()}")
+        
+        # Denoise (reusing the transformer's residual on steps the step cache
+        # skips), then decode with the VAE chosen by decode_quality
+        with self.step_cache.run(threshold, denoise_steps) as cached:
+            latents = pipe(
+                **img2img,
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                num_inference_steps=steps,
+                height=height,
+                width=width,
+                guidance_scale=guidance_scale,
+                generator=generator,
+                max_sequence_length=max_sequence_length,
+                callback_on_step_end=chain_callbacks(cancel.step_callback, callback),
+                output_type="latent",
+            ).images
+        if threshold:
+            print(f"Step cache: {cached.stats()}; total: {self.step_cache.stats()}")
+        cancel.check()
+        latents = self.pipe._unpack_latents(latents, height, width, self.pipe.vae_scale_factor)
+        image = self.decoder.decode(latents, quality)[0]
+        print(f"Decode: {self.decoder.stats()}")
+        cancel.check()
+        
+        # Encoded straight into R2, no intermediate BytesIO copy
+        url = submit_image(image, filename, img_format, on_uploaded=on_uploaded, **encode_options)
+        
+        return url, cached.skipped
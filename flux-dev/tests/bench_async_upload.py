@@ -0,0 +1,70 @@
+"""
+GPU-idle time per job with inline versus background R2 uploads.
+
+A stub S3 client adds a fixed put_object latency and a sleep stands in for the
+diffusion run, so the numbers only reflect how long the "GPU" waits between
+jobs for the upload to finish:
+
+    python bench_async_upload.py --jobs 20 --gen-ms 800 --upload-ms 400
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import uploader  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+class SlowS3Stub:
+    """Stands in for the R2 client; every put_object takes `latency` seconds."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.keys = []
+
+    def put_object(self, Key, **kwargs):
+        time.sleep(self.latency)
+        self.keys.append(Key)
+
+
+def run_jobs(upload_fn, jobs, gen_seconds, image):
+    idle = []
+    gpu_free_at = None
+    for i in range(jobs):
+        start = time.perf_counter()
+        if gpu_free_at is not None:
+            idle.append(start - gpu_free_at)
+        time.sleep(gen_seconds)  # the pipeline call
+        gpu_free_at = time.perf_counter()
+        upload_fn(image, f"bench/{i}.png", "png")
+    return idle
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--gen-ms", type=float, default=800)
+    parser.add_argument("--upload-ms", type=float, default=400)
+    args = parser.parse_args()
+
+    image = Image.new("RGB", (1360, 768), "gray")
+    gen_seconds = args.gen_ms / 1000
+
+    for mode, upload_fn in (("inline", uploader.upload_image), ("background", uploader.upload_queue.submit)):
+        stub = SlowS3Stub(args.upload_ms / 1000)
+        uploader._client = stub
+        start = time.perf_counter()
+        idle = run_jobs(upload_fn, args.jobs, gen_seconds, image)
+        uploader.upload_queue.flush()
+        total = time.perf_counter() - start
+        assert len(stub.keys) == args.jobs
+        print(f"{mode:<10} GPU idle/job {1000 * sum(idle) / len(idle):8.1f} ms   "
+              f"wall {total:6.2f} s for {args.jobs} jobs")
+    uploader.upload_queue.shutdown()
+
+
+if __name__ == "__main__":
+    main()
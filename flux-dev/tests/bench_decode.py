@@ -0,0 +1,71 @@
+"""
+Benchmark: latency and peak CUDA memory of "full" (AutoencoderKL) versus
+"fast" (taef1 tiny autoencoder) decodes through src/decode.py, at the
+standard Flux resolutions.
+
+Decode cost depends on the architecture, not the weights, so both
+autoencoders are built from their published configs with random weights
+(no download needed). Peak memory is only measured on CUDA:
+
+    pip install torch diffusers
+    python bench_decode.py --sizes 1360x768,1024x1024 --batch 1 --repeat 3
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from diffusers import AutoencoderKL, AutoencoderTiny
+from diffusers.image_processor import VaeImageProcessor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from decode import Decoder  # noqa: E402
+
+
+def flux_vae():
+    """FLUX.1 VAE architecture (black-forest-labs/FLUX.1-dev, subfolder vae)."""
+    return AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=16,
+        down_block_types=("DownEncoderBlock2D",) * 4, up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(128, 256, 512, 512), layers_per_block=2, sample_size=1024,
+        use_quant_conv=False, use_post_quant_conv=False, scaling_factor=0.3611, shift_factor=0.1159,
+    )
+
+
+def taef1():
+    """madebyollin/taef1 architecture."""
+    return AutoencoderTiny(latent_channels=16, scaling_factor=0.3611, shift_factor=0.1159)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1360x768,1024x1024")
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    dtype = torch.bfloat16 if args.device == "cuda" else torch.float32
+    full, fast = flux_vae().to(args.device, dtype).eval(), taef1().to(args.device, dtype).eval()
+    print(f"full VAE decoder {sum(p.numel() for p in full.decoder.parameters()) / 1e6:.1f}M params, "
+          f"taef1 decoder {sum(p.numel() for p in fast.decoder.parameters()) / 1e6:.1f}M params, {args.device}")
+    print(f"{'size':<10} {'quality':<8} {'ms/batch':>9} {'peak MB':>9}")
+    for size in args.sizes.split(","):
+        width, height = (int(side) for side in size.split("x"))
+        latents = torch.randn(args.batch, 16, height // 8, width // 8, device=args.device, dtype=dtype)
+        for quality in ("full", "fast"):
+            # Fresh decoder per row, so stats cover this size only; the first decode is warmup
+            decoder = Decoder(full, fast, VaeImageProcessor(vae_scale_factor=8))
+            decoder.decode(latents, quality)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                decoder.decode(latents, quality)
+            ms = (time.perf_counter() - start) * 1000 / args.repeat
+            peak = decoder.stats()[quality]["peak_mb"] if args.device == "cuda" else float("nan")
+            print(f"{size:<10} {quality:<8} {ms:>9.1f} {peak:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
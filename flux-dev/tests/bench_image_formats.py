@@ -0,0 +1,77 @@
+"""
+Encode time and output size per format at the standard resolutions, plus the
+throughput of encoding several images on the upload thread pool at once.
+
+Uses a smooth synthetic image with a little noise, which compresses roughly
+like a generated picture:
+
+    python bench_image_formats.py --repeat 3 --parallel 4
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from uploader import IMAGE_FORMATS, save_options  # noqa: E402
+
+RESOLUTIONS = [(1360, 768), (1024, 1024), (768, 768)]
+CASES = [
+    ("png", {}),
+    ("png", {"compress_level": 1}),
+    ("jpeg", {"quality": 95}),
+    ("webp", {"quality": 90}),
+    ("webp", {"lossless": True, "quality": 20}),
+    ("avif", {"quality": 75}),
+]
+
+
+def synthetic_image(width, height):
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    channels = [np.sin(6 * x + 2 * y), np.cos(4 * y - 3 * x), np.sin(5 * (x + y))]
+    pixels = np.stack([(c + 1) * 110 for c in channels], axis=-1)
+    pixels += np.random.default_rng(0).normal(0, 6, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def encode(image, img_format, options):
+    pil_format = IMAGE_FORMATS[img_format][0]
+    buffered = io.BytesIO()
+    image.save(buffered, format=pil_format, **save_options(pil_format, **options))
+    return buffered.getbuffer().nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--parallel", type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'resolution':<11} {'format':<36} {'size KB':>9} {'encode ms':>10} {'x' + str(args.parallel) + ' pool ms':>12}")
+    for width, height in RESOLUTIONS:
+        image = synthetic_image(width, height)
+        for img_format, options in CASES:
+            if img_format not in IMAGE_FORMATS:
+                continue
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                size = encode(image, img_format, options)
+            single = (time.perf_counter() - start) / args.repeat
+
+            with ThreadPoolExecutor(args.parallel) as pool:
+                start = time.perf_counter()
+                list(pool.map(lambda _: encode(image, img_format, options), range(args.parallel)))
+                pooled = time.perf_counter() - start
+
+            label = img_format + (f" {options}" if options else "")
+            print(f"{width}x{height:<6} {label:<36} {size / 1024:9.0f} {single * 1000:10.1f} {pooled * 1000:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark: text-encode time per request with and without the prompt
+embedding cache in src/prompt_cache.py, on a tiny randomly initialized Flux
+pipeline on CPU (no weights or GPU needed).
+
+Prompts are drawn so that about --repeat-rate of requests reuse an earlier
+prompt:
+
+    pip install torch diffusers transformers tokenizers
+    python bench_prompt_cache.py --requests 200 --repeat-rate 0.5 --t5-dim 512 --t5-layers 8
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import torch
+from diffusers.utils import logging as diffusers_logging
+from transformers.utils import logging as transformers_logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from prompt_cache import PromptCache  # noqa: E402
+from tiny_flux import VOCAB_SIZE, tiny_flux_pipeline  # noqa: E402
+from txt2img_flux_dev import FluxDevGenerator  # noqa: E402
+
+
+def workload(requests, repeat_rate, seed=0):
+    rng = random.Random(seed)
+    seen = []
+    prompts = []
+    for _ in range(requests):
+        if seen and rng.random() < repeat_rate:
+            prompts.append(rng.choice(seen))
+        else:
+            prompt = " ".join(f"w{rng.randrange(VOCAB_SIZE - 3)}" for _ in range(rng.randint(8, 40)))
+            seen.append(prompt)
+            prompts.append(prompt)
+    return prompts
+
+
+def run(generator, prompts, max_sequence_length):
+    start = time.perf_counter()
+    for prompt in prompts:
+        generator.encode_prompt(prompt, max_sequence_length)
+    return (time.perf_counter() - start) * 1000 / len(prompts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--repeat-rate", type=float, default=0.5)
+    parser.add_argument("--max-sequence-length", type=int, default=512)
+    parser.add_argument("--t5-dim", type=int, default=512)
+    parser.add_argument("--t5-layers", type=int, default=8)
+    args = parser.parse_args()
+
+    diffusers_logging.set_verbosity_error()
+    transformers_logging.set_verbosity_error()
+    generator = FluxDevGenerator()
+    generator.pipe = tiny_flux_pipeline(t5_dim=args.t5_dim, t5_layers=args.t5_layers)
+    generator.initialized = True
+    prompts = workload(args.requests, args.repeat_rate)
+
+    with torch.no_grad():
+        generator.encode_prompt("w1 w2 w3", args.max_sequence_length)  # warm up
+        generator.prompt_cache = PromptCache()
+        generator.prompt_cache.enabled = False
+        uncached = run(generator, prompts, args.max_sequence_length)
+        generator.prompt_cache = PromptCache()
+        cached = run(generator, prompts, args.max_sequence_length)
+
+    stats = generator.prompt_cache.stats()
+    print(f"{args.requests} requests, repeat rate {args.repeat_rate}, T5 d_model {args.t5_dim} x {args.t5_layers} layers")
+    print(f"no cache   {uncached:8.2f} ms/request")
+    print(f"cache      {cached:8.2f} ms/request   hit rate {stats['hit_rate']:.2f}   "
+          f"{stats['entries']} entries, {stats['bytes'] / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Replays a request mix through the result cache the way handler.py does and
+reports hit rate, evictions and mean job latency against always generating.
+
+A sleep stands in for the GPU generation:
+
+    python bench_result_cache.py --requests 2000 --repeat-rate 0.3 --max-entries 500
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from result_cache import ResultCache, cache_key  # noqa: E402
+
+
+def request_mix(count, repeat_rate, rng):
+    seen = []
+    for i in range(count):
+        if seen and rng.random() < repeat_rate:
+            yield rng.choice(seen)
+        else:
+            params = {"prompt": f"prompt {i}", "seed": rng.randrange(2 ** 31), "width": 1360, "height": 768}
+            seen.append(params)
+            yield params
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--repeat-rate", type=float, default=0.3)
+    parser.add_argument("--max-entries", type=int, default=500)
+    parser.add_argument("--gen-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ResultCache(path=os.path.join(tmp, "cache.sqlite3"), max_entries=args.max_entries, verify=False)
+        rng = random.Random(0)
+        start = time.perf_counter()
+        for params in request_mix(args.requests, args.repeat_rate, rng):
+            key = cache_key("bench-model", params)
+            if cache.get(key) is None:
+                time.sleep(args.gen_ms / 1000)
+                cache.put(key, [f"https://cdn/{key}.png"])
+        cached = time.perf_counter() - start
+
+    stats = cache.stats()
+    print(f"{args.requests} requests, repeat rate {args.repeat_rate:.0%}, {args.max_entries} entries max")
+    print(f"hits {stats['hits']}  misses {stats['misses']}  evictions {stats['evictions']}  "
+          f"hit rate {stats['hits'] / args.requests:.1%}")
+    print(f"mean latency {1000 * cached / args.requests:.2f} ms with cache, "
+          f"{args.gen_ms:.2f} ms without")
+
+
+if __name__ == "__main__":
+    main()
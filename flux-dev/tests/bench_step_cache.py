@@ -0,0 +1,72 @@
+"""
+Benchmark: denoising time per image and skipped steps of the step cache in
+src/step_cache.py at several thresholds, on a tiny randomly initialized Flux
+pipeline on CPU (no weights or GPU needed).
+
+Quality is the relative L1 error of the final latents against the uncached
+run with the same seed. Random weights don't behave like FLUX.1's, so the
+raw relative change is used (no rescaling polynomial) and the thresholds
+here don't transfer to the real model:
+
+    pip install torch diffusers transformers tokenizers
+    python bench_step_cache.py --steps 30 --layers 8 --size 128 --thresholds 0,0.05,0.1,0.2,0.4
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from diffusers.utils import logging as diffusers_logging
+from transformers.utils import logging as transformers_logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from step_cache import StepCache  # noqa: E402
+from tiny_flux import tiny_flux_pipeline  # noqa: E402
+
+
+def generate(pipe, size, steps, seed):
+    return pipe(
+        prompt="w1 w2 w3 w4", height=size, width=size, num_inference_steps=steps, guidance_scale=0.0,
+        generator=torch.Generator("cpu").manual_seed(seed), output_type="latent",
+    ).images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--layers", type=int, default=8, help="double and single transformer blocks each")
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--images", type=int, default=3)
+    parser.add_argument("--thresholds", default="0,0.05,0.1,0.2,0.4")
+    args = parser.parse_args()
+
+    diffusers_logging.set_verbosity_error()
+    transformers_logging.set_verbosity_error()
+    pipe = tiny_flux_pipeline(transformer_layers=args.layers)
+    cache = StepCache(pipe.transformer)
+    generate(pipe, args.size, 2, seed=0)  # warm up
+
+    print(f"{args.size}x{args.size}, {args.steps} steps, {args.layers}+{args.layers} blocks, {args.images} images")
+    print(f"{'threshold':>10} {'ms/image':>10} {'speedup':>8} {'skipped':>8} {'rel. error':>11}")
+    reference = None
+    baseline = None
+    for threshold in (float(t) for t in args.thresholds.split(",")):
+        latents, skipped = [], 0
+        start = time.perf_counter()
+        for seed in range(args.images):
+            with cache.run(threshold, args.steps) as run:
+                latents.append(generate(pipe, args.size, args.steps, seed))
+            skipped += run.skipped
+        ms = (time.perf_counter() - start) * 1000 / args.images
+        if reference is None:
+            reference, baseline = latents, ms
+        error = sum(
+            ((a - b).abs().mean() / b.abs().mean()).item() for a, b in zip(latents, reference)
+        ) / args.images
+        print(f"{threshold:>10g} {ms:>10.1f} {baseline / ms:>7.2f}x {skipped / args.images:>8.1f} {error:>11.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Peak Python memory per image for the legacy BytesIO + getvalue() upload
+versus encoding straight into uploader.StreamingUpload.
+
+Uploads go to a stub client that only counts bytes, so the numbers are the
+encode/upload path alone. Noise images are used because they barely compress
+and give the worst-case PNG size:
+
+    python bench_stream_encode.py
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import uploader  # noqa: E402
+
+RESOLUTIONS = [(1360, 768), (1024, 1024), (2048, 2048)]
+
+
+class CountingS3Stub:
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def put_object(self, Body, **kwargs):
+        self.bytes_sent += len(Body)
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "bench"}
+
+    def upload_part(self, Body, PartNumber, **kwargs):
+        self.bytes_sent += len(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+
+def legacy_upload(image, filename, img_format):
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    buffered.seek(0)
+    uploader.upload_to_r2(buffered.getvalue(), filename, "image/png")
+
+
+def measure(upload_fn, image):
+    stub = CountingS3Stub()
+    uploader._client = stub
+    tracemalloc.start()
+    start = time.perf_counter()
+    upload_fn(image, "bench.png", "png")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed, stub.bytes_sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threshold-mb", type=float, default=5)
+    args = parser.parse_args()
+    os.environ["R2_MULTIPART_THRESHOLD"] = str(int(args.threshold_mb * 1024 * 1024))
+
+    print(f"{'resolution':<11} {'png size':>10} {'legacy peak':>12} {'stream peak':>12} "
+          f"{'legacy ms':>10} {'stream ms':>10}")
+    for width, height in RESOLUTIONS:
+        pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels)
+        legacy_peak, legacy_s, size = measure(legacy_upload, image)
+        stream_peak, stream_s, _ = measure(uploader.upload_image, image)
+        mb = 1024 * 1024
+        print(f"{width}x{height:<6} {size / mb:8.2f}MB {legacy_peak / mb:10.2f}MB {stream_peak / mb:10.2f}MB "
+              f"{legacy_s * 1000:10.1f} {stream_s * 1000:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Benchmark: load time and peak host memory of the Flux transformer from the
+original fp8 single file (key conversion and upcast at load time) versus the
+bf16 diffusers shards written by src/download_model.py.
+
+Each load runs in a fresh process, so peak RSS is per path, and is timed
+until the weights are on --device (cuda when available). The first run of
+a path may be served from disk, later ones from the page cache; both are
+reported. Inside the built image, against the real weights:
+
+    python bench_transformer_load.py --single-file /models/fp8_transformer/flux1-dev-fp8.safetensors \\
+        --converted /models/fp8_transformer/flux1-dev-fp8-diffusers --config /models/flux-dev/transformer
+
+Without weights, --synthetic writes a random fp8 checkpoint in the original
+key layout (full width, --double-blocks/--single-blocks deep) and converts it
+the way download_model.py does:
+
+    pip install torch diffusers safetensors
+    python bench_transformer_load.py --synthetic --double-blocks 1 --single-blocks 2
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+HIDDEN = 3072
+MLP = 4 * HIDDEN
+HEAD_DIM = 128
+
+
+def synthetic_checkpoint(double_blocks, single_blocks):
+    """Random fp8 weights under the original (BFL) key names, FLUX.1-dev shapes."""
+    shapes = {
+        "img_in": (HIDDEN, 64), "txt_in": (HIDDEN, 4096),
+        "time_in.in_layer": (HIDDEN, 256), "time_in.out_layer": (HIDDEN, HIDDEN),
+        "guidance_in.in_layer": (HIDDEN, 256), "guidance_in.out_layer": (HIDDEN, HIDDEN),
+        "vector_in.in_layer": (HIDDEN, 768), "vector_in.out_layer": (HIDDEN, HIDDEN),
+        "final_layer.linear": (64, HIDDEN), "final_layer.adaLN_modulation.1": (2 * HIDDEN, HIDDEN),
+    }
+    norms = []
+    for i in range(double_blocks):
+        for stream in ("img", "txt"):
+            prefix = f"double_blocks.{i}.{stream}"
+            shapes.update({
+                f"{prefix}_mod.lin": (6 * HIDDEN, HIDDEN),
+                f"{prefix}_attn.qkv": (3 * HIDDEN, HIDDEN),
+                f"{prefix}_attn.proj": (HIDDEN, HIDDEN),
+                f"{prefix}_mlp.0": (MLP, HIDDEN),
+                f"{prefix}_mlp.2": (HIDDEN, MLP),
+            })
+            norms += [f"{prefix}_attn.norm.query_norm.scale", f"{prefix}_attn.norm.key_norm.scale"]
+    for i in range(single_blocks):
+        prefix = f"single_blocks.{i}"
+        shapes.update({
+            f"{prefix}.linear1": (3 * HIDDEN + MLP, HIDDEN),
+            f"{prefix}.linear2": (HIDDEN, HIDDEN + MLP),
+            f"{prefix}.modulation.lin": (3 * HIDDEN, HIDDEN),
+        })
+        norms += [f"{prefix}.norm.query_norm.scale", f"{prefix}.norm.key_norm.scale"]
+    checkpoint = {}
+    for name, shape in shapes.items():
+        checkpoint[f"{name}.weight"] = (torch.randn(shape) * 0.02).to(torch.float8_e4m3fn)
+        checkpoint[f"{name}.bias"] = torch.zeros(shape[0]).to(torch.float8_e4m3fn)
+    for name in norms:
+        checkpoint[name] = torch.ones(HEAD_DIM).to(torch.float8_e4m3fn)
+    return checkpoint
+
+
+def make_synthetic(directory, double_blocks, single_blocks):
+    from diffusers import FluxTransformer2DModel
+    from safetensors.torch import save_file
+
+    single_file = os.path.join(directory, "flux-fp8.safetensors")
+    save_file(synthetic_checkpoint(double_blocks, single_blocks), single_file)
+    config = os.path.join(directory, "config")
+    os.makedirs(config)
+    with open(os.path.join(config, "config.json"), "w") as f:
+        json.dump({
+            "_class_name": "FluxTransformer2DModel", "num_layers": double_blocks,
+            "num_single_layers": single_blocks, "guidance_embeds": True,
+        }, f)
+    # Same conversion as download_model.py
+    converted = os.path.join(directory, "flux-fp8-diffusers")
+    transformer = FluxTransformer2DModel.from_single_file(single_file, config=config, torch_dtype=torch.bfloat16)
+    transformer.save_pretrained(converted, max_shard_size="2GB")
+    return single_file, converted, config
+
+
+def peak_rss_gb():
+    # VmHWM rather than ru_maxrss, which Linux carries over from the parent across exec
+    with open("/proc/self/status") as f:
+        kb = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    return kb / 2**20
+
+
+def load_once(path, kind, config, device):
+    """Child process: load one way until the weights are usable on `device`, print seconds and peak RSS."""
+    from diffusers import FluxTransformer2DModel
+    from diffusers.utils import logging
+
+    logging.set_verbosity_error()
+    start = time.perf_counter()
+    if kind == "single_file":
+        model = FluxTransformer2DModel.from_single_file(path, config=config, torch_dtype=torch.bfloat16)
+    else:
+        model = FluxTransformer2DModel.from_pretrained(path, torch_dtype=torch.bfloat16)
+    assert next(model.parameters()).dtype == torch.bfloat16
+    # Safetensors shards are mmapped, so pages are only read on first use:
+    # include moving to the GPU (or touching every page on CPU) in the time
+    if device == "cuda":
+        model.to(device)
+        torch.cuda.synchronize()
+    else:
+        with torch.no_grad():
+            for tensor in model.state_dict().values():
+                tensor.view(-1)[::2048].float().sum()
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": seconds, "peak_rss_gb": peak_rss_gb()}))
+
+
+def measure(path, kind, config, device):
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", kind, "--path", path, "--config", config or "", "--device", device],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--single-file")
+    parser.add_argument("--converted")
+    parser.add_argument("--config", help="directory with the transformer's config.json")
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--double-blocks", type=int, default=1)
+    parser.add_argument("--single-blocks", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--child", choices=("single_file", "converted"), help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        load_once(args.path, args.child, args.config or None, args.device)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.synthetic:
+            args.single_file, args.converted, args.config = make_synthetic(directory, args.double_blocks, args.single_blocks)
+        if not (args.single_file and args.converted):
+            parser.error("pass --single-file and --converted, or --synthetic")
+        sizes = {
+            "single_file": os.path.getsize(args.single_file),
+            "converted": sum(os.path.getsize(os.path.join(args.converted, f)) for f in os.listdir(args.converted)),
+        }
+        runs = {"single_file": [], "converted": []}
+        # Interleaved, so neither path alone benefits from a warmer page cache
+        for _ in range(args.repeat):
+            runs["single_file"].append(measure(args.single_file, "single_file", args.config, args.device))
+            runs["converted"].append(measure(args.converted, "converted", None, args.device))
+
+    print(f"{'path':<12} {'on disk':>9} {'first':>8} {'median':>8} {'peak RSS':>9}")
+    for kind, results in runs.items():
+        seconds = [r["seconds"] for r in results]
+        print(
+            f"{kind:<12} {sizes[kind] / 2**30:>7.2f}GB {seconds[0]:>7.2f}s {statistics.median(seconds):>7.2f}s "
+            f"{max(r['peak_rss_gb'] for r in results):>7.2f}GB"
+        )
+    speedup = statistics.median(r["seconds"] for r in runs["single_file"]) / statistics.median(
+        r["seconds"] for r in runs["converted"]
+    )
+    print(f"converted layout loads {speedup:.2f}x faster")
+
+
+if __name__ == "__main__":
+    main()
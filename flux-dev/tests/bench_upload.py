@@ -0,0 +1,105 @@
+"""
+Micro-benchmark: per-upload latency of the legacy per-call boto3 session
+versus the shared pooled client in src/uploader.py.
+
+Runs against a local moto S3 server, so no R2 credentials are needed:
+
+    pip install "moto[server]" boto3
+    python bench_upload.py --uploads 200 --size-kb 1500
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.client import Config
+from moto.server import ThreadedMotoServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import uploader  # noqa: E402
+
+
+def legacy_upload_to_r2(image_bytes, filename, content_type):
+    """The pre-pooling implementation: new session and client for every image."""
+    session = boto3.session.Session()
+    expires_at = (datetime.utcnow() + timedelta(hours=24)).isoformat()
+    client = session.client(
+        's3',
+        region_name='auto',
+        endpoint_url=os.getenv('R2_ENDPOINT_URL'),
+        aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
+        config=Config(signature_version='s3v4')
+    )
+    client.put_object(
+        Bucket=os.getenv('R2_BUCKET_NAME'),
+        Key=filename,
+        Body=image_bytes,
+        ContentType=content_type,
+        Metadata={"expires-at": expires_at},
+        ACL='public-read'
+    )
+    return f"{os.getenv('PUBLIC_URL')}/{filename}"
+
+
+def run(upload_fn, payload, uploads):
+    timings = []
+    for i in range(uploads):
+        start = time.perf_counter()
+        upload_fn(payload, f"bench/{upload_fn.__name__}/{i}.png", "image/png")
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<10} mean {statistics.mean(timings):8.2f} ms   "
+          f"p50 {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uploads", type=int, default=100)
+    parser.add_argument("--size-kb", type=int, default=1500)
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    os.environ.update({
+        "R2_ENDPOINT_URL": f"http://127.0.0.1:{args.port}",
+        "R2_ACCESS_KEY_ID": "bench",
+        "R2_SECRET_ACCESS_KEY": "bench",
+        "R2_BUCKET_NAME": "bench",
+        "PUBLIC_URL": "https://cdn.example.com",
+    })
+    try:
+        boto3.client(
+            "s3",
+            region_name="us-east-1",
+            endpoint_url=os.environ["R2_ENDPOINT_URL"],
+            aws_access_key_id="bench",
+            aws_secret_access_key="bench",
+        ).create_bucket(Bucket="bench")
+        payload = os.urandom(args.size_kb * 1024)
+
+        # One untimed call each so imports and the moto bucket are warm.
+        legacy_upload_to_r2(payload, "bench/warmup-legacy.png", "image/png")
+        uploader.upload_to_r2(payload, "bench/warmup-pooled.png", "image/png")
+
+        print(f"{args.uploads} uploads of {args.size_kb} KB")
+        report("legacy", run(legacy_upload_to_r2, payload, args.uploads))
+        report("pooled", run(uploader.upload_to_r2, payload, args.uploads))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
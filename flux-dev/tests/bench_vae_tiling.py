@@ -0,0 +1,73 @@
+"""
+Benchmark: latency, peak CUDA memory and fidelity of full, sliced and tiled
+VAE decodes through src/decode.py, from standard to large resolutions.
+
+Each strategy is forced with DECODE_STRATEGY; PSNR is measured against the
+full decode of the same latents (inf for sliced, which is exact). The VAE
+is the Flux AutoencoderKL architecture with random weights, as in
+bench_decode.py, so PSNR shows seam error only, not image quality. Peak
+memory is only measured on CUDA:
+
+    pip install torch diffusers
+    python bench_vae_tiling.py --sizes 1024x1024,2048x2048 --batch 2 --tile 512
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from diffusers.image_processor import VaeImageProcessor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from bench_decode import flux_vae, taef1  # noqa: E402
+from decode import DECODE_STRATEGIES, FULL, TILED, Decoder  # noqa: E402
+
+
+def psnr(images, references):
+    error = np.mean([
+        np.mean((np.asarray(image, dtype=np.float64) - np.asarray(reference, dtype=np.float64)) ** 2)
+        for image, reference in zip(images, references)
+    ])
+    return math.inf if error == 0 else 10 * math.log10(255**2 / error)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1024x1024,2048x2048")
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--tile", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    dtype = torch.bfloat16 if args.device == "cuda" else torch.float32
+    full, fast = flux_vae().to(args.device, dtype).eval(), taef1().to(args.device, dtype).eval()
+    os.environ["DECODE_TILE"] = str(args.tile)
+    print(f"batch {args.batch}, tile {args.tile}, {args.device}")
+    print(f"{'size':<10} {'strategy':<10} {'ms/batch':>9} {'peak MB':>9} {'PSNR dB':>8}")
+    for size in args.sizes.split(","):
+        width, height = (int(side) for side in size.split("x"))
+        latents = torch.randn(args.batch, 16, height // 8, width // 8, device=args.device, dtype=dtype)
+        reference = None
+        for strategy in DECODE_STRATEGIES:
+            os.environ["DECODE_STRATEGY"] = strategy
+            # Fresh decoder per row, so stats cover this size and strategy only
+            decoder = Decoder(full, fast, VaeImageProcessor(vae_scale_factor=8))
+            images = decoder.decode(latents, "full")
+            if strategy == FULL:
+                reference = images
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                decoder.decode(latents, "full")
+            ms = (time.perf_counter() - start) * 1000 / args.repeat
+            peak = decoder.stats()["full"]["peak_mb"] if args.device == "cuda" else float("nan")
+            label = f"{strategy}@{args.tile}" if strategy == TILED else strategy
+            print(f"{size:<10} {label:<10} {ms:>9.1f} {peak:>9.1f} {psnr(images, reference):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+
+from cancellation import CancelGroup, CancelToken, CancelWatcher, JobCancelled, job_deadline  # noqa: E402
+from gpu_executor import GPUExecutor  # noqa: E402
+
+
+def tiny_generator(monkeypatch):
+    """A FluxDevGenerator around the tiny random-weight pipeline, recording decodes and uploads."""
+    import torch
+    from diffusers import AutoencoderTiny
+
+    import txt2img_flux_dev
+    from decode import Decoder
+    from step_cache import StepCache
+    from tiny_flux import tiny_flux_pipeline
+
+    torch.manual_seed(0)
+    generator = txt2img_flux_dev.FluxDevGenerator()
+    generator.pipe = tiny_flux_pipeline()
+    generator.tiny_vae = AutoencoderTiny(
+        latent_channels=1, encoder_block_out_channels=(4, 4, 4, 4), decoder_block_out_channels=(4, 4, 4, 4),
+    )
+    generator.decoder = Decoder(generator.pipe.vae, generator.tiny_vae, generator.pipe.image_processor)
+    generator.step_cache = StepCache(generator.pipe.transformer)
+    generator.initialized = True
+    generator.decodes, generator.uploads = [], []
+    decode = generator.decoder.decode
+    generator.decoder.decode = lambda *args: generator.decodes.append(1) or decode(*args)
+    monkeypatch.setattr(
+        txt2img_flux_dev, "submit_image", lambda image, *args, **kwargs: generator.uploads.append(image) or "url"
+    )
+    return generator
+
+
+OPTIONS = {"prompt": "w1", "height": 32, "width": 32, "num_inference_steps": 8, "seed": 1}
+
+
+def test_deadlines_and_groups():
+    token = CancelToken(deadline=time.time() - 1)
+    assert token.cancelled and token.reason == "deadline exceeded"
+    with pytest.raises(JobCancelled, match="deadline exceeded"):
+        token.check()
+
+    first, second = CancelToken(), CancelToken(deadline=time.time() + 60)
+    group = CancelGroup([first, second])
+    first.cancel()
+    assert not group.cancelled
+    second.cancel("timed_out")
+    assert group.cancelled and group.reason == "cancelled"
+
+
+def test_job_deadline_input(monkeypatch):
+    monkeypatch.delenv("JOB_TIMEOUT_SECONDS", raising=False)
+    assert job_deadline({}) is None
+    assert job_deadline({"deadline": 1700000000}) == 1700000000.0
+    monkeypatch.setenv("JOB_TIMEOUT_SECONDS", "30")
+    assert 29 < job_deadline({}) - time.time() <= 30
+    for value in (0, "soon", True):
+        with pytest.raises(ValueError):
+            job_deadline({"deadline": value})
+
+
+def test_job_cancelled_upstream_stops_at_the_next_step(monkeypatch):
+    generator = tiny_generator(monkeypatch)
+    # Fake job source: the state of each job, as the runpod status API would report it
+    statuses = {"job-1": "IN_PROGRESS"}
+    watcher = CancelWatcher(status=statuses.get, interval=0.01)
+    token = CancelToken()
+    calls = []
+
+    def cancel_after_two_steps(*args):
+        calls.append(1)
+        if len(calls) == 2:
+            statuses["job-1"] = "CANCELLED"
+            assert token.wait(1)
+
+    generator.pipe.transformer.register_forward_hook(cancel_after_two_steps)
+    with watcher.watch("job-1", token), pytest.raises(JobCancelled, match="cancelled"):
+        generator.generate(OPTIONS, cancel=token)
+
+    assert len(calls) == 2 and watcher.cancelled == 1
+    assert generator.decodes == [] and generator.uploads == []
+
+    # The next job on the same generator is unaffected
+    assert generator.generate(OPTIONS, cancel=CancelToken()) == ("url", 0)
+    assert len(calls) == 10 and len(generator.uploads) == 1
+
+
+def test_deadline_passed_during_decode_skips_the_upload(monkeypatch):
+    generator = tiny_generator(monkeypatch)
+    token = CancelToken(deadline=time.time() + 60)
+    decode = generator.decoder.decode
+
+    def slow_decode(*args):
+        token.deadline = time.time()
+        return decode(*args)
+
+    generator.decoder.decode = slow_decode
+    with pytest.raises(JobCancelled, match="deadline exceeded"):
+        generator.generate(OPTIONS, cancel=token)
+    assert generator.decodes == [1] and generator.uploads == []
+
+
+def test_abandoned_job_is_cancelled_on_the_gpu_thread():
+    executor = GPUExecutor()
+    token = CancelToken()
+    started = threading.Event()
+    steps = []
+
+    def job(cancel):
+        started.set()
+        for step in range(500):
+            cancel.check()
+            steps.append(step)
+            time.sleep(0.01)
+
+    async def main():
+        task = asyncio.create_task(token.guard(executor.run(job, cancel=token)))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    while executor.metrics()["cancelled"] != 1:
+        time.sleep(0.01)
+    assert token.reason == "cancelled" and len(steps) < 500
+    assert executor.metrics()["failed"] == 0
@@ -0,0 +1,93 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import numpy as np  # noqa: E402
+import pytest  # noqa: E402
+import torch  # noqa: E402
+from diffusers import AutoencoderTiny  # noqa: E402
+
+from decode import GB, SLICED, TILED, Decoder, apply_decode_plan, decode_quality, plan_decode  # noqa: E402
+from tiny_flux import tiny_flux_pipeline  # noqa: E402
+
+
+def tiny_autoencoder():
+    torch.manual_seed(0)
+    return AutoencoderTiny(
+        latent_channels=1, encoder_block_out_channels=(4, 4, 4, 4), decoder_block_out_channels=(4, 4, 4, 4),
+        scaling_factor=0.5, shift_factor=0.1,
+    ).eval()
+
+
+def test_decode_quality_validation():
+    assert decode_quality({}, "full") == "full"
+    assert decode_quality({"decode_quality": "fast"}, "full") == "fast"
+    with pytest.raises(ValueError):
+        decode_quality({"decode_quality": "draft"}, "full")
+
+
+def test_full_decode_matches_the_pipeline_and_fast_uses_the_tiny_autoencoder():
+    pipe = tiny_flux_pipeline()
+    decoder = Decoder(pipe.vae, tiny_autoencoder(), pipe.image_processor)
+    options = dict(prompt="w1 w2", height=32, width=32, num_inference_steps=2, guidance_scale=1.0)
+    expected = pipe(**options, generator=torch.Generator().manual_seed(0)).images[0]
+    latents = pipe(**options, generator=torch.Generator().manual_seed(0), output_type="latent").images
+    latents = pipe._unpack_latents(latents, 32, 32, pipe.vae_scale_factor)
+
+    full = decoder.decode(latents, "full")[0]
+    assert np.array_equal(np.asarray(full), np.asarray(expected))
+
+    # Three 2x upsampling stages: 8x the latent size
+    fast = decoder.decode(latents, "fast")
+    assert len(fast) == 1 and fast[0].size == (8 * latents.shape[-1], 8 * latents.shape[-2])
+
+    stats = decoder.stats()
+    assert stats["full"]["decodes"] == 1 and stats["fast"]["decodes"] == 1
+    assert stats["fast"]["mean_ms"] >= 0
+
+
+def test_plan_decode_picks_the_cheapest_strategy_that_fits(monkeypatch):
+    monkeypatch.delenv("DECODE_STRATEGY", raising=False)
+    monkeypatch.delenv("DECODE_TILE", raising=False)
+    assert plan_decode(4, 1024, 1024, 3.0, 20 * GB) == ("full", None)
+    assert plan_decode(4, 1024, 1024, 3.0, 8 * GB) == ("sliced", None)
+    # 7 GB budget at 3 GB/MP: tiles of ~1527 px, rounded down to a multiple of 64
+    assert plan_decode(1, 4096, 4096, 3.0, 8 * GB) == ("tiled", 1472)
+    # Never below MIN_TILE, even when memory is short
+    assert plan_decode(1, 4096, 4096, 3.0, 1.5 * GB) == ("tiled", 512)
+    # No CUDA: nothing to measure against
+    assert plan_decode(8, 4096, 4096, 3.0, None) == ("full", None)
+
+    monkeypatch.setenv("DECODE_STRATEGY", "tiled")
+    monkeypatch.setenv("DECODE_TILE", "768")
+    assert plan_decode(1, 1024, 1024, 3.0, 20 * GB) == ("tiled", 768)
+    monkeypatch.setenv("DECODE_STRATEGY", "chunked")
+    with pytest.raises(ValueError):
+        plan_decode(1, 1024, 1024, 3.0, 20 * GB)
+
+
+def test_sliced_decode_matches_whole_batch(monkeypatch):
+    pipe = tiny_flux_pipeline()
+    decoder = Decoder(pipe.vae, tiny_autoencoder(), pipe.image_processor)
+    latents = torch.randn(2, 1, 24, 24)
+    monkeypatch.setenv("DECODE_STRATEGY", "full")
+    expected = decoder.decode(latents, "full")
+    monkeypatch.setenv("DECODE_STRATEGY", "sliced")
+    sliced = decoder.decode(latents, "full")
+    assert pipe.vae.use_slicing and not pipe.vae.use_tiling
+    for image, reference in zip(sliced, expected):
+        assert np.abs(np.asarray(image, dtype=int) - np.asarray(reference, dtype=int)).max() <= 1
+    assert decoder.stats()["full"]["strategies"] == {"full": 1, "sliced": 1}
+
+
+def test_tiled_decode_keeps_the_output_size():
+    vae = tiny_autoencoder()
+    latents = torch.randn(1, 1, 20, 28)
+    expected = vae.decode(latents, return_dict=False)[0]
+    apply_decode_plan(vae, TILED, 64)
+    assert vae.use_tiling and vae.tile_latent_min_size == 8 and vae.tile_overlap_factor == 0.25
+    tiled = vae.decode(latents, return_dict=False)[0]
+    assert tiled.shape == expected.shape
+    apply_decode_plan(vae, SLICED)
+    assert not vae.use_tiling
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+
+from gpu_executor import GPUExecutor, QueueFull  # noqa: E402
+
+
+def test_runs_jobs_in_order_on_one_thread():
+    executor = GPUExecutor(max_queue=8)
+    futures = [executor.submit(lambda i=i: (i, threading.current_thread().name)) for i in range(4)]
+    results = [f.result(5) for f in futures]
+    assert [i for i, _ in results] == [0, 1, 2, 3]
+    assert {name for _, name in results} == {"gpu-executor"}
+
+
+def test_rejects_when_queue_is_full():
+    executor = GPUExecutor(max_queue=2)
+    release = threading.Event()
+    running = executor.submit(release.wait, 5)
+    while executor.metrics()["running"] != 1:
+        time.sleep(0.01)
+    executor.submit(lambda: None)
+    executor.submit(lambda: None)
+    with pytest.raises(QueueFull):
+        executor.submit(lambda: None)
+
+    metrics = executor.metrics()
+    assert (metrics["queued"], metrics["running"], metrics["rejected"]) == (2, 1, 1)
+    release.set()
+    running.result(5)
+
+
+def test_concurrency_follows_measured_latency():
+    executor = GPUExecutor(max_queue=16, target_latency=1.0, initial_concurrency=2)
+    assert executor.concurrency_modifier(500) == 2
+    executor.submit(time.sleep, 0.2).result(5)
+    assert 3 <= executor.concurrency_modifier(2) <= 5
+    executor.seconds_per_job = 0.01
+    assert executor.concurrency_modifier(5) == 16  # capped by the queue
+    executor.seconds_per_job = 10.0
+    assert executor.concurrency_modifier(5) == 1
+
+
+def test_small_latency_drift_keeps_the_concurrency():
+    executor = GPUExecutor(max_queue=16, target_latency=8.0)
+    executor.seconds_per_job = 1.0
+    assert executor.concurrency_modifier(2) == 8
+    # 7.2 to 8.9 jobs fit: within one job of 8, so runpod isn't made to drain
+    for seconds in (1.02, 0.98, 1.1, 0.9, 1.05):
+        executor.seconds_per_job = seconds
+        assert executor.concurrency_modifier(8) == 8
+    executor.seconds_per_job = 1.2
+    assert executor.concurrency_modifier(8) == 6
+    executor.seconds_per_job = 0.8
+    assert executor.concurrency_modifier(6) == 10
+
+
+def test_awaiting_does_not_block_the_event_loop():
+    executor = GPUExecutor()
+
+    async def main():
+        ticks = 0
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        beat = asyncio.create_task(heartbeat())
+        await executor.run(time.sleep, 0.3)
+        beat.cancel()
+        return ticks
+
+    assert asyncio.run(main()) >= 10
+
+
+def test_failed_and_cancelled_jobs_are_counted_once_and_not_timed():
+    from cancellation import JobCancelled
+
+    executor = GPUExecutor()
+    executor.submit(time.sleep, 0.1).result(5)
+    seconds_per_job = executor.seconds_per_job
+
+    def fail():
+        raise RuntimeError("CUDA error")
+
+    def cancelled():
+        raise JobCancelled("cancelled")
+
+    for job in (fail, cancelled):
+        with pytest.raises(RuntimeError):
+            executor.submit(job).result(5)
+
+    # Futures resolve just before the GPU thread records them
+    while executor.metrics()["running"]:
+        time.sleep(0.01)
+    metrics = executor.metrics()
+    assert (metrics["completed"], metrics["failed"], metrics["cancelled"]) == (1, 1, 1)
+    assert executor.seconds_per_job == seconds_per_job
@@ -0,0 +1,180 @@
+import asyncio
+import io
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from image_fetch import ImageFetchError, ImageFetcher  # noqa: E402
+
+
+def png(color, size=(40, 30)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class Source(BaseHTTPRequestHandler):
+    """Serves /image.png with an ETag (answering If-None-Match with 304), plus misbehaving paths."""
+
+    etag = '"v1"'
+    body = png("red")
+    gets = []
+
+    def do_GET(self):
+        Source.gets.append(self.path)
+        if self.path == "/image.png":
+            if self.headers.get("If-None-Match") == Source.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.reply(Source.body, {"ETag": Source.etag})
+        elif self.path == "/no-etag.png":
+            self.reply(Source.body)
+        elif self.path == "/slow.png":
+            time.sleep(1)
+            self.reply(Source.body)
+        elif self.path == "/text":
+            self.reply(b"not an image")
+        elif self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "http://169.254.169.254/latest/meta-data/")
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def reply(self, body, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # The local source is on loopback, which fetchers otherwise refuse
+    monkeypatch.setenv("IMAGE_FETCH_ALLOW_PRIVATE", "1")
+    Source.etag, Source.body, Source.gets = '"v1"', png("red"), []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Source)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def test_unchanged_image_is_revalidated_not_downloaded(server):
+    fetcher = ImageFetcher()
+    first = asyncio.run(fetcher.fetch(f"{server}/image.png"))
+    assert first.image.size == (40, 30) and first.image.getpixel((0, 0)) == (255, 0, 0)
+    assert first.key == (f"{server}/image.png", '"v1"') and not first.cached
+
+    again = fetcher.fetch_sync(f"{server}/image.png")
+    assert again.cached and again.image is first.image and again.key == first.key
+    assert fetcher.stats()["downloads"] == 1 and fetcher.stats()["revalidated"] == 1
+
+    # A new version behind the same URL is downloaded again, under a new key
+    Source.etag, Source.body = '"v2"', png("blue")
+    changed = fetcher.fetch_sync(f"{server}/image.png")
+    assert not changed.cached and changed.key[1] == '"v2"' and changed.image.getpixel((0, 0)) == (0, 0, 255)
+    assert len(Source.gets) == 3
+
+
+def test_images_without_etag_are_keyed_by_content_and_not_kept(server):
+    fetcher = ImageFetcher()
+    first = fetcher.fetch_sync(f"{server}/no-etag.png")
+    second = fetcher.fetch_sync(f"{server}/no-etag.png")
+    assert first.key == second.key and first.key[0] == "sha256"
+    assert fetcher.stats()["downloads"] == 2 and fetcher.stats()["cache"]["entries"] == 0
+
+
+def test_concurrent_fetches_share_the_session(server):
+    fetcher = ImageFetcher()
+
+    async def fetch_all():
+        return await asyncio.gather(*(fetcher.fetch(f"{server}/no-etag.png") for _ in range(8)))
+
+    assert len(asyncio.run(fetch_all())) == 8
+    assert fetcher.stats()["downloads"] == 8
+
+
+@pytest.mark.parametrize("path, options, message", [
+    ("/missing.png", {}, "HTTP 404"),
+    ("/image.png", {"max_bytes": 10}, "larger than"),
+    ("/image.png", {"max_pixels": 100}, "larger than 100 pixels"),
+    ("/slow.png", {"timeout": 0.2}, "Timed out"),
+    ("/text", {}, "not a readable image"),
+])
+def test_bad_sources_raise_image_fetch_error(server, path, options, message):
+    with pytest.raises(ImageFetchError, match=message):
+        ImageFetcher(**options).fetch_sync(f"{server}{path}")
+
+
+def test_only_http_urls_are_fetched():
+    with pytest.raises(ImageFetchError):
+        ImageFetcher().fetch_sync("file:///etc/passwd")
+
+
+def test_internal_addresses_are_refused(server, monkeypatch):
+    import image_fetch
+
+    port = server.rsplit(":", 1)[1]
+    fetcher = ImageFetcher(allow_private=False)
+    for url, message in (
+        ("http://169.254.169.254/latest/meta-data/", "non-public address"),
+        (f"{server}/image.png", "non-public address"),
+        (f"http://[::ffff:127.0.0.1]:{port}/image.png", "non-public address"),
+        (f"http://localhost:{port}/image.png", "does not resolve to a public address"),
+    ):
+        with pytest.raises(ImageFetchError, match=message):
+            fetcher.fetch_sync(url)
+    assert Source.gets == []
+
+    # A permitted source can't redirect the fetcher to one that isn't
+    monkeypatch.setattr(image_fetch, "public_address", lambda host: host == "127.0.0.1")
+    with pytest.raises(ImageFetchError, match="non-public address"):
+        fetcher.fetch_sync(f"{server}/redirect")
+    assert Source.gets == ["/redirect"]
+
+
+def test_flux_img2img_encodes_each_input_image_once(monkeypatch):
+    import torch
+    from diffusers import AutoencoderTiny
+
+    import txt2img_flux_dev
+    from decode import Decoder
+    from image_fetch import FetchedImage
+    from step_cache import StepCache
+    from tiny_flux import tiny_flux_pipeline
+
+    generator = txt2img_flux_dev.FluxDevGenerator()
+    generator.pipe = tiny_flux_pipeline()
+    generator.tiny_vae = AutoencoderTiny(
+        latent_channels=1, encoder_block_out_channels=(4, 4, 4, 4), decoder_block_out_channels=(4, 4, 4, 4),
+    )
+    generator.decoder = Decoder(generator.pipe.vae, generator.tiny_vae, generator.pipe.image_processor)
+    generator.step_cache = StepCache(generator.pipe.transformer)
+    generator.initialized = True
+    uploads = []
+    monkeypatch.setattr(txt2img_flux_dev, "submit_image", lambda image, *args, **kwargs: uploads.append(image))
+    encodes = []
+    generator.pipe.vae.encoder.register_forward_hook(lambda *args: encodes.append(1))
+
+    source = FetchedImage(Image.new("RGB", (40, 40), "red"), ("http://images/cat.png", '"v1"'), cached=False)
+    options = {"prompt": "w1", "height": 32, "width": 32, "num_inference_steps": 4, "seed": 1, "strength": 0.5}
+    generator.generate(options, image=source)
+    generator.generate(options, image=source)
+
+    assert len(encodes) == 1 and generator.latent_cache.stats()["hits"] == 1
+    assert [image.size for image in uploads] == [(32, 32), (32, 32)]
+    assert generator.cache_key(options, image=source) != generator.cache_key(options)
+    assert torch.is_tensor(generator.latent_cache.get((source.key, 32, 32)))
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxPipeline, FluxTransformer2DModel  # noqa: E402
+from transformers import AutoTokenizer, CLIPTextModel, T5EncoderModel  # noqa: E402
+
+from loader import ReadinessGate, load_components, weight_files  # noqa: E402
+from tiny_flux import tiny_flux_pipeline  # noqa: E402
+
+
+def test_modules_load_one_at_a_time_alongside_light_loaders(tmp_path):
+    active, peak = [0], [0]
+    lock = threading.Lock()
+    module_running = threading.Event()
+
+    def module(value):
+        def load():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            module_running.set()
+            time.sleep(0.1)
+            with lock:
+                active[0] -= 1
+            return value
+        return load
+
+    # Only finishes if it runs while a module is loading
+    def tokenizer():
+        assert module_running.wait(5)
+        return "tokenizer"
+
+    weights = tmp_path / "model.safetensors"
+    weights.write_bytes(os.urandom(2**20))
+    components, timings = load_components(
+        {"a": module("A"), "b": module("B"), "c": module("C")},
+        light={"tokenizer": tokenizer},
+        prefetch=[str(weights)],
+    )
+    assert components == {"a": "A", "b": "B", "c": "C", "tokenizer": "tokenizer"}
+    assert peak[0] == 1
+    assert set(timings) == {"a", "b", "c", "tokenizer", "prefetch model.safetensors"}
+    assert all(timings[name] >= 0.1 for name in "abc")
+
+
+def test_tiny_flux_loads_per_component(tmp_path):
+    tiny_flux_pipeline().save_pretrained(tmp_path)
+    path = str(tmp_path)
+    components, _ = load_components(
+        {
+            "transformer": lambda: FluxTransformer2DModel.from_pretrained(path, subfolder="transformer", torch_dtype=torch.bfloat16),
+            "text_encoder_2": lambda: T5EncoderModel.from_pretrained(path, subfolder="text_encoder_2", torch_dtype=torch.bfloat16),
+            "text_encoder": lambda: CLIPTextModel.from_pretrained(path, subfolder="text_encoder", torch_dtype=torch.bfloat16),
+            "vae": lambda: AutoencoderKL.from_pretrained(path, subfolder="vae", torch_dtype=torch.bfloat16),
+        },
+        light={
+            "tokenizer": lambda: AutoTokenizer.from_pretrained(path, subfolder="tokenizer"),
+            "tokenizer_2": lambda: AutoTokenizer.from_pretrained(path, subfolder="tokenizer_2"),
+            "scheduler": lambda: FlowMatchEulerDiscreteScheduler.from_pretrained(path, subfolder="scheduler"),
+        },
+        prefetch=weight_files(*(os.path.join(path, name) for name in ("transformer", "text_encoder_2", "text_encoder", "vae"))),
+    )
+    pipe = FluxPipeline(**components)
+    reference = FluxPipeline.from_pretrained(path, torch_dtype=torch.bfloat16)
+    for name in ("transformer", "text_encoder_2", "text_encoder", "vae"):
+        loaded, expected = getattr(pipe, name).state_dict(), getattr(reference, name).state_dict()
+        assert loaded.keys() == expected.keys()
+        assert all(torch.equal(loaded[key], expected[key]) for key in expected)
+    # Loading must not leak the libraries' temporary patches
+    assert torch.get_default_dtype() == torch.float32
+    assert torch.nn.Linear(2, 2).weight.device.type == "cpu"
+
+
+def test_readiness_gate_holds_jobs_until_startup_finishes():
+    release = threading.Event()
+    gate = ReadinessGate().start(lambda: release.wait(5))
+    modifier = gate.concurrency_modifier(lambda current: 3)
+    assert modifier(1) == 0 and not gate.ready
+
+    async def job():
+        await gate.wait()
+        return "ran"
+
+    async def main():
+        task = asyncio.create_task(job())
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        release.set()
+        return await task
+
+    assert asyncio.run(main()) == "ran"
+    assert gate.ready and modifier(1) == 3 and gate.seconds is not None
+
+
+def test_readiness_gate_fails_jobs_when_startup_fails():
+    def startup():
+        raise OSError("weights missing")
+
+    gate = ReadinessGate().start(startup)
+    with pytest.raises(RuntimeError, match="weights missing"):
+        asyncio.run(gate.wait())
+    assert not gate.ready
+    assert gate.concurrency_modifier(lambda current: 2)(1) == 2
@@ -0,0 +1,128 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+
+from placement import (  # noqa: E402
+    GB, MIXED, MODEL_OFFLOAD, RESIDENT, SEQUENTIAL_OFFLOAD, PlacementPlan, apply_plan, component_sizes, plan_placement,
+)
+
+# FLUX.1 in bf16
+FLUX = {"text_encoder": 0.25 * GB, "text_encoder_2": 9.5 * GB, "transformer": 23.8 * GB, "vae": 0.2 * GB}
+PRIORITY = ("transformer", "vae", "text_encoder", "text_encoder_2")
+
+
+def plan(device_gb, working_gb=4, **kwargs):
+    return plan_placement(FLUX, device_gb * GB, working_gb * GB, priority=PRIORITY, denoiser="transformer", **kwargs)
+
+
+def test_everything_resident_on_a_large_card():
+    p = plan(80)
+    assert p.strategy == RESIDENT
+    assert sorted(p.resident) == sorted(FLUX) and p.transfer_bytes == 0
+
+
+def test_keeps_transformer_resident_and_offloads_text_encoders():
+    p = plan(37.5)
+    assert p.strategy == MIXED
+    assert p.resident == ["transformer", "vae"]
+    assert p.offloaded == ["text_encoder", "text_encoder_2"]
+    assert p.transfer_bytes == FLUX["text_encoder"] + FLUX["text_encoder_2"]
+    assert p.offload_peak_bytes == FLUX["text_encoder_2"]
+
+
+def test_keeps_small_components_when_the_transformer_must_move():
+    p = plan(32)
+    assert p.strategy == MIXED
+    assert p.resident == ["vae", "text_encoder"]
+    assert p.offloaded == ["transformer", "text_encoder_2"]
+
+
+def test_model_offload_when_only_one_component_fits_at_a_time():
+    p = plan(27.9)
+    assert p.strategy == MODEL_OFFLOAD
+    assert p.resident == []
+    assert p.transfer_bytes == sum(FLUX.values())
+
+
+def test_sequential_offload_when_the_transformer_does_not_fit():
+    p = plan(24, steps=30)
+    assert p.strategy == SEQUENTIAL_OFFLOAD
+    assert p.transfer_bytes == sum(FLUX.values()) + 29 * FLUX["transformer"]
+
+
+def test_pinned_components_stay_resident():
+    p = plan(27.9, pinned=("text_encoder_2",))
+    assert "text_encoder_2" in p.resident and "text_encoder_2" not in p.offloaded
+
+
+def test_forced_strategy(monkeypatch):
+    monkeypatch.setenv("PLACEMENT_STRATEGY", MODEL_OFFLOAD)
+    assert plan(80).strategy == MODEL_OFFLOAD
+    monkeypatch.setenv("PLACEMENT_STRATEGY", "everywhere")
+    with pytest.raises(ValueError):
+        plan(80)
+
+
+def test_describe_reports_transfer_per_request():
+    assert "~9.8 GB host-to-device per request" in plan(37.5).describe()
+
+
+def test_apply_mixed_plan_installs_offload_hooks():
+    from tiny_flux import tiny_flux_pipeline
+
+    pipe = tiny_flux_pipeline()
+    sizes = component_sizes(pipe)
+    assert set(sizes) == {"text_encoder", "text_encoder_2", "transformer", "vae"}
+    mixed = PlacementPlan(MIXED, ["transformer", "vae"], ["text_encoder", "text_encoder_2"], 0, 0, 0)
+    apply_plan(pipe, mixed, device="cpu")
+
+    from accelerate.hooks import CpuOffload
+
+    assert isinstance(pipe.text_encoder_2._hf_hook, CpuOffload)
+    assert not isinstance(getattr(pipe.transformer, "_hf_hook", None), CpuOffload)
+    embeds, pooled, _ = pipe.encode_prompt("w1 w2", None, max_sequence_length=16)
+    pipe(prompt_embeds=embeds, pooled_prompt_embeds=pooled, height=32, width=32, num_inference_steps=1)
+    assert pipe._execution_device == torch.device("cpu")
+
+
+def test_extra_modules_are_planned_and_placed_with_the_pipeline():
+    from tiny_flux import tiny_flux_pipeline
+
+    pipe = tiny_flux_pipeline()
+    refiner = torch.nn.Linear(4, 4)
+    sizes = component_sizes(pipe, extra={"refiner": refiner})
+    assert sizes["refiner"] == 80 and "transformer" in sizes
+    mixed = PlacementPlan(MIXED, ["vae"], ["text_encoder", "text_encoder_2", "transformer", "refiner"], 0, 0, 0)
+    apply_plan(pipe, mixed, device="cpu", extra={"refiner": refiner}, after="transformer")
+    # The refiner runs after the transformer, so loading it offloads the transformer
+    assert refiner._hf_hook.prev_module_hook.model is pipe.transformer
+
+
+def test_offloaded_components_are_back_on_the_cpu_after_a_call(monkeypatch):
+    from accelerate.hooks import CpuOffload
+    from tiny_flux import tiny_flux_pipeline
+
+    # No second device here: CpuOffload as accelerate implements it, moving a virtual location instead of the weights
+    where = {}
+
+    def pre_forward(self, module, *args, **kwargs):
+        if self.prev_module_hook is not None and where.get(self.prev_module_hook.model) == "device":
+            self.prev_module_hook.offload()
+        where[module] = "device"
+        return args, kwargs
+
+    monkeypatch.setattr(CpuOffload, "init_hook", lambda self, module: where.update({module: "cpu"}) or module)
+    monkeypatch.setattr(CpuOffload, "pre_forward", pre_forward)
+    pipe = tiny_flux_pipeline()
+    # The 32 GB plan: the small encoder and the VAE resident, T5 and the transformer offloaded
+    mixed = PlacementPlan(MIXED, ["text_encoder", "vae"], ["text_encoder_2", "transformer"], 0, 0, 0)
+    apply_plan(pipe, mixed, device="cpu")
+
+    for _ in range(2):
+        pipe(prompt="w1 w2", height=32, width=32, num_inference_steps=2, max_sequence_length=16)
+        assert where == {pipe.text_encoder_2: "cpu", pipe.transformer: "cpu"}
+    assert pipe.text_encoder_2._hf_hook.prev_module_hook.model is pipe.transformer
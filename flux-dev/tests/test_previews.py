@@ -0,0 +1,62 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+
+from diffusers import AutoencoderTiny  # noqa: E402
+
+from previews import PreviewStream, preview_callback, preview_settings, tiny_vae_preview  # noqa: E402
+
+
+def tiny_vae():
+    torch.manual_seed(0)
+    return AutoencoderTiny(
+        latent_channels=16, encoder_block_out_channels=(4, 4, 4, 4), decoder_block_out_channels=(4, 4, 4, 4),
+    )
+
+
+def test_tiny_vae_preview_is_bounded_by_max_size():
+    image = tiny_vae_preview(tiny_vae(), torch.randn(1, 16, 64, 96), max_size=128)
+    assert image.mode == "RGB"
+    assert image.size == (128, 88)
+
+
+def test_callback_emits_every_n_steps_but_not_the_last():
+    previews = []
+    vae = tiny_vae()
+    callback = preview_callback(lambda pipe, latents: tiny_vae_preview(vae, latents, 64), 10, 3, previews.append)
+    for i in range(10):
+        assert callback(None, i, None, {"latents": torch.randn(1, 16, 8, 8)}) == {}
+
+    assert [p["step"] for p in previews] == [3, 6, 9]
+    assert all(p["total_steps"] == 10 for p in previews)
+    assert previews[0]["preview"].startswith("data:image/jpeg;base64,")
+
+
+def test_preview_settings_validation():
+    assert preview_settings({}, default_every=5) == (5, 256)
+    assert preview_settings({"preview_every": 0, "preview_size": 64}, default_every=5) == (0, 64)
+    with pytest.raises(ValueError):
+        preview_settings({"preview_every": -1}, default_every=5)
+    with pytest.raises(ValueError):
+        preview_settings({"preview_size": 4096}, default_every=5)
+
+
+def test_preview_stream_yields_previews_then_result():
+    def job(on_preview):
+        for step in range(3):
+            on_preview({"step": step})
+        return {"image_url": "https://cdn/x.png"}
+
+    async def consume():
+        stream = PreviewStream(lambda on_preview: asyncio.to_thread(job, on_preview))
+        items = [preview async for preview in stream]
+        return items, await stream.result()
+
+    items, result = asyncio.run(consume())
+    assert items == [{"step": 0}, {"step": 1}, {"step": 2}]
+    assert result == {"image_url": "https://cdn/x.png"}
@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import torch  # noqa: E402
+
+from prompt_cache import PromptCache  # noqa: E402
+
+
+def tensors(kb):
+    return (torch.zeros(kb * 256), torch.zeros(0))  # kb KiB of float32
+
+
+def test_lru_bounded_by_bytes():
+    cache = PromptCache(max_bytes=3 * 1024)
+    for prompt in ("a", "b", "c"):
+        cache.get_or_encode(PromptCache.key("flux", prompt), lambda: tensors(1))
+    cache.get_or_encode(PromptCache.key("flux", "a"), lambda: tensors(1))  # a is now most recently used
+    cache.get_or_encode(PromptCache.key("flux", "d"), lambda: tensors(1))  # evicts b
+
+    calls = []
+    cache.get_or_encode(PromptCache.key("flux", "b"), lambda: calls.append("b") or tensors(1))
+    assert calls == ["b"]
+    stats = cache.stats()
+    assert stats["bytes"] == 3 * 1024 and stats["entries"] == 3
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 5, 2)
+    assert stats["hit_rate"] == round(1 / 6, 3)
+
+
+def test_key_normalizes_whitespace_but_not_model_or_options():
+    assert PromptCache.key("flux", " a  cat ", 512) == PromptCache.key("flux", "a cat", 512)
+    assert PromptCache.key("flux", "a cat", 512) != PromptCache.key("flux", "a cat", 256)
+    assert PromptCache.key("flux", "a cat") != PromptCache.key("sd3", "a cat")
+
+
+def test_flux_generator_encodes_each_prompt_once():
+    from tiny_flux import tiny_flux_pipeline
+    from txt2img_flux_dev import FluxDevGenerator
+
+    generator = FluxDevGenerator()
+    generator.pipe = tiny_flux_pipeline()
+    generator.initialized = True
+    calls = []
+    generator.pipe.text_encoder_2.register_forward_hook(lambda *args: calls.append(1))
+
+    first = generator.encode_prompt("w1 w2  w3", 64)
+    again = generator.encode_prompt("w1 w2 w3", 64)
+    direct = generator.pipe.encode_prompt("w1 w2 w3", None, max_sequence_length=64)
+
+    assert len(calls) == 2  # one cached encode plus the direct call
+    assert torch.equal(first[0], again[0])
+    assert torch.allclose(first[0], direct[0]) and torch.allclose(first[1], direct[1])
@@ -0,0 +1,86 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+
+from residency import ModelResidency  # noqa: E402
+
+MB = 2**20
+
+
+def linear(mb):
+    """fp32 Linear with `mb` MB of weights."""
+    return torch.nn.Linear(mb * MB // 4 // 256, 256, bias=False)
+
+
+class FakeGenerator:
+    def __init__(self, load):
+        self.load = load
+        self.loads = 0
+        self.initialized = False
+        self._modules = None
+
+    def initialize(self):
+        self._modules = self.load()
+        self.loads += 1
+        self.initialized = True
+
+    def modules(self):
+        return self._modules
+
+    def unload(self):
+        self._modules = None
+        self.initialized = False
+
+
+def test_least_recently_used_model_is_evicted_and_shared_modules_count_once(monkeypatch):
+    monkeypatch.delenv("RESIDENCY_BUDGET_GB", raising=False)
+    encoder = linear(4)
+    generators = {
+        "a": FakeGenerator(lambda: {"transformer": linear(8), "text_encoder": encoder}),
+        "b": FakeGenerator(lambda: {"transformer": linear(8), "text_encoder": encoder}),
+        "c": FakeGenerator(lambda: {"transformer": linear(8)}),
+    }
+    residency = ModelResidency(generators, budget_bytes=21 * MB, device="cpu")
+
+    residency.acquire("a")
+    residency.acquire("b")
+    # The shared encoder is counted once: 8 + 8 + 4 MB fit in 21
+    assert residency.resident() == ["a", "b"]
+    assert residency.resident_bytes() == 20 * MB
+    residency.acquire("a")
+    assert residency.resident() == ["b", "a"]
+
+    residency.acquire("c")
+    assert residency.resident() == ["a", "c"]
+    stats = residency.stats()
+    assert (stats["hits"], stats["misses"], stats["loads"], stats["evictions"]) == (1, 3, 3, 1)
+    assert stats["hit_rate"] == 0.25 and stats["swap_in_ms_max"] >= 0
+
+    # Offloaded to host memory: swapping back in doesn't load again
+    residency.acquire("b")
+    assert generators["b"].loads == 1
+
+
+def test_disk_offload_unloads_and_reloads(monkeypatch):
+    monkeypatch.delenv("RESIDENCY_BUDGET_GB", raising=False)
+    generators = {name: FakeGenerator(lambda: {"transformer": linear(8)}) for name in ("a", "b")}
+    residency = ModelResidency(generators, budget_bytes=10 * MB, device="cpu", offload="disk")
+    residency.acquire("a")
+    residency.acquire("b")
+    assert not generators["a"].initialized and residency.resident() == ["b"]
+    residency.acquire("a")
+    assert generators["a"].loads == 2 and residency.stats()["loads"] == 3
+
+
+def test_model_larger_than_the_budget_is_refused(monkeypatch):
+    monkeypatch.setenv("RESIDENCY_BUDGET_GB", str(4 / 1024))
+    residency = ModelResidency({"a": FakeGenerator(lambda: {"transformer": linear(8)})}, budget_bytes=None, device="cpu")
+    assert residency.budget_bytes == 4 * MB
+    with pytest.raises(RuntimeError):
+        residency.acquire("a")
+    with pytest.raises(ValueError):
+        ModelResidency({}, budget_bytes=MB, offload="swap")
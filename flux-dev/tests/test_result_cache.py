@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from botocore.exceptions import ClientError  # noqa: E402
+
+import result_cache  # noqa: E402
+from result_cache import ResultCache, cache_key  # noqa: E402
+
+
+def test_key_ignores_order_and_prompt_whitespace():
+    a = cache_key("flux", {"prompt": result_cache.normalize_prompt(" a  cat "), "seed": 1, "width": 512})
+    b = cache_key("flux", {"width": 512, "seed": 1, "prompt": result_cache.normalize_prompt("a cat")})
+    assert a == b
+    assert a != cache_key("flux", {"width": 512, "seed": 2, "prompt": "a cat"})
+    assert a != cache_key("sdxl", {"width": 512, "seed": 1, "prompt": "a cat"})
+
+
+def test_hit_miss_and_lru_eviction(tmp_path):
+    cache = ResultCache(path=str(tmp_path / "cache.sqlite3"), max_entries=2, verify=False)
+    cache.put("a", ["https://cdn/a.png"])
+    cache.put("b", ["https://cdn/b.png"])
+    assert cache.get("a") == ["https://cdn/a.png"]  # a is now most recently used
+    cache.put("c", ["https://cdn/c.png"])  # evicts b
+
+    assert cache.get("b") is None
+    assert cache.get("c") == ["https://cdn/c.png"]
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 1, "entries": 2}
+
+
+def test_expired_entries_miss(tmp_path):
+    cache = ResultCache(path=str(tmp_path / "cache.sqlite3"), ttl_seconds=0.000001, verify=False)
+    cache.put("a", ["https://cdn/a.png"])
+    assert cache.get("a") is None
+
+
+def test_verify_drops_entries_missing_from_r2(tmp_path, monkeypatch):
+    class HeadStub:
+        def head_object(self, Bucket, Key):
+            if Key != "a.png":
+                raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+
+    monkeypatch.setenv("PUBLIC_URL", "https://cdn")
+    monkeypatch.setattr(result_cache, "get_r2_client", lambda: HeadStub())
+    cache = ResultCache(path=str(tmp_path / "cache.sqlite3"), verify=True)
+    cache.put("a", ["https://cdn/a.png"])
+    cache.put("b", ["https://cdn/b.png"])
+
+    assert cache.get("a") == ["https://cdn/a.png"]
+    assert cache.get("b") is None
+    assert cache.stats()["entries"] == 1
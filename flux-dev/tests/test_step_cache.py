@@ -0,0 +1,101 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+
+from step_cache import StepCache, step_cache_threshold  # noqa: E402
+from tiny_flux import tiny_flux_pipeline  # noqa: E402
+
+
+def count_block_runs(transformer):
+    """Counter of attention calls, which only happen when the blocks really run."""
+    calls = []
+    for block in list(transformer.transformer_blocks) + list(transformer.single_transformer_blocks):
+        block.attn.register_forward_hook(lambda *args: calls.append(1))
+    return calls
+
+
+def generate(pipe, steps=8):
+    return pipe(
+        prompt="w1 w2 w3", height=32, width=32, num_inference_steps=steps, guidance_scale=0.0,
+        generator=torch.Generator("cpu").manual_seed(0), output_type="latent",
+    ).images
+
+
+@torch.no_grad()
+def test_unchanged_input_reuses_the_cached_residual_exactly():
+    transformer = tiny_flux_pipeline(transformer_layers=2).transformer
+    calls = count_block_runs(transformer)
+    inputs = {
+        "hidden_states": torch.randn(1, 16, 4),
+        "encoder_hidden_states": torch.randn(1, 8, 32),
+        "pooled_projections": torch.randn(1, 32),
+        "timestep": torch.tensor([0.5]),
+        "img_ids": torch.zeros(16, 3),
+        "txt_ids": torch.zeros(8, 3),
+    }
+    reference = transformer(**inputs).sample
+    calls.clear()
+
+    cache = StepCache(transformer)
+    with cache.run(threshold=0.1, steps=3) as run:
+        outputs = [transformer(**inputs).sample for _ in range(3)]
+
+    # The middle step is served from the cache; the first and last always run the 4 blocks
+    assert run.stats() == {"threshold": 0.1, "steps": 3, "skipped": 1}
+    assert len(calls) == 8
+    for output in outputs:
+        torch.testing.assert_close(output, reference)
+
+
+def test_zero_threshold_leaves_the_model_untouched():
+    pipe = tiny_flux_pipeline()
+    reference = generate(pipe)
+    block = pipe.transformer.transformer_blocks[0]
+    # Stands in for an offload hook's forward, which must survive the run
+    block.forward = hook = block.forward
+
+    cache = StepCache(pipe.transformer)
+    with cache.run(0.0, 8) as run:
+        assert block.forward is hook
+        torch.testing.assert_close(generate(pipe), reference, rtol=0, atol=0)
+    assert run.skipped == 0 and cache.stats()["runs"] == 0
+
+    with cache.run(100.0, 8):
+        assert block.forward is not hook
+    assert block.forward is hook
+    assert "forward" not in pipe.transformer.single_transformer_blocks[0].__dict__
+
+
+def test_higher_thresholds_skip_more_steps():
+    pipe = tiny_flux_pipeline()
+    calls = count_block_runs(pipe.transformer)
+    reference = generate(pipe)
+    cache = StepCache(pipe.transformer)
+
+    skipped = []
+    for threshold in (0.01, 0.2, 100.0):
+        calls.clear()
+        with cache.run(threshold, 8) as run:
+            latents = generate(pipe)
+        skipped.append(run.skipped)
+        assert len(calls) == 2 * (8 - run.skipped)
+        assert torch.isfinite(latents).all()
+
+    assert skipped == sorted(skipped) and skipped[-1] == 6
+    assert not torch.equal(latents, reference)
+    assert cache.stats() == {"runs": 3, "steps": 24, "skipped": sum(skipped), "skip_rate": round(sum(skipped) / 24, 3)}
+
+
+def test_step_cache_input_is_validated(monkeypatch):
+    monkeypatch.delenv("STEP_CACHE_THRESHOLD", raising=False)
+    assert step_cache_threshold({}) == 0.0
+    assert step_cache_threshold({"step_cache": 0.25}) == 0.25
+    monkeypatch.setenv("STEP_CACHE_THRESHOLD", "0.4")
+    assert step_cache_threshold({}) == 0.4
+    for value in (-0.1, "fast", True):
+        with pytest.raises(ValueError):
+            step_cache_threshold({"step_cache": value})
@@ -0,0 +1,64 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+
+from torch_compile import CompileCache, compile_with_warmup  # noqa: E402
+
+
+class TinyDenoiser(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.net = torch.nn.Sequential(torch.nn.Linear(16, 64), torch.nn.GELU(), torch.nn.Linear(64, 16))
+
+    def forward(self, x):
+        return self.net(x)
+
+
+def make_warm(module):
+    def warm(width, height, steps):
+        x = torch.randn(width * height // 64, 16)
+        with torch.no_grad():
+            for _ in range(steps):
+                x = module(x)
+    return warm
+
+
+@pytest.fixture
+def fresh_dynamo():
+    torch._dynamo.reset()
+    torch.compiler.reset()
+    yield
+    torch._dynamo.reset()
+
+
+def test_compile_reports_and_reuses_persistent_cache(tmp_path, fresh_dynamo, monkeypatch):
+    monkeypatch.setenv("TORCH_COMPILE_DYNAMIC", "0")
+    buckets = [(64, 64, 2), (64, 32, 2)]
+    cache_dir = str(tmp_path / "compile-cache")
+
+    module = TinyDenoiser().eval()
+    report = compile_with_warmup(module, make_warm(module), buckets, cache=CompileCache(cache_dir))
+    assert set(report["buckets"]) == set(buckets)
+    assert report["fx_graph_misses"] >= 2
+    assert report["speedup"] > 0
+    assert os.path.exists(os.path.join(cache_dir, "cache_artifacts.bin"))
+
+    # A "cold start": new dynamo state and module, same cache directory
+    torch._dynamo.reset()
+    before = CompileCache.stats()
+    module = TinyDenoiser().eval()
+    report = compile_with_warmup(module, make_warm(module), buckets, cache=CompileCache(cache_dir))
+    assert report["loaded_artifacts"]
+    assert report["fx_graph_hits"] - before["fx_graph_hits"] >= 2
+
+
+def test_invalid_dynamic_setting(monkeypatch):
+    from torch_compile import compile_module
+
+    monkeypatch.setenv("TORCH_COMPILE_DYNAMIC", "sometimes")
+    with pytest.raises(ValueError):
+        compile_module(TinyDenoiser())
@@ -0,0 +1,178 @@
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import uploader  # noqa: E402
+
+
+class FlakyS3Stub:
+    """put_object fails `failures` times (alternating read timeouts and 503s), then succeeds."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Key, Body, **kwargs):
+        with self.lock:
+            self.calls += 1
+            if self.calls <= self.failures:
+                if self.calls % 2:
+                    raise ReadTimeoutError(endpoint_url="http://r2.local")
+                raise ClientError({"Error": {"Code": "503", "Message": "Slow Down"}}, "PutObject")
+            self.objects[Key] = Body.read() if hasattr(Body, "read") else bytes(Body)
+
+
+@pytest.fixture
+def flaky(monkeypatch, tmp_path):
+    def install(failures):
+        stub = FlakyS3Stub(failures)
+        monkeypatch.setattr(uploader, "_client", stub)
+        spool = uploader.UploadSpool(directory=str(tmp_path), base_delay=0.01, max_delay=0.05)
+        monkeypatch.setattr(uploader, "spool", spool)
+        return stub, spool
+
+    monkeypatch.setenv("PUBLIC_URL", "https://cdn.example.com")
+    yield install
+    uploader.spool.stop()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_failed_upload_is_spooled_and_retried(flaky):
+    stub, spool = flaky(failures=4)
+
+    url, uploaded = uploader.upload_or_spool(Image.new("RGB", (8, 8), "red"), "gen-images/a.png", "png")
+
+    assert url == "https://cdn.example.com/gen-images/a.png"
+    assert not uploaded
+    assert wait_for(lambda: spool.retried == 1)
+    assert Image.open(io.BytesIO(stub.objects["gen-images/a.png"])).getpixel((0, 0)) == (255, 0, 0)
+    assert spool.pending() == 0
+
+
+def test_spooled_uploads_survive_a_restart(flaky, tmp_path):
+    stub, spool = flaky(failures=1000)
+    uploader.upload_or_spool(Image.new("RGB", (8, 8)), "b.webp", "webp", quality=50)
+    spool.stop()
+    assert spool.pending() == 1
+
+    # A new worker process starts on the same spool directory with R2 healthy again
+    stub.failures = 0
+    restarted = uploader.UploadSpool(directory=str(tmp_path), base_delay=0.01)
+    restarted.start()
+
+    assert wait_for(lambda: restarted.pending() == 0)
+    restarted.stop()
+    assert Image.open(io.BytesIO(stub.objects["b.webp"])).format == "WEBP"
+
+
+def test_backoff_grows_with_attempts(flaky, monkeypatch):
+    stub, spool = flaky(failures=1000)
+    spool.base_delay, spool.max_delay = 10, 10_000
+    monkeypatch.setattr(spool, "start", lambda: None)  # drive retries by hand
+    uploader.upload_or_spool(Image.new("RGB", (8, 8)), "c.png", "png")
+
+    [name] = [name for name in os.listdir(spool.directory) if name.endswith(".json")]
+    path = os.path.join(spool.directory, name)
+    for attempt in range(1, 5):
+        record = json.load(open(path))
+        record["next_attempt"] = 0
+        spool._write_record(name[:-len(".json")], record)
+        before = time.time()
+        spool.retry_due()
+        record = json.load(open(path))
+        assert record["attempts"] == attempt
+        # full jitter: anywhere between now and base * 2^attempt
+        assert before <= record["next_attempt"] <= time.time() + 10 * 2 ** attempt
+
+
+def test_background_queue_spools_instead_of_dropping(flaky):
+    stub, spool = flaky(failures=3)
+    queue = uploader.UploadQueue(workers=2)
+    for i in range(3):
+        queue.submit(Image.new("RGB", (8, 8)), f"{i}.png", "png")
+    queue.shutdown()
+
+    assert queue.failed == 0 and queue.uploaded + queue.spooled == 3
+    assert wait_for(lambda: len(stub.objects) == 3)
+
+
+def test_only_confirmed_uploads_are_reported(flaky, monkeypatch):
+    stub, spool = flaky(failures=1)
+    monkeypatch.setattr(spool, "start", lambda: None)
+    queue = uploader.UploadQueue(workers=1)
+    reported = []
+    for i in range(2):
+        queue.submit(Image.new("RGB", (8, 8)), f"{i}.png", "png", on_uploaded=reported.append)
+    queue.shutdown()
+
+    # The first upload failed and was spooled: its URL must not be cached yet
+    assert (queue.spooled, queue.uploaded) == (1, 1)
+    assert reported == [uploader.public_url("1.png")]
+
+
+def test_workers_sharing_a_spool_upload_each_entry_once(flaky, tmp_path, monkeypatch):
+    stub, _ = flaky(failures=0)
+    first, second = (uploader.UploadSpool(directory=str(tmp_path), base_delay=0.01) for _ in range(2))
+    for worker in (first, second):
+        monkeypatch.setattr(worker, "start", lambda: None)  # drive retries by hand
+    for i in range(5):
+        first.add(Image.new("RGB", (8, 8)), f"{i}.png", "png")
+
+    # The second worker listed the spool, then the first uploaded everything in it
+    listing = os.listdir(tmp_path)
+    first.retry_due()
+    with monkeypatch.context() as patch:
+        patch.setattr(uploader.os, "listdir", lambda directory: listing)
+        second.retry_due()
+
+    assert stub.calls == 5 and (first.retried, second.retried) == (5, 0)
+    assert os.listdir(tmp_path) == []
+
+
+def test_claims_of_a_dead_worker_are_released(flaky, tmp_path, monkeypatch):
+    stub, spool = flaky(failures=0)
+    monkeypatch.setattr(spool, "start", lambda: None)
+    spool.add(Image.new("RGB", (8, 8)), "d.png", "png")
+    [name] = [n for n in os.listdir(tmp_path) if n.endswith(".json")]
+    entry_id = name[:-len(".json")]
+    os.rename(tmp_path / name, tmp_path / f"{entry_id}.{int(time.time()) - 3600}.dead-worker.claim")
+
+    spool.retry_due()  # releases the stale claim
+    spool.retry_due()
+    assert spool.retried == 1 and "d.png" in stub.objects and spool.pending() == 0
+
+
+def test_retry_thread_survives_a_failed_pass(flaky, monkeypatch):
+    stub, spool = flaky(failures=0)
+    retry_due, passes = spool.retry_due, []
+
+    def failing_once():
+        passes.append(1)
+        if len(passes) == 1:
+            raise OSError("Stale file handle")
+        return retry_due()
+
+    monkeypatch.setattr(spool, "retry_due", failing_once)
+    spool.add(Image.new("RGB", (8, 8)), "e.png", "png")
+    assert wait_for(lambda: passes)
+    spool._wake.set()
+    assert wait_for(lambda: spool.retried == 1) and "e.png" in stub.objects
@@ -0,0 +1,149 @@
+import io
+import os
+import sys
+import threading
+import time
+
+import boto3
+import numpy as np
+import pytest
+from moto import mock_aws
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import uploader  # noqa: E402
+
+
+class RecordingS3Stub:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Key, Body, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.objects[Key] = bytes(Body)
+
+
+def noise_image(width, height):
+    """Random pixels barely compress, so the PNG is as large as it gets."""
+    pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+@pytest.fixture
+def r2(monkeypatch):
+    """Local moto S3 standing in for R2, with a fresh shared client."""
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("R2_BUCKET_NAME", "test-bucket")
+    monkeypatch.setenv("PUBLIC_URL", "https://cdn.example.com")
+    with mock_aws():
+        uploader.reset_r2_client()
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="test-bucket")
+        yield s3
+    uploader.reset_r2_client()
+
+
+def test_background_upload_returns_url_before_upload(monkeypatch):
+    monkeypatch.setenv("PUBLIC_URL", "https://cdn.example.com")
+    stub = RecordingS3Stub(latency=0.2)
+    monkeypatch.setattr(uploader, "_client", stub)
+    queue = uploader.UploadQueue(workers=1, max_pending=4)
+
+    url = queue.submit(Image.new("RGB", (8, 8)), "gen-images/a.png", "png")
+
+    assert url == "https://cdn.example.com/gen-images/a.png"
+    assert "gen-images/a.png" not in stub.objects
+    queue.shutdown()
+    assert stub.objects["gen-images/a.png"].startswith(b"\x89PNG")
+
+
+def test_shutdown_flushes_every_accepted_image(monkeypatch):
+    stub = RecordingS3Stub(latency=0.01)
+    monkeypatch.setattr(uploader, "_client", stub)
+    queue = uploader.UploadQueue(workers=3, max_pending=2)
+
+    for i in range(20):
+        queue.submit(Image.new("RGB", (8, 8)), f"{i}.png", "png")
+    queue.shutdown()
+
+    assert len(stub.objects) == 20
+    assert queue.uploaded == 20 and queue.failed == 0
+
+
+def test_small_image_is_a_single_put(r2):
+    image = noise_image(64, 64)
+    expected = io.BytesIO()
+    image.save(expected, format="PNG")
+
+    url = uploader.upload_image(image, "small.png", "png")
+
+    assert url == "https://cdn.example.com/small.png"
+    stored = r2.get_object(Bucket="test-bucket", Key="small.png")
+    assert stored["ContentType"] == "image/png"
+    assert stored["Body"].read() == expected.getvalue()
+
+
+def test_large_image_streams_as_multipart(r2, monkeypatch):
+    monkeypatch.setenv("R2_MULTIPART_THRESHOLD", str(5 * 1024 * 1024))
+    monkeypatch.setenv("R2_MULTIPART_PART_SIZE", str(5 * 1024 * 1024))
+    image = noise_image(2048, 1536)  # ~9 MB of PNG -> two parts
+    expected = io.BytesIO()
+    image.save(expected, format="PNG")
+
+    uploader.upload_image(image, "large.png", "png")
+
+    head = r2.head_object(Bucket="test-bucket", Key="large.png", PartNumber=1)
+    assert head["PartsCount"] == 2
+    stored = r2.get_object(Bucket="test-bucket", Key="large.png")["Body"].read()
+    assert stored == expected.getvalue()
+
+
+def test_failed_encode_aborts_multipart(r2, monkeypatch):
+    monkeypatch.setenv("R2_MULTIPART_THRESHOLD", "1")
+    stream = uploader.StreamingUpload("broken.png", "image/png")
+    stream.write(b"x" * 16)
+    stream.abort()
+
+    assert r2.list_multipart_uploads(Bucket="test-bucket").get("Uploads", []) == []
+
+
+def test_image_options_validation():
+    assert uploader.image_options({"image_format": "webp", "quality": 80}) == {
+        "quality": 80, "compress_level": None, "lossless": False,
+    }
+    for bad in ({"image_format": "gif"}, {"quality": 0}, {"quality": "80"}, {"compress_level": 10}):
+        with pytest.raises(ValueError):
+            uploader.image_options(bad)
+
+
+@pytest.mark.parametrize("img_format,options,content_type", [
+    ("webp", {"quality": 70}, "image/webp"),
+    ("webp", {"lossless": True}, "image/webp"),
+    ("jpg", {"quality": 90}, "image/jpeg"),
+    ("png", {"compress_level": 1}, "image/png"),
+])
+def test_upload_image_formats(r2, img_format, options, content_type):
+    image = noise_image(64, 48)
+    uploader.upload_image(image, f"out.{img_format}", img_format, **options)
+
+    stored = r2.get_object(Bucket="test-bucket", Key=f"out.{img_format}")
+    assert stored["ContentType"] == content_type
+    decoded = Image.open(io.BytesIO(stored["Body"].read()))
+    assert decoded.size == (64, 48)
+    if options.get("lossless"):
+        assert np.array_equal(np.asarray(decoded.convert("RGB")), np.asarray(image))
+
+
+def test_upload_images_keeps_order(r2):
+    images = [Image.new("RGB", (16, 16), color) for color in ("red", "green", "blue")]
+    urls, uploaded = uploader.upload_images(images, ["0.png", "1.png", "2.png"], "png")
+
+    assert uploaded
+    assert urls == [f"https://cdn.example.com/{i}.png" for i in range(3)]
+    for i, color in enumerate([(255, 0, 0), (0, 128, 0), (0, 0, 255)]):
+        body = r2.get_object(Bucket="test-bucket", Key=f"{i}.png")["Body"].read()
+        assert Image.open(io.BytesIO(body)).getpixel((0, 0)) == color
@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+
+from warmup import parse_buckets, run_warmup, snap_size, warmup_buckets  # noqa: E402
+
+BUCKETS = [(1024, 1024, 4), (1360, 768, 4)]
+
+
+def test_parse_buckets():
+    assert parse_buckets("1024x1024x4, 1360X768", default_steps=2) == [(1024, 1024, 4), (1360, 768, 2)]
+    assert parse_buckets("", default_steps=2) == []
+    with pytest.raises(ValueError):
+        parse_buckets("1024", default_steps=2)
+    with pytest.raises(ValueError):
+        parse_buckets("1024x0", default_steps=2)
+
+
+def test_warmup_can_be_disabled(monkeypatch):
+    monkeypatch.setenv("WARMUP", "0")
+    assert warmup_buckets(default="1024x1024") == []
+
+
+def test_snap_only_when_enabled_and_close(monkeypatch):
+    assert snap_size(1000, 1000, BUCKETS) == (1000, 1000)
+    monkeypatch.setenv("WARMUP_SNAP", "1")
+    assert snap_size(1000, 1000, BUCKETS) == (1024, 1024)
+    assert snap_size(1344, 768, BUCKETS) == (1360, 768)
+    assert snap_size(512, 512, BUCKETS) == (512, 512)  # too far from any bucket
+    assert snap_size(1024, 768, BUCKETS, tolerance=0.1) == (1024, 768)
+
+
+def test_run_warmup_times_each_bucket_after_setup():
+    calls = []
+    timings = run_warmup(lambda *bucket: calls.append(bucket), BUCKETS, setup=lambda: calls.append("setup"))
+    assert calls == ["setup", (1024, 1024, 4), (1360, 768, 4)]
+    assert set(timings) == set(BUCKETS)
+
+
+def test_generator_warmup_runs_pipeline_without_uploading(monkeypatch):
+    import txt2img_flux_dev
+    from tiny_flux import tiny_flux_pipeline
+
+    monkeypatch.setattr(txt2img_flux_dev, "submit_image", lambda *args, **kwargs: pytest.fail("uploaded"))
+    generator = txt2img_flux_dev.FluxDevGenerator()
+    generator.pipe = tiny_flux_pipeline()
+    generator.initialized = True
+    run_warmup(generator.warmup, [(32, 32, 2), (48, 32, 1)])
+    assert generator.prompt_cache.stats()["hits"] == 1
@@ -0,0 +1,58 @@
+"""
+Randomly initialized, CPU-sized Flux pipeline for offline tests and benchmarks.
+
+Same component layout as FLUX.1 (CLIP + T5 text encoders, Flux transformer,
+AutoencoderKL) but with a few thousand parameters and word-level tokenizers
+built in memory, so nothing is downloaded.
+"""
+import torch
+from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxPipeline, FluxTransformer2DModel
+from tokenizers import Tokenizer, models, normalizers, pre_tokenizers
+from transformers import CLIPTextConfig, CLIPTextModel, PreTrainedTokenizerFast, T5Config, T5EncoderModel
+
+VOCAB_SIZE = 1000
+
+
+def word_tokenizer(max_length):
+    """Lowercasing whitespace tokenizer over the vocabulary w0 ... w996."""
+    words = ["<pad>", "<unk>", "</s>"] + [f"w{i}" for i in range(VOCAB_SIZE - 3)]
+    tokenizer = Tokenizer(models.WordLevel({word: i for i, word in enumerate(words)}, unk_token="<unk>"))
+    tokenizer.normalizer = normalizers.Lowercase()
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", unk_token="<unk>", eos_token="</s>", model_max_length=max_length,
+    )
+
+
+def tiny_flux_pipeline(t5_dim=32, t5_layers=2, transformer_layers=1, seed=0):
+    torch.manual_seed(seed)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=VOCAB_SIZE, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, max_position_embeddings=77, projection_dim=32, bos_token_id=2, eos_token_id=2,
+    ))
+    text_encoder_2 = T5EncoderModel(T5Config(
+        vocab_size=VOCAB_SIZE, d_model=t5_dim, d_kv=t5_dim // 4, d_ff=t5_dim * 2, num_layers=t5_layers, num_heads=4,
+    ))
+    transformer = FluxTransformer2DModel(
+        patch_size=1, in_channels=4, num_layers=transformer_layers, num_single_layers=transformer_layers,
+        attention_head_dim=16, num_attention_heads=2, joint_attention_dim=t5_dim, pooled_projection_dim=32,
+        axes_dims_rope=[4, 4, 8],
+    )
+    vae = AutoencoderKL(
+        sample_size=32, in_channels=3, out_channels=3, block_out_channels=(4,), layers_per_block=1,
+        latent_channels=1, norm_num_groups=1, use_quant_conv=False, use_post_quant_conv=False,
+        shift_factor=0.0609, scaling_factor=1.5035,
+    )
+    pipe = FluxPipeline(
+        scheduler=FlowMatchEulerDiscreteScheduler(),
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=word_tokenizer(77),
+        text_encoder_2=text_encoder_2,
+        tokenizer_2=word_tokenizer(512),
+        transformer=transformer,
+    )
+    for component in (text_encoder, text_encoder_2, transformer, vae):
+        component.eval()
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
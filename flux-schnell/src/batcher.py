@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+
+from cancellation import CancelGroup, JobCancelled
+from gpu_executor import GPUExecutor, Job
+
+
+def vram_budget_gb(reserved_gb=0.0):
+    """GPU memory (GB) available for batch activations once the model is loaded.
+
+    BATCH_VRAM_BUDGET_GB overrides the measurement; otherwise it is the free
+    device memory minus BATCH_VRAM_MARGIN_GB (default 2) and reserved_gb, for
+    weights that are offloaded now but move onto the GPU during a call. 0
+    without CUDA.
+    """
+    if os.getenv("BATCH_VRAM_BUDGET_GB"):
+        return float(os.getenv("BATCH_VRAM_BUDGET_GB"))
+    if not torch.cuda.is_available():
+        return 0.0
+    free, _ = torch.cuda.mem_get_info()
+    return max(0.0, free / 2**30 - reserved_gb - float(os.getenv("BATCH_VRAM_MARGIN_GB", "2")))
+
+
+
+def batch_limit(budget_gb, gb_per_megapixel, height, width, max_size=None):
+    """How many images of height x width fit into budget_gb at once, between 1 and max_size."""
+    max_size = max_size or int(os.getenv("BATCH_MAX_SIZE", "4"))
+    per_image = gb_per_megapixel * height * width / 1e6
+    return max(1, min(max_size, int(budget_gb // per_image)))
+
+
+class DenoiseError(RuntimeError):
+    """A batch's pipeline call failed, e.g. out of memory at this batch size.
+
+    Only this failure makes the Batcher run the batch's requests again one at
+    a time; anything raised after denoising fails them without regenerating.
+    """
+
+
+@contextmanager
+def denoising():
+    """Re-raises a failure of the pipeline call in the block as DenoiseError; cancellation passes through."""
+    try:
+        yield
+    except JobCancelled:
+        raise
+    except Exception as e:
+        raise DenoiseError(str(e)) from e
+
+
+class _Request(Job):
+    __slots__ = ("key", "input_data", "on_preview", "cancel", "on_uploaded")
+
+    def __init__(self, key, input_data, on_preview, cancel=None, on_uploaded=None):
+        super().__init__()
+        self.key = key
+        self.input_data = input_data
+        self.on_preview = on_preview
+        self.cancel = cancel
+        self.on_uploaded = on_uploaded
+
+
+class Batcher(GPUExecutor):
+    """Collects requests that arrive within a short window and runs compatible ones as one batch.
+
+    key(input_data) decides which requests may share a pipeline call and
+    limit(key) caps how many do; a group is dispatched as soon as it reaches
+    its limit or its oldest request has waited window_ms. run_batch(inputs,
+    on_preview=None) returns one result per input and runs on the executor's
+    GPU thread, so the GPU sees one batch at a time. Requests that stream
+    previews always run alone. When every request carries a CancelToken,
+    run_batch also gets cancel=, a CancelGroup that is cancelled once all
+    of the batch's requests are. When any request has an on_uploaded
+    callback, run_batch gets on_uploaded=, one callback (or None) per input.
+    run_batch may return an exception in place of one request's result (e.g.
+    JobCancelled for a request cancelled while its batch ran) to fail only
+    that request. If a batch's pipeline call raises DenoiseError (see
+    denoising()), its requests are retried one at a time, so an OOM at this
+    size or one bad request doesn't fail its neighbours.
+    """
+
+    def __init__(self, run_batch, key, limit, window_ms=None, **executor_options):
+        super().__init__(**executor_options)
+        self.run_batch = run_batch
+        self.key = key
+        self.limit = limit
+        self.window = (window_ms if window_ms is not None else float(os.getenv("BATCH_WINDOW_MS", "50"))) / 1000
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, input_data, on_preview=None, cancel=None, on_uploaded=None):
+        """Queue one request; returns a concurrent Future for its result."""
+        key = self.key(input_data) if on_preview is None else None
+        return self._admit(_Request(key, input_data, on_preview, cancel, on_uploaded))
+
+    async def run(self, input_data, on_preview=None, cancel=None, on_uploaded=None):
+        return await asyncio.wrap_future(self.submit(input_data, on_preview, cancel, on_uploaded))
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            first = self._pending[0]
+            if first.on_preview is not None:
+                return [self._pending.pop(0)]
+            limit = max(1, self.limit(first.key))
+            deadline = first.arrival + self.window
+            while True:
+                group = [p for p in self._pending if p.key == first.key]
+                remaining = deadline - time.monotonic()
+                if len(group) >= limit or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = group[:limit]
+            self._pending = [p for p in self._pending if p not in batch]
+            self.batches += 1
+            self.items += len(batch)
+            return batch
+
+    def _execute(self, batch):
+        options = {}
+        if all(p.cancel is not None for p in batch):
+            options["cancel"] = CancelGroup(p.cancel for p in batch)
+        if any(p.on_uploaded is not None for p in batch):
+            options["on_uploaded"] = [p.on_uploaded for p in batch]
+        results = self.run_batch([p.input_data for p in batch], on_preview=batch[0].on_preview, **options)
+        for pending, result in zip(batch, results):
+            if isinstance(result, Exception):
+                pending.future.set_exception(result)
+            else:
+                pending.future.set_result(result)
+
+    def _fail(self, batch, error):
+        if len(batch) == 1 or not isinstance(error, DenoiseError):
+            return super()._fail(batch, error)
+        print(f"Batch of {len(batch)} failed ({error}), retrying one at a time")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        for job in batch:
+            if job.future.done():
+                continue
+            try:
+                self._execute([job])
+            except Exception as single_error:
+                job.future.set_exception(single_error)
@@ -0,0 +1,149 @@
+import math
+import os
+import time
+
+import torch
+
+DECODE_QUALITIES = ("fast", "full")
+
+FULL = "full"
+SLICED = "sliced"
+TILED = "tiled"
+DECODE_STRATEGIES = (FULL, SLICED, TILED)
+
+GB = 2**30
+# Below this, per-tile GroupNorm statistics drift far enough apart to show seams
+MIN_TILE = 512
+# Fraction of a tile blended with its neighbours
+TILE_OVERLAP = 0.25
+# Starting estimates of peak decode memory, replaced by measurements once available
+GB_PER_MEGAPIXEL = {"full": 3.0, "fast": 0.5}
+
+
+def decode_quality(input_data, default):
+    """"fast" decodes with the tiny autoencoder, "full" with the pipeline's VAE."""
+    quality = input_data.get("decode_quality", default)
+    if quality not in DECODE_QUALITIES:
+        raise ValueError("Invalid decode_quality. Must be fast or full.")
+    return quality
+
+
+def free_decode_bytes():
+    """CUDA memory a decode can use: free device memory plus what PyTorch has cached but not allocated."""
+    if not torch.cuda.is_available():
+        return None
+    free, _ = torch.cuda.mem_get_info()
+    return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+
+def plan_decode(batch, height, width, gb_per_megapixel, free_bytes):
+    """(strategy, tile size in pixels) that keeps a decode of `batch` images within `free_bytes`.
+
+    Decodes the whole batch at once when it fits, one image at a time
+    (sliced) when one image fits, and otherwise in the largest tiles that fit
+    (tiled, which also slices). Large tiles keep seams invisible, so tiles
+    never go below MIN_TILE. DECODE_STRATEGY forces a strategy and
+    DECODE_TILE a tile size; DECODE_MARGIN_GB (default 1) is kept free.
+    """
+    strategy = os.getenv("DECODE_STRATEGY") or None
+    if strategy is not None and strategy not in DECODE_STRATEGIES:
+        raise ValueError(f"Invalid decode strategy {strategy!r}. Must be one of {', '.join(DECODE_STRATEGIES)}.")
+    budget_gb = None if free_bytes is None else free_bytes / GB - float(os.getenv("DECODE_MARGIN_GB", "1"))
+    per_image_gb = gb_per_megapixel * height * width / 1e6
+    if strategy is None:
+        if budget_gb is None or per_image_gb * batch <= budget_gb:
+            strategy = FULL
+        elif per_image_gb <= budget_gb:
+            strategy = SLICED
+        else:
+            strategy = TILED
+    if strategy != TILED:
+        return strategy, None
+    if os.getenv("DECODE_TILE"):
+        return strategy, int(os.getenv("DECODE_TILE"))
+    tile = max(height, width)
+    if budget_gb is not None:
+        tile = min(tile, math.sqrt(max(budget_gb, 0.0) / gb_per_megapixel * 1e6))
+    return strategy, max(MIN_TILE, int(tile) // 64 * 64)
+
+
+def apply_decode_plan(vae, strategy, tile=None):
+    """Set up an AutoencoderKL or AutoencoderTiny for the planned strategy (its decode() reads these flags)."""
+    vae.use_slicing = strategy in (SLICED, TILED)
+    vae.use_tiling = strategy == TILED
+    if strategy == TILED:
+        scale = vae.tile_sample_min_size // vae.tile_latent_min_size
+        vae.tile_sample_min_size = tile
+        vae.tile_latent_min_size = tile // scale
+        vae.tile_overlap_factor = TILE_OVERLAP
+
+
+class Decoder:
+    """Turns (B, C, h, w) transformer-space latents into PIL images with the full VAE or a tiny autoencoder.
+
+    The tiny autoencoder must be trained for the same latent space (taef1 for
+    Flux, taesd3 for SD3); both are given the latents un-scaled and un-shifted
+    with their own config, like the pipelines do. Latency and peak CUDA
+    memory of each decode are recorded per quality.
+
+    Each decode is planned by plan_decode() from the image size, batch and
+    free memory. The memory per megapixel starts from GB_PER_MEGAPIXEL and
+    follows the largest ratio measured on whole-batch decodes.
+    """
+
+    def __init__(self, full_vae, tiny_vae, image_processor, gb_per_megapixel=None):
+        self.vaes = {"full": full_vae, "fast": tiny_vae}
+        self.image_processor = image_processor
+        self.gb_per_megapixel = dict(gb_per_megapixel or GB_PER_MEGAPIXEL)
+        self._measured = {}
+        self._stats = {
+            quality: {"decodes": 0, "ms": 0.0, "peak_mb": 0.0, "strategies": {}} for quality in DECODE_QUALITIES
+        }
+
+    def estimate(self, quality):
+        """GB of decode memory per megapixel of output: measured (plus 10%) once possible, else the default."""
+        if quality in self._measured:
+            return self._measured[quality] * 1.1
+        return self.gb_per_megapixel[quality]
+
+    @torch.no_grad()
+    def decode(self, latents, quality):
+        vae = self.vaes[quality]
+        latents = latents / vae.config.scaling_factor + (getattr(vae.config, "shift_factor", None) or 0.0)
+        scale = vae.tile_sample_min_size // vae.tile_latent_min_size
+        batch, height, width = latents.shape[0], latents.shape[-2] * scale, latents.shape[-1] * scale
+        strategy, tile = plan_decode(batch, height, width, self.estimate(quality), free_decode_bytes())
+        apply_decode_plan(vae, strategy, tile)
+        cuda = latents.is_cuda
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            baseline = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        # Offloaded VAEs are moved in by their hook; decode() is hooked like forward()
+        images = vae.decode(latents.to(dtype=vae.dtype), return_dict=False)[0]
+        if cuda:
+            torch.cuda.synchronize()
+        stats = self._stats[quality]
+        stats["decodes"] += 1
+        stats["ms"] += (time.perf_counter() - start) * 1000
+        stats["strategies"][strategy] = stats["strategies"].get(strategy, 0) + 1
+        if cuda:
+            peak = torch.cuda.max_memory_allocated() - baseline
+            stats["peak_mb"] = max(stats["peak_mb"], peak / 2**20)
+            if strategy == FULL:
+                ratio = peak / GB / (batch * height * width / 1e6)
+                self._measured[quality] = max(self._measured.get(quality, 0.0), ratio)
+        return self.image_processor.postprocess(images, output_type="pil")
+
+    def stats(self):
+        """Mean ms per decode and the largest extra CUDA memory a decode needed, per quality used so far."""
+        return {
+            quality: {
+                "decodes": s["decodes"],
+                "mean_ms": round(s["ms"] / s["decodes"], 1),
+                "peak_mb": round(s["peak_mb"], 1),
+                "strategies": dict(s["strategies"]),
+            }
+            for quality, s in self._stats.items() if s["decodes"]
+        }
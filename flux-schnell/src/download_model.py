@@ -1,12 +1,42 @@
 import torch
-from diffusers import FluxPipeline, AutoencoderTiny
+from diffusers import FluxPipeline, FluxTransformer2DModel, AutoencoderTiny
 import os
 from huggingface_hub import hf_hub_download
+from safetensors import safe_open
 
 # Path where models will be saved
 model_base_path = os.environ.get("MODEL_BASE_PATH", "/models")
 os.makedirs(model_base_path, exist_ok=True)
 
+
+def convert_transformer(single_file, config, target):
+    """Convert the fp8 single-file transformer to bf16 diffusers shards under `target`.
+
+    The shards are checked to hold every weight of the converted model; then
+    the single file, which nothing reads at runtime, is deleted
+    unless KEEP_FP8_SOURCE=1.
+    """
+    transformer = FluxTransformer2DModel.from_single_file(
+        single_file,
+        config=config,
+        subfolder="transformer",
+        torch_dtype=torch.bfloat16,
+    )
+    transformer.save_pretrained(target, max_shard_size="2GB")
+    expected = set(transformer.state_dict())
+    del transformer
+    saved = set()
+    for name in os.listdir(target):
+        if name.endswith(".safetensors"):
+            with safe_open(os.path.join(target, name), "pt") as shard:
+                saved.update(shard.keys())
+    if saved != expected:
+        raise RuntimeError(f"Converted transformer in {target} is missing {len(expected - saved)} weights")
+    if os.environ.get("KEEP_FP8_SOURCE", "0") != "1":
+        print(f"Removing {single_file}, converted to {target}")
+        os.remove(single_file)
+
+
 print("Downloading flux model and components...")
 
 # Download SD3 pipeline
@@ -16,8 +46,8 @@ pipeline =  FluxPipeline.from_pretrained(
     torch_dtype=torch.bfloat16,   
 )
 
-# Download tiny autoencoder
-tiny_vae = AutoencoderTiny.from_pretrained('madebyollin/taesd3', torch_dtype=torch.float16)
+# Download the tiny autoencoder trained on Flux's latent space (taesd3 is SD3's)
+tiny_vae = AutoencoderTiny.from_pretrained('madebyollin/taef1', torch_dtype=torch.bfloat16)
 
 #Download fp8 versuion of the tranformer
 print("Downloading fp8 version of the transformer...")
@@ -30,7 +60,7 @@ print(f"Transformer downloaded to {transformer_path}")
 
 # Save models to local directory
 flux_path = os.path.join(model_base_path, "flux-schnell")
-vae_path = os.path.join(model_base_path, "taesd3")
+vae_path = os.path.join(model_base_path, "taef1")
 
 print(f"Saving flux pipeline to {flux_path}...")
 pipeline.save_pretrained(flux_path)
@@ -38,4 +68,12 @@ pipeline.save_pretrained(flux_path)
 print(f"Saving tiny autoencoder to {vae_path}...")
 tiny_vae.save_pretrained(vae_path)
 
+# Convert the single-file transformer once here rather than at every cold start:
+# the original key layout is mapped to diffusers' and upcast to bf16, then saved
+# as safetensors shards that load without conversion, copies or casts
+del pipeline  # the conversion holds a second copy of the weights in RAM
+converted_path = os.path.join(model_base_path, "fp8_transformer", "flux1-schnell-fp8-e4m3fn-diffusers")
+print(f"Converting the fp8 transformer to {converted_path}...")
+convert_transformer(transformer_path, flux_path, converted_path)
+
 print("Models successfully downloaded and saved")
\ No newline at end of file
@@ -0,0 +1,54 @@
+import os
+
+
+def early_exit_tolerance(input_data):
+    """The `early_exit` input: change of the predicted image under which denoising stops, 0 = off."""
+    tolerance = input_data.get("early_exit", float(os.getenv("EARLY_EXIT_TOLERANCE", "0")))
+    if isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or tolerance < 0:
+        raise ValueError("Invalid early_exit. Must be a non-negative number.")
+    return float(tolerance)
+
+
+class EarlyExit:
+    """callback_on_step_end that stops a flow-matching pipeline once its prediction has converged.
+
+    After each step the velocity the scheduler just applied is recovered from
+    the latents of consecutive steps, giving the clean latents it points at
+    (x - sigma * v). Once that prediction changes by less than `tolerance`
+    (mean relative L1, the largest over the batch) between steps, the
+    latents jump straight to it, the same Euler step to sigma 0 the
+    remaining steps would take if the velocity held, and the pipeline is
+    interrupted. The requested steps stay the upper bound; steps_used is
+    how many ran.
+    """
+
+    def __init__(self, tolerance, steps):
+        self.tolerance = tolerance
+        self.steps = steps
+        self.steps_used = steps
+        self.changes = []
+        self._latents = None
+        self._prediction = None
+
+    def __call__(self, pipe, i, t, callback_kwargs):
+        latents = callback_kwargs["latents"]
+        previous, self._latents = self._latents, latents.float()
+        if previous is None or i + 1 >= self.steps:
+            return {}
+        sigma, sigma_next = pipe.scheduler.sigmas[i].item(), pipe.scheduler.sigmas[i + 1].item()
+        velocity = (self._latents - previous) / (sigma_next - sigma)
+        prediction = self._latents - sigma_next * velocity
+        last, self._prediction = self._prediction, prediction
+        if last is None:
+            return {}
+        dims = tuple(range(1, prediction.ndim))
+        change = ((prediction - last).abs().mean(dims) / last.abs().mean(dims).clamp_min(1e-8)).max().item()
+        self.changes.append(round(change, 5))
+        if change < self.tolerance:
+            self.steps_used = i + 1
+            pipe._interrupt = True
+            return {"latents": prediction.to(latents.dtype)}
+        return {}
+
+    def stats(self):
+        return {"tolerance": self.tolerance, "steps": self.steps_used, "max_steps": self.steps, "changes": self.changes}
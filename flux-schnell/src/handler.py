@@ -1,40 +1,116 @@
+import os
 import runpod
-from txt2img_flux_schnell import FluxSchnellGenerator
+from txt2img_flux_schnell import DEFAULTS, FluxSchnellGenerator
+from uploader import image_options
 from utils import calculate_cost
+from result_cache import ResultCache
+from previews import PreviewStream, preview_settings
+from decode import decode_quality
+from batcher import Batcher
+from warmup import run_warmup, snap_size, warmup_buckets
+from torch_compile import compile_enabled, compile_with_warmup
+from loader import ReadinessGate
+from step_cache import step_cache_threshold
+from early_exit import early_exit_tolerance
+from cancellation import CANCELLED, CancelToken, CancelWatcher, JobCancelled, job_deadline
 
+
+result_cache = ResultCache()
+# (width, height, steps) sizes generated once at startup so their kernels are primed
+warm_buckets = warmup_buckets(default="1360x768x2,1024x1024x2")
 flux = FluxSchnellGenerator()
+# Compatible requests arriving within BATCH_WINDOW_MS share one pipeline call on the GPU thread
+batcher = Batcher(flux.generate_batch, key=flux.batch_key, limit=lambda key: flux.max_batch_size(key[0], key[1]))
+# Cancels the token of a running job once it is cancelled upstream (CANCEL_POLL_SECONDS)
+watcher = CancelWatcher()
 
-# Import our SD3Generator class
-async def handler(job):
+def validate(job):
     job_input = job.get("input")
     if not job_input:
         raise ValueError("No input provided")
-    image_format = job_input.get("image_format", "png")
-    if image_format not in ["png", "jpeg", "jpg"]:
-        raise ValueError("Invalid image format. Supported formats are 'png' and 'jpg'.")
-    
-    mime_type = "image/jpeg" if image_format in ["jpeg", "jpg"] else "image/png"
-    
+    image_options(job_input)
+    decode_quality(job_input, default="full")
+    step_cache_threshold(job_input)
+    early_exit_tolerance(job_input)
+    job_deadline(job_input)
+    if "width" in job_input and "height" in job_input:
+        job_input["width"], job_input["height"] = snap_size(job_input["width"], job_input["height"], warm_buckets)
+    preview_settings(job_input, default_every=1)
+    return job_input
+
+async def run_job(job_input, on_preview=None, job_id=None):
+    token = CancelToken(job_deadline(job_input))
     try:
-        img_url = flux.generate(job_input)
+        await gate.wait()
+        # Seeded requests are deterministic: reuse the URL of an identical earlier job
+        key = flux.cache_key(job_input) if result_cache.enabled else None
+        cached_urls = result_cache.get(key) if key else None
+        steps = skipped_steps = None
+        if cached_urls:
+            img_url = cached_urls[0]
+        else:
+            # Stops at the next denoising step once the job is cancelled or past its deadline.
+            # The URL is cached once its upload is confirmed, not when it's queued
+            on_uploaded = (lambda url: result_cache.put(key, [url])) if key else None
+            with watcher.watch(job_id, token):
+                img_url, steps, skipped_steps = await token.guard(
+                    batcher.run(job_input, on_preview=on_preview, cancel=token, on_uploaded=on_uploaded)
+                )
+            print(f"GPU queue: {batcher.metrics()}")
+        if key:
+            print(f"Result cache: {result_cache.stats()}")
         return {
             "image_url": img_url,
+            "cached": bool(cached_urls),
+            # Denoising steps run (fewer than requested after an early exit); None when the result cache answered
+            "steps": steps,
             "cost": calculate_cost(
-                job_input["width"], job_input["height"]
+                job_input["width"], job_input["height"],
+                steps=steps, max_steps=job_input.get("num_inference_steps", DEFAULTS["num_inference_steps"]),
             ),
+            # Denoising steps served from the step cache; None when the result cache answered
+            "skipped_steps": skipped_steps,
             # "image": base64_img,
             # "data_url": f"data:{mime_type};base64,{base64_img}",
         }
+    except JobCancelled as e:
+        return {
+            "status": CANCELLED,
+            "message": str(e),
+        }
     except RuntimeError as e:
         return {
             "status": "error",
             "message": str(e),
         }
 
+async def handler(job):
+    return await run_job(validate(job), job_id=job.get("id"))
+
+async def stream_handler(job):
+    """Yields low-resolution previews while denoising, then the final result."""
+    job_input = validate(job)
+    stream = PreviewStream(lambda on_preview: run_job(job_input, on_preview, job_id=job.get("id")))
+    async for preview in stream:
+        yield preview
+    yield await stream.result()
+
+def startup():
+    """Load the model and warm up; with TORCH_COMPILE=1 warmup also compiles each bucket."""
+    flux.initialize()
+    if compile_enabled():
+        compile_with_warmup(flux.pipe.transformer, flux.warmup, warm_buckets)
+    else:
+        run_warmup(flux.warmup, warm_buckets)
+
+# Starts loading at process start; no job is pulled until it's done
+gate = ReadinessGate().start(startup)
+
 runpod.serverless.start(
     {
-        "handler": handler,
-        "concurrency_modifier": lambda x: 500,
+        # Generator handlers change /run output to the list of yielded items, so opt in
+        "handler": stream_handler if os.getenv("PREVIEW_STREAMING", "0") == "1" else handler,
+        "concurrency_modifier": gate.concurrency_modifier(batcher.concurrency_modifier),
         "return_aggregate_stream": True,
     }
-)
\ No newline at end of file
+)
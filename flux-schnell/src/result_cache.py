@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from uploader import get_r2_client
+
+
+def cache_key(model_id, params):
+    """Canonical hash of the model identity and the normalized generation parameters."""
+    canonical = json.dumps({"model": model_id, **params}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def normalize_prompt(prompt):
+    return " ".join((prompt or "").split())
+
+
+class ResultCache:
+    """Local LRU index from a request hash to the public URLs it already produced.
+
+    Only deterministic requests (a client-supplied seed) are worth caching.
+    Entries expire before the 24 h R2 object expiry, and with
+    RESULT_CACHE_VERIFY=1 a hit is confirmed with a HEAD on the object first.
+    """
+
+    def __init__(self, path=None, max_entries=None, ttl_seconds=None, verify=None):
+        self.path = path or os.getenv('RESULT_CACHE_PATH', '/tmp/result_cache.sqlite3')
+        self.max_entries = max_entries or int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '10000'))
+        self.ttl_seconds = ttl_seconds or float(os.getenv('RESULT_CACHE_TTL_HOURS', '23')) * 3600
+        self.verify = verify if verify is not None else os.getenv('RESULT_CACHE_VERIFY', '0') == '1'
+        self.enabled = os.getenv('RESULT_CACHE', '1') == '1'
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, urls TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def get(self, key):
+        """Return the cached list of URLs for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT urls, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                row = None
+        urls = json.loads(row[0]) if row is not None else None
+        if urls is not None and self.verify and not all(self._exists(url) for url in urls):
+            with self._lock:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            urls = None
+        with self._lock:
+            if urls is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+        return urls
+
+    def put(self, key, urls):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, urls, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(urls), now, now),
+            )
+            overflow = self._count() - self.max_entries
+            if overflow > 0:
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": self._count(),
+            }
+
+    def _count(self):
+        return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def _exists(self, url):
+        filename = url[len(f"{os.getenv('PUBLIC_URL')}/"):]
+        try:
+            get_r2_client().head_object(Bucket=os.getenv('R2_BUCKET_NAME'), Key=filename)
+            return True
+        except ClientError:
+            return False
@@ -1,17 +1,54 @@
 import torch
 import base64
 import io
-from diffusers import FluxPipeline, FluxTransformer2DModel
+import os
+from diffusers import AutoencoderKL, AutoencoderTiny, FlowMatchEulerDiscreteScheduler, FluxPipeline, FluxTransformer2DModel
+from transformers import CLIPTextModel, CLIPTokenizer, T5EncoderModel, T5TokenizerFast
 from PIL import Image
-from utils import upload_to_r2
+from uploader import image_options, submit_image
+from result_cache import cache_key, normalize_prompt
+from prompt_cache import PromptCache
+from placement import GB, place_pipeline
+from loader import load_components, weight_files
+from previews import chain_callbacks, preview_callback, preview_settings, tiny_vae_preview
+from decode import Decoder, decode_quality
+from early_exit import EarlyExit, early_exit_tolerance
+from cancellation import CancelGroup, CancelToken, JobCancelled, release_on_cancel
+from step_cache import FLUX_COEFFICIENTS, StepCache, step_cache_threshold
+from batcher import batch_limit, denoising, vram_budget_gb
 import uuid
 from datetime import datetime, timedelta
 from nanoid import generate
 
+DEFAULTS = {
+    "prompt": "A photo of a dog and a cat",
+    "negative_prompt": "",
+    "height": 768,
+    "width": 1360,
+    "num_inference_steps": 4,  # Default for schnell is lower
+    "guidance_scale": 0.0,  # Default for schnell is 0
+    "max_sequence_length": 256,  # Schnell-specific
+    "image_format": "png",
+    "decode_quality": "full",
+}
+
 class FluxSchnellGenerator:
+    MODEL_ID = "black-forest-labs/FLUX.1-schnell:flux1-schnell-fp8-e4m3fn"
+    # Activation headroom at the default resolution, GB
+    WORKING_GB = 6
+    # Rough activation + VAE decode memory per megapixel of batch, bf16
+    GB_PER_MEGAPIXEL = 1.5
+
     def __init__(self):
         self.pipe = None
         self.initialized = False
+        self.placement = None
+        self.load_timings = {}
+        self.tiny_vae = None
+        self.decoder = None
+        self.step_cache = None
+        self.prompt_cache = PromptCache()
+        self.batch_budget_gb = 0.0
     
     def initialize(self):
         """Initialize the Flux-schnell model with optimizations for both memory and speed."""
@@ -21,73 +58,252 @@ class FluxSchnellGenerator:
         # Model path
         flux_model_path = "/models/flux-schnell"
         fp8_transformer_path = "/models/fp8_transformer/flux1-schnell-fp8-e4m3fn.safetensors"
+        tiny_vae_path = "/models/taef1"
+        # Converted to diffusers' layout and bf16 by download_model.py
+        converted_transformer_path = "/models/fp8_transformer/flux1-schnell-fp8-e4m3fn-diffusers"
         
-        # Load the Flux pipeline with optimizations
-        self.pipe = FluxPipeline.from_pretrained(
-            flux_model_path,
-            transformer=None,
-            # text_encoder_2=None,
-            torch_dtype=torch.bfloat16,
+        def subfolder(cls, name, **kwargs):
+            return lambda: cls.from_pretrained(flux_model_path, subfolder=name, **kwargs)
+
+        if os.path.exists(os.path.join(converted_transformer_path, "config.json")):
+            load_transformer = lambda: FluxTransformer2DModel.from_pretrained(
+                converted_transformer_path,
+                torch_dtype=torch.bfloat16
+            )
+            transformer_files = weight_files(converted_transformer_path)
+        else:
+            # Images built before the conversion step: convert at load time
+            load_transformer = lambda: FluxTransformer2DModel.from_single_file(
+                fp8_transformer_path,
+                torch_dtype=torch.bfloat16
+            )
+            transformer_files = [fp8_transformer_path]
+
+        # Load the components concurrently: weight files are read ahead while
+        # the torch modules are built and the encoders are cast to bf16
+        components, self.load_timings = load_components(
+            {
+                "transformer": load_transformer,
+                "text_encoder_2": subfolder(T5EncoderModel, "text_encoder_2", torch_dtype=torch.bfloat16),
+                "text_encoder": subfolder(CLIPTextModel, "text_encoder", torch_dtype=torch.bfloat16),
+                "vae": subfolder(AutoencoderKL, "vae", torch_dtype=torch.bfloat16),
+                # taef1: tiny autoencoder for Flux's 16-channel latents (fast decode and previews)
+                "tiny_vae": lambda: AutoencoderTiny.from_pretrained(tiny_vae_path, torch_dtype=torch.bfloat16),
+            },
+            light={
+                "tokenizer": subfolder(CLIPTokenizer, "tokenizer"),
+                "tokenizer_2": subfolder(T5TokenizerFast, "tokenizer_2"),
+                "scheduler": subfolder(FlowMatchEulerDiscreteScheduler, "scheduler"),
+            },
+            prefetch=transformer_files + weight_files(
+                *(os.path.join(flux_model_path, name) for name in ("text_encoder_2", "text_encoder", "vae")),
+                tiny_vae_path,
+            ),
         )
+        tiny_vae = components.pop("tiny_vae")
+        self.pipe = FluxPipeline(**components)
         
-        transformer = FluxTransformer2DModel.from_single_file(
-            fp8_transformer_path, 
-            torch_dtype=torch.bfloat16
+        # Keep as much resident as the card allows; offload only what doesn't fit
+        self.placement = place_pipeline(
+            self.pipe,
+            working_gb=self.WORKING_GB,
+            priority=("transformer", "vae", "text_encoder", "text_encoder_2"),
+            denoiser="transformer",
+            steps=DEFAULTS["num_inference_steps"],
         )
-        self.pipe.transformer = transformer
-        self.pipe.enable_model_cpu_offload()
         
+        # A few MB: always resident, so fast decodes and previews never wait for offloaded weights
+        self.tiny_vae = tiny_vae.to(self.pipe._execution_device)
+        self.decoder = Decoder(self.pipe.vae, self.tiny_vae, self.pipe.image_processor)
+        self.step_cache = StepCache(self.pipe.transformer, coefficients=FLUX_COEFFICIENTS)
+        
+        # The largest offloaded component still has to fit next to the batch while it runs
+        self.batch_budget_gb = vram_budget_gb(reserved_gb=self.placement.offload_peak_bytes / GB)
         self.initialized = True
         
-    def generate(self, input_data):
-        """Generate an image based on the input and return as base64 string."""
+    def cache_key(self, input_data):
+        """Result-cache key for a seeded request, or None when the output isn't deterministic."""
+        if input_data.get("seed") is None:
+            return None
+        params = {name: input_data.get(name, default) for name, default in DEFAULTS.items()}
+        params["prompt"] = normalize_prompt(params["prompt"])
+        params["negative_prompt"] = normalize_prompt(params["negative_prompt"])
+        params["seed"] = input_data["seed"]
+        if threshold := step_cache_threshold(input_data):
+            params["step_cache"] = threshold
+        if tolerance := early_exit_tolerance(input_data):
+            params["early_exit"] = tolerance
+        params.update(image_options(input_data))
+        return cache_key(self.MODEL_ID, params)
+
+    def encode_prompt(self, prompt, max_sequence_length):
+        """(prompt_embeds, pooled_prompt_embeds) for one prompt, from the LRU cache when possible."""
+        key = PromptCache.key(self.MODEL_ID, prompt, max_sequence_length)
+        def encode():
+            prompt_embeds, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+                prompt=prompt,
+                prompt_2=None,
+                max_sequence_length=max_sequence_length,
+            )
+            return prompt_embeds, pooled_prompt_embeds
+        return self.prompt_cache.get_or_encode(key, encode, device=self.pipe._execution_device)
+
+    def warmup(self, width, height, steps):
+        """One throwaway generation at this size, so kernels and allocator are primed; nothing is uploaded."""
         if not self.initialized:
             self.initialize()
+        max_sequence_length = DEFAULTS["max_sequence_length"]
+        prompt_embeds, pooled_prompt_embeds = self.encode_prompt(DEFAULTS["prompt"], max_sequence_length)
+        self.pipe(
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            num_inference_steps=steps,
+            height=height,
+            width=width,
+            guidance_scale=DEFAULTS["guidance_scale"],
+            generator=torch.Generator("cpu").manual_seed(0),
+            max_sequence_length=max_sequence_length,
+        )
+
+    def _params(self, input_data):
+        """Generation parameters for one request, with defaults applied."""
+        params = {name: input_data.get(name, default) for name, default in DEFAULTS.items()}
+        params["seed"] = input_data.get("seed", None)
+        params["decode_quality"] = decode_quality(input_data, DEFAULTS["decode_quality"])
+        params["step_cache"] = step_cache_threshold(input_data)
+        params["early_exit"] = early_exit_tolerance(input_data)
+        params["encode_options"] = image_options(input_data)
+        return params
+
+    def batch_key(self, input_data):
+        """Requests with equal keys can share one batched pipeline call."""
+        params = self._params(input_data)
+        return (
+            params["height"],
+            params["width"],
+            params["num_inference_steps"],
+            params["guidance_scale"],
+            params["max_sequence_length"],
+            params["decode_quality"],
+            params["step_cache"],
+            params["early_exit"],
+        )
+
+    def max_batch_size(self, height, width):
+        """Images of this size that fit into the VRAM left after loading the model."""
+        if not self.initialized:
+            self.initialize()
+        return batch_limit(self.batch_budget_gb, self.GB_PER_MEGAPIXEL, height, width)
+
+    def generate(self, input_data, on_preview=None, cancel=None, on_uploaded=None):
+        """Generate an image based on the input; returns its URL, the steps run and the steps the step cache skipped.
+
+        When on_preview is given it is called with a low-resolution preview
+        every `preview_every` denoising steps.
+        """
+        result = self.generate_batch([input_data], on_preview=on_preview, cancel=cancel, on_uploaded=[on_uploaded])[0]
+        if isinstance(result, JobCancelled):
+            raise result
+        return result
+
+    @release_on_cancel()
+    def generate_batch(self, inputs, on_preview=None, cancel=None, on_uploaded=None):
+        """Generate one image per input in a single pipeline call; returns (URL, steps run, skipped steps) per input.
+
+        All inputs must share a batch_key. Each sample gets its own generator,
+        so a seeded request produces the same image whether or not it was batched.
+        Raises JobCancelled as soon as `cancel` (a CancelToken) is cancelled:
+        checked on every denoising step, before decoding and before upload.
+        For a CancelGroup, each request's own token is checked before its
+        upload too; a cancelled request gets JobCancelled in place of its result.
+        on_uploaded, one callback (or None) per input, is called with the
+        input's URL once its image is actually in R2.
+        """
+        if not self.initialized:
+            self.initialize()
+        cancel = cancel or CancelToken()
+        cancel.check()
         
         # Extract parameters from input data
-        prompt = input_data.get("prompt", "A photo of a dog and a cat")
-        negative_prompt = input_data.get("negative_prompt", "")
-        height = input_data.get("height", 768)
-        width = input_data.get("width", 1360)
-        steps = input_data.get("num_inference_steps", 4)  # Default for schnell is lower
-        guidance_scale = input_data.get("guidance_scale", 0.0)  # Default for schnell is 0
-        seed = input_data.get("seed", None)
-        max_sequence_length = input_data.get("max_sequence_length", 256)  # Schnell-specific
-        img_format = input_data.get("image_format", "png")
-        if img_format not in ["png", "jpeg", "jpg"]:
-            raise ValueError("Invalid image format. Supported formats are 'png' and 'jpg'.")
+        jobs = [self._params(input_data) for input_data in inputs]
+        height = jobs[0]["height"]
+        width = jobs[0]["width"]
+        steps = jobs[0]["num_inference_steps"]
         
-        # Set up generator if seed is provided
+        # Set up per-sample generators if any seed is provided
         generator = None
-        if seed is not None:
-            generator = torch.Generator("cpu").manual_seed(seed)
+        if any(job["seed"] is not None for job in jobs):
+            generator = []
+            for job in jobs:
+                sample_generator = torch.Generator("cpu")
+                if job["seed"] is not None:
+                    sample_generator.manual_seed(job["seed"])
+                else:
+                    sample_generator.seed()
+                generator.append(sample_generator)
         
-        # Generate the image
-        image = self.pipe(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            num_inference_steps=steps,
-            height=height,
-            width=width,
-            guidance_scale=guidance_scale,
-            generator=generator,
-            max_sequence_length=max_sequence_length,  # Schnell-specific parameter
-        ).images[0]
-        
-        # Convert to base64
-        buffered = io.BytesIO()
+        # Object keys (and so the public URLs) are fixed before generation starts
         now = datetime.now()
-        filename = f"gen-images/{now.month}/{now.day}/{generate(size=10)}/{uuid.uuid4()}.{img_format}"
-        if img_format == "png":
-            image.save(buffered, format="PNG")
-            content_type = "image/png"
-        elif img_format == "jpeg" or img_format == "jpg":
-            image.convert("RGB")
-            # Convert to RGB for JPEG
-            image.save(buffered, format="JPEG")
-            content_type = "image/jpeg"
-        buffered.seek(0)
-        url = upload_to_r2(buffered.getvalue(), filename, content_type)
-        # img_str = base64.b64encode(buffered.getvalue()).decode()
+        filenames = [
+            f"gen-images/{now.month}/{now.day}/{generate(size=10)}/{uuid.uuid4()}.{job['image_format']}"
+            for job in jobs
+        ]
+        
+        # Low-resolution previews through the step-end callback
+        callback = None
+        if on_preview is not None:
+            preview_every, preview_size = preview_settings(inputs[0], default_every=1)
+            if preview_every:
+                def decode(pipe, latents):
+                    latents = pipe._unpack_latents(latents, height, width, pipe.vae_scale_factor)
+                    return tiny_vae_preview(self.tiny_vae, latents, preview_size)
+                callback = preview_callback(decode, steps, preview_every, on_preview)
+        
+        # Text encoder outputs come from the prompt cache; the (unused without
+        # true CFG) negative prompt is not encoded at all
+        max_sequence_length = jobs[0]["max_sequence_length"]
+        embeds = [self.encode_prompt(job["prompt"], max_sequence_length) for job in jobs]
+        print(f"Prompt cache: {self.prompt_cache.stats()}")
+        
+        # Adaptive mode: stop once the prediction settles, within the requested steps
+        early_exit = EarlyExit(jobs[0]["early_exit"], steps) if jobs[0]["early_exit"] else None
+        
+        # Denoise (reusing the transformer's residual on steps the step cache
+        # skips), then decode the batch with the VAE chosen by decode_quality.
+        # Only a failure in the pipeline call has the batch retried one request at a time
+        with self.step_cache.run(jobs[0]["step_cache"], steps) as cached, denoising():
+            latents = self.pipe(
+                prompt_embeds=torch.cat([prompt_embeds for prompt_embeds, _ in embeds]),
+                pooled_prompt_embeds=torch.cat([pooled for _, pooled in embeds]),
+                num_inference_steps=steps,
+                height=height,
+                width=width,
+                guidance_scale=jobs[0]["guidance_scale"],
+                generator=generator,
+                max_sequence_length=max_sequence_length,  # Schnell-specific parameter
+                callback_on_step_end=chain_callbacks(cancel.step_callback, callback, early_exit),
+                output_type="latent",
+            ).images
+        if jobs[0]["step_cache"]:
+            print(f"Step cache: {cached.stats()}; total: {self.step_cache.stats()}")
+        steps_used = early_exit.steps_used if early_exit else steps
+        if early_exit:
+            print(f"Early exit: {early_exit.stats()}")
+        cancel.check()
+        latents = self.pipe._unpack_latents(latents, height, width, self.pipe.vae_scale_factor)
+        images = self.decoder.decode(latents, jobs[0]["decode_quality"])
+        print(f"Decode: {self.decoder.stats()}")
+        cancel.check()
         
-        return url
\ No newline at end of file
+        # Encoded straight into R2, no intermediate BytesIO copy; nothing is
+        # uploaded for a request cancelled while the rest of its batch ran
+        tokens = cancel.tokens if isinstance(cancel, CancelGroup) else [cancel] * len(jobs)
+        on_uploaded = on_uploaded or [None] * len(jobs)
+        return [
+            JobCancelled(token.reason) if token.cancelled else (
+                submit_image(image, filename, job["image_format"], on_uploaded=notify, **job["encode_options"]),
+                steps_used,
+                cached.skipped,
+            )
+            for image, filename, job, token, notify in zip(images, filenames, jobs, tokens, on_uploaded)
+        ]
@@ -1,49 +1,22 @@
 import io
 import uuid
 from PIL import Image
-import boto3
-from botocore.client import Config
 import os
 from datetime import datetime, timedelta
 
-# === Upload function ===
-def upload_to_r2(image_bytes, filename, content_type):
-    session = boto3.session.Session()
-    expires_at = (datetime.utcnow() + timedelta(hours=24)).isoformat()
-    client = session.client(
-        's3',
-        region_name='auto',
-        endpoint_url=os.getenv('R2_ENDPOINT_URL'),
-        aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),  
-        aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),  
-        config=Config(signature_version='s3v4')
-    )
-
-    bucket_name = os.getenv('R2_BUCKET_NAME')
-
-    
-    
-    client.put_object(
-        Bucket=bucket_name,
-        Key=filename,
-        Body=image_bytes,
-        ContentType=content_type,
-        Metadata={"expires-at": expires_at},
-        ACL='public-read'
-    )
-    # Month and date
-    
-    public_url = f"{os.getenv('PUBLIC_URL')}/{filename}"
-    return public_url
-
-
-def calculate_cost(width: int, height: int):
+from uploader import upload_to_r2  # noqa: F401
+
+
+def calculate_cost(width: int, height: int, steps: int = None, max_steps: int = None):
     """
     Calculate cost based on image dimensions and COST_PER_MEGAPX env variable.
 
     Args:
         width (int): Image width in pixels.
         height (int): Image height in pixels.
+        steps (int): Optional. Denoising steps actually run; with max_steps,
+            only that share of the requested steps is billed (early exit).
+        max_steps (int): Optional. Denoising steps requested.
 
     Returns:
         dict: Dictionary containing pixels, megapixels, and total cost in USD.
@@ -57,6 +30,9 @@ def calculate_cost(width: int, height: int):
     except ValueError:
         raise ValueError("Invalid COST_PER_MEGAPX value in environment.")
 
+    if steps is not None and max_steps:
+        cost_per_megapixel *= min(steps, max_steps) / max_steps
+
     cost_usd = round(megapixels * cost_per_megapixel, 8)
 
     return cost_usd
\ No newline at end of file
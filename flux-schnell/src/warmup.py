@@ -0,0 +1,56 @@
+import os
+import time
+
+
+def parse_buckets(spec, default_steps):
+    """"1024x1024x4,1360x768" -> [(1024, 1024, 4), (1360, 768, default_steps)] as (width, height, steps)."""
+    buckets = []
+    for item in spec.replace(" ", "").split(","):
+        if not item:
+            continue
+        parts = [int(part) for part in item.lower().split("x")]
+        if len(parts) not in (2, 3) or min(parts) <= 0:
+            raise ValueError(f"Invalid warmup bucket {item!r}. Expected WIDTHxHEIGHT or WIDTHxHEIGHTxSTEPS.")
+        buckets.append((parts[0], parts[1], parts[2] if len(parts) == 3 else default_steps))
+    return buckets
+
+
+def warmup_buckets(default, default_steps=2):
+    """Buckets from WARMUP_BUCKETS (or `default`); empty when WARMUP=0."""
+    if os.getenv("WARMUP", "1") != "1":
+        return []
+    return parse_buckets(os.getenv("WARMUP_BUCKETS", default), default_steps)
+
+
+def run_warmup(warm, buckets, setup=None):
+    """Call warm(width, height, steps) per bucket, logging and returning the seconds each took.
+
+    setup (e.g. model loading) runs first and is timed separately, so bucket
+    timings only show first-call compilation and allocation.
+    """
+    timings = {}
+    if setup is not None and buckets:
+        start = time.perf_counter()
+        setup()
+        print(f"Warmup setup: {time.perf_counter() - start:.2f}s")
+    for width, height, steps in buckets:
+        start = time.perf_counter()
+        warm(width, height, steps)
+        timings[(width, height, steps)] = time.perf_counter() - start
+        print(f"Warmup {width}x{height}, {steps} steps: {timings[(width, height, steps)]:.2f}s")
+    return timings
+
+
+def snap_size(width, height, buckets, tolerance=None):
+    """Nearest warmed (width, height) when both sides are within `tolerance` (a fraction), else the input.
+
+    Only active with WARMUP_SNAP=1, so clients get the size they asked for
+    unless the endpoint opts in.
+    """
+    if os.getenv("WARMUP_SNAP", "0") != "1" or not buckets:
+        return width, height
+    tolerance = tolerance if tolerance is not None else float(os.getenv("WARMUP_SNAP_TOLERANCE", "0.1"))
+    best = min(buckets, key=lambda b: abs(b[0] - width) / width + abs(b[1] - height) / height)
+    if abs(best[0] - width) <= tolerance * width and abs(best[1] - height) <= tolerance * height:
+        return best[0], best[1]
+    return width, height
@@ -0,0 +1,128 @@
+"""
+Benchmark: throughput versus latency of src/batcher.py micro-batching, on a
+tiny randomly initialized Flux pipeline running on CPU (no weights, GPU or
+endpoint needed).
+
+Requests arrive as a Poisson process; each configuration reports images per
+second and p50/p95 latency from arrival to result:
+
+    pip install torch diffusers
+    python bench_batching.py --requests 64 --rate 12 --windows 0,25,100 --max-batch 1,4,8
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+import torch
+from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxPipeline, FluxTransformer2DModel
+from diffusers.utils import logging as diffusers_logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from batcher import Batcher  # noqa: E402
+
+
+def tiny_pipeline():
+    torch.manual_seed(0)
+    transformer = FluxTransformer2DModel(
+        patch_size=1, in_channels=4, num_layers=2, num_single_layers=2, attention_head_dim=32,
+        num_attention_heads=4, joint_attention_dim=32, pooled_projection_dim=32, axes_dims_rope=[8, 12, 12],
+    )
+    vae = AutoencoderKL(
+        sample_size=32, in_channels=3, out_channels=3, block_out_channels=(4,), layers_per_block=1,
+        latent_channels=1, norm_num_groups=1, use_quant_conv=False, use_post_quant_conv=False,
+        shift_factor=0.0609, scaling_factor=1.5035,
+    )
+    pipe = FluxPipeline(
+        scheduler=FlowMatchEulerDiscreteScheduler(), vae=vae, text_encoder=None, tokenizer=None,
+        text_encoder_2=None, tokenizer_2=None, transformer=transformer,
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def make_run_batch(pipe, size, steps):
+    # Precomputed embeddings stand in for the text encoders
+    prompt_embeds = torch.randn(1, 64, 32)
+    pooled_prompt_embeds = torch.randn(1, 32)
+
+    def run_batch(inputs, on_preview=None):
+        n = len(inputs)
+        images = pipe(
+            prompt_embeds=prompt_embeds.repeat(n, 1, 1),
+            pooled_prompt_embeds=pooled_prompt_embeds.repeat(n, 1),
+            height=size,
+            width=size,
+            num_inference_steps=steps,
+            generator=[torch.Generator().manual_seed(item["seed"]) for item in inputs],
+            output_type="np",
+        ).images
+        return list(images)
+    return run_batch
+
+
+def run(run_batch, requests, rate, window_ms, max_batch):
+    batcher = Batcher(
+        run_batch, key=lambda item: 0, limit=lambda key: max_batch, window_ms=window_ms, max_queue=requests,
+    )
+    latencies = []
+    lock = threading.Lock()
+    rng = random.Random(0)
+
+    def record(arrival):
+        def done(_):
+            with lock:
+                latencies.append((time.perf_counter() - arrival) * 1000)
+        return done
+
+    start = time.perf_counter()
+    futures = []
+    for i in range(requests):
+        future = batcher.submit({"seed": i})
+        future.add_done_callback(record(time.perf_counter()))
+        futures.append(future)
+        time.sleep(rng.expovariate(rate))
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "throughput": requests / elapsed,
+        "p50": statistics.median(latencies),
+        "p95": latencies[int(len(latencies) * 0.95) - 1],
+        "mean_batch": batcher.items / batcher.batches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=12.0, help="mean arrivals per second")
+    parser.add_argument("--size", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--windows", default="0,25,100", help="comma-separated batch windows in ms")
+    parser.add_argument("--max-batch", default="1,4,8", help="comma-separated batch size caps")
+    args = parser.parse_args()
+
+    diffusers_logging.set_verbosity_error()
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+    run_batch = make_run_batch(tiny_pipeline(), args.size, args.steps)
+    run_batch([{"seed": 0}] * 2)  # warm up
+
+    print(f"{args.requests} requests at {args.rate}/s, {args.size}x{args.size}, {args.steps} steps")
+    for max_batch in (int(m) for m in args.max_batch.split(",")):
+        for window_ms in (float(w) for w in args.windows.split(",")):
+            if max_batch == 1 and window_ms:
+                continue  # no batching: window only adds latency
+            r = run(run_batch, args.requests, args.rate, window_ms, max_batch)
+            print(f"max_batch {max_batch:>2}  window {window_ms:5.0f} ms   "
+                  f"{r['throughput']:6.2f} img/s   p50 {r['p50']:8.1f} ms   p95 {r['p95']:8.1f} ms   "
+                  f"mean batch {r['mean_batch']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
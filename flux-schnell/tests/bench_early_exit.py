@@ -0,0 +1,78 @@
+"""
+Benchmark: steps saved and latency of adaptive early exit (src/early_exit.py)
+across a prompt set, on a tiny randomly initialized Flux pipeline running on
+CPU (no weights, GPU or endpoint needed).
+
+Each prompt (random embeddings standing in for the text encoders) is
+generated once per tolerance with the same seed. Quality is the relative L1
+error of the final latents against running all requested steps. Random
+weights converge differently from the real models, so use this to compare
+tolerances, not to pick one:
+
+    pip install torch diffusers
+    python bench_early_exit.py --prompts 16 --steps 4,20 --tolerances 0,0.01,0.02,0.05
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import torch
+from diffusers.utils import logging as diffusers_logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from bench_batching import tiny_pipeline  # noqa: E402
+from early_exit import EarlyExit  # noqa: E402
+
+
+def prompt_set(count, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [(torch.randn(1, 64, 32, generator=generator), torch.randn(1, 32, generator=generator)) for _ in range(count)]
+
+
+def generate(pipe, prompt, size, steps, tolerance, seed):
+    early_exit = EarlyExit(tolerance, steps)
+    prompt_embeds, pooled_prompt_embeds = prompt
+    start = time.perf_counter()
+    latents = pipe(
+        prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds, height=size, width=size,
+        num_inference_steps=steps, generator=torch.Generator().manual_seed(seed), output_type="latent",
+        callback_on_step_end=early_exit,
+    ).images
+    return latents, early_exit.steps_used, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=16)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--steps", default="4,20", help="requested steps, e.g. schnell's 4 and SD3's 20")
+    parser.add_argument("--tolerances", default="0,0.01,0.02,0.05")
+    args = parser.parse_args()
+
+    diffusers_logging.set_verbosity_error()
+    pipe = tiny_pipeline()
+    prompts = prompt_set(args.prompts)
+    generate(pipe, prompts[0], args.size, 2, 0.0, seed=0)  # warm up
+
+    print(f"{args.prompts} prompts, {args.size}x{args.size}")
+    print(f"{'steps':>5} {'tolerance':>10} {'mean steps':>11} {'saved':>7} {'ms/image':>9} {'rel. error':>11}")
+    for steps in (int(s) for s in args.steps.split(",")):
+        reference = None
+        for tolerance in (float(t) for t in args.tolerances.split(",")):
+            results = [generate(pipe, prompt, args.size, steps, tolerance, seed) for seed, prompt in enumerate(prompts)]
+            if reference is None:
+                reference = [latents for latents, _, _ in results]
+            used = statistics.mean(steps_used for _, steps_used, _ in results)
+            ms = statistics.mean(ms for _, _, ms in results)
+            error = statistics.mean(
+                ((latents - ref).abs().mean() / ref.abs().mean()).item()
+                for (latents, _, _), ref in zip(results, reference)
+            )
+            print(f"{steps:>5} {tolerance:>10g} {used:>11.2f} {1 - used / steps:>6.0%} {ms:>9.1f} {error:>11.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+
+from batcher import Batcher, DenoiseError, batch_limit  # noqa: E402
+from cancellation import CancelToken, JobCancelled  # noqa: E402
+
+
+class RecordingRun:
+    def __init__(self, fail_when=None):
+        self.calls = []
+        self.fail_when = fail_when
+        self.release = threading.Event()
+
+    def __call__(self, inputs, on_preview=None):
+        self.release.wait(5)
+        self.calls.append([item["id"] for item in inputs])
+        if self.fail_when and len(inputs) > 1 and any(self.fail_when(item) for item in inputs):
+            raise DenoiseError("CUDA out of memory")
+        if self.fail_when and any(self.fail_when(item) for item in inputs):
+            raise RuntimeError("bad request")
+        return [f"url-{item['id']}" for item in inputs]
+
+
+def make_batcher(run, limit=8):
+    return Batcher(run, key=lambda item: (item["height"], item["width"]), limit=lambda key: limit, window_ms=200)
+
+
+def test_groups_compatible_requests_and_splits_results():
+    run = RecordingRun()
+    batcher = make_batcher(run)
+    futures = [
+        batcher.submit({"id": i, "height": 512 if i % 2 else 768, "width": 512})
+        for i in range(6)
+    ]
+    run.release.set()
+
+    assert [f.result(5) for f in futures] == [f"url-{i}" for i in range(6)]
+    assert sorted(run.calls) == [[0, 2, 4], [1, 3, 5]]
+    assert batcher.batches == 2 and batcher.items == 6
+
+
+def test_full_batch_dispatches_before_the_window():
+    run = RecordingRun()
+    run.release.set()
+    batcher = Batcher(run, key=lambda item: 0, limit=lambda key: 2, window_ms=60_000)
+    futures = [batcher.submit({"id": i}) for i in range(2)]
+    assert [f.result(5) for f in futures] == ["url-0", "url-1"]
+
+
+def test_failed_batch_is_retried_one_at_a_time():
+    run = RecordingRun(fail_when=lambda item: item["id"] == 1)
+    batcher = make_batcher(run)
+    futures = [batcher.submit({"id": i, "height": 512, "width": 512}) for i in range(3)]
+    run.release.set()
+
+    assert futures[0].result(5) == "url-0"
+    assert futures[2].result(5) == "url-2"
+    with pytest.raises(RuntimeError, match="bad request"):
+        futures[1].result(5)
+
+
+def test_failure_after_denoising_is_not_generated_again():
+    calls = []
+
+    def run(inputs, on_preview=None):
+        calls.append(len(inputs))
+        raise RuntimeError("upload queue is shut down")
+
+    batcher = Batcher(run, key=lambda item: 0, limit=lambda key: 2, window_ms=60_000)
+    futures = [batcher.submit({"id": i}) for i in range(2)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="shut down"):
+            future.result(5)
+    assert calls == [2]
+
+
+def test_preview_requests_run_alone():
+    run = RecordingRun()
+    batcher = make_batcher(run)
+    futures = [batcher.submit({"id": i, "height": 512, "width": 512}, on_preview=print if i == 0 else None) for i in range(3)]
+    run.release.set()
+
+    [f.result(5) for f in futures]
+    assert run.calls == [[0], [1, 2]]
+
+
+def test_batch_stops_only_once_all_its_requests_are_cancelled():
+    steps = []
+
+    def run(inputs, on_preview=None, cancel=None):
+        for step in range(500):
+            cancel.check()
+            steps.append(step)
+            time.sleep(0.01)
+        return [f"url-{item['id']}" for item in inputs]
+
+    batcher = Batcher(run, key=lambda item: 0, limit=lambda key: 2, window_ms=60_000)
+    tokens = [CancelToken(), CancelToken()]
+    futures = [batcher.submit({"id": i}, cancel=token) for i, token in enumerate(tokens)]
+    tokens[0].cancel()
+    time.sleep(0.1)
+    assert not futures[0].done() and steps
+
+    tokens[1].cancel()
+    for future in futures:
+        with pytest.raises(JobCancelled):
+            future.result(5)
+    while batcher.metrics()["running"]:
+        time.sleep(0.01)
+    assert len(steps) < 500 and batcher.metrics()["cancelled"] == 2
+
+
+def test_batch_limit_scales_with_budget_and_size():
+    assert batch_limit(12.0, 1.5, 1024, 1024, max_size=8) == 7
+    assert batch_limit(12.0, 1.5, 2048, 2048, max_size=8) == 1
+    assert batch_limit(0.0, 1.5, 512, 512, max_size=8) == 1
+    assert batch_limit(100.0, 1.5, 512, 512, max_size=4) == 4
+
+
+def test_cancelled_member_of_a_batch_is_not_uploaded(monkeypatch):
+    import torch
+    from diffusers import AutoencoderTiny
+
+    import txt2img_flux_schnell
+    from bench_batching import tiny_pipeline
+    from decode import Decoder
+    from step_cache import StepCache
+
+    generator = txt2img_flux_schnell.FluxSchnellGenerator()
+    generator.pipe = tiny_pipeline()
+    generator.tiny_vae = AutoencoderTiny(
+        latent_channels=1, encoder_block_out_channels=(4, 4, 4, 4), decoder_block_out_channels=(4, 4, 4, 4),
+    )
+    generator.decoder = Decoder(generator.pipe.vae, generator.tiny_vae, generator.pipe.image_processor)
+    generator.step_cache = StepCache(generator.pipe.transformer)
+    generator.initialized = True
+    monkeypatch.setattr(generator, "encode_prompt", lambda prompt, length: (torch.randn(1, 8, 32), torch.randn(1, 32)))
+    uploads, confirmed = [], []
+
+    def submit_image(image, filename, img_format, on_uploaded=None, **options):
+        uploads.append(filename)
+        if on_uploaded is not None:
+            on_uploaded(filename)
+        return filename
+
+    monkeypatch.setattr(txt2img_flux_schnell, "submit_image", submit_image)
+    tokens = [CancelToken(), CancelToken()]
+    # The first request is cancelled while the batch denoises
+    generator.pipe.transformer.register_forward_hook(lambda *args: tokens[0].cancel())
+
+    batcher = Batcher(generator.generate_batch, key=generator.batch_key, limit=lambda key: 2, window_ms=60_000)
+    options = {"height": 32, "width": 32, "num_inference_steps": 2}
+    futures = [
+        batcher.submit({**options, "seed": i}, cancel=token, on_uploaded=confirmed.append)
+        for i, token in enumerate(tokens)
+    ]
+
+    with pytest.raises(JobCancelled):
+        futures[0].result(30)
+    url, steps, skipped = futures[1].result(30)
+    assert uploads == [url] and confirmed == [url] and steps == 2
+    while batcher.metrics()["running"]:
+        time.sleep(0.01)
+    assert batcher.batches == 1 and batcher.metrics()["cancelled"] == 1
@@ -0,0 +1,72 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+
+from bench_batching import tiny_pipeline  # noqa: E402
+from early_exit import EarlyExit, early_exit_tolerance  # noqa: E402
+from previews import chain_callbacks  # noqa: E402
+from utils import calculate_cost  # noqa: E402
+
+
+def test_straight_flow_exits_at_its_endpoint():
+    """On a straight path the prediction is exact from the start, so denoising stops as soon as it can be compared."""
+    torch.manual_seed(0)
+    clean, noise = torch.randn(2, 16, 4), torch.randn(2, 16, 4)
+    sigmas = torch.linspace(1, 0, 9)
+    pipe = SimpleNamespace(scheduler=SimpleNamespace(sigmas=sigmas), _interrupt=False)
+    previews = []
+    early_exit = EarlyExit(0.01, steps=8)
+    callback = chain_callbacks(lambda pipe, i, t, kwargs: previews.append(i) or {}, None, early_exit)
+
+    for i in range(8):
+        latents = (1 - sigmas[i + 1]) * clean + sigmas[i + 1] * noise
+        outputs = callback(pipe, i, None, {"latents": latents})
+        if pipe._interrupt:
+            break
+
+    assert early_exit.steps_used == 3 and previews == [0, 1, 2]
+    torch.testing.assert_close(outputs["latents"], clean)
+    assert early_exit.stats()["changes"] == [0.0]
+
+
+def test_pipeline_stops_early_and_runs_to_the_end_without_a_tolerance():
+    pipe = tiny_pipeline()
+    calls = []
+    pipe.transformer.register_forward_hook(lambda *args: calls.append(1))
+
+    def generate(callback):
+        return pipe(
+            prompt_embeds=torch.randn(1, 8, 32, generator=torch.Generator().manual_seed(1)),
+            pooled_prompt_embeds=torch.zeros(1, 32), height=32, width=32, num_inference_steps=8,
+            generator=torch.Generator().manual_seed(0), output_type="latent", callback_on_step_end=callback,
+        ).images
+
+    reference = generate(EarlyExit(0.0, steps=8))
+    assert len(calls) == 8
+
+    calls.clear()
+    early_exit = EarlyExit(100.0, steps=8)
+    latents = generate(early_exit)
+    assert early_exit.steps_used == 3 and len(calls) == 3
+    assert latents.shape == reference.shape and torch.isfinite(latents).all()
+
+
+def test_cost_is_billed_for_the_steps_run(monkeypatch):
+    monkeypatch.setenv("COST_PER_MEGAPIXEL", "0.004")
+    assert calculate_cost(1000, 1000) == 0.004
+    assert calculate_cost(1000, 1000, steps=3, max_steps=4) == 0.003
+    assert calculate_cost(1000, 1000, steps=None, max_steps=4) == 0.004
+
+
+def test_early_exit_input_is_validated(monkeypatch):
+    monkeypatch.delenv("EARLY_EXIT_TOLERANCE", raising=False)
+    assert early_exit_tolerance({}) == 0.0
+    assert early_exit_tolerance({"early_exit": 0.02}) == 0.02
+    for value in (-1, "yes", True):
+        with pytest.raises(ValueError):
+            early_exit_tolerance({"early_exit": value})
@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import io
+import os
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+
+def preview_settings(input_data, default_every):
+    """Preview cadence (every N steps, 0 = off) and max side in pixels for a job."""
+    every = input_data.get("preview_every", int(os.getenv("PREVIEW_EVERY", str(default_every))))
+    max_size = input_data.get("preview_size", int(os.getenv("PREVIEW_SIZE", "256")))
+    if not isinstance(every, int) or every < 0:
+        raise ValueError("Invalid preview_every. Must be a non-negative integer.")
+    if not isinstance(max_size, int) or not 32 <= max_size <= 1024:
+        raise ValueError("Invalid preview_size. Must be an integer between 32 and 1024.")
+    return every, max_size
+
+
+def _to_image(rgb, max_size):
+    """(3, h, w) tensor in [-1, 1] -> PIL image no larger than max_size."""
+    pixels = ((rgb.float() + 1) / 2).clamp(0, 1).mul(255).byte()
+    image = Image.fromarray(pixels.permute(1, 2, 0).cpu().numpy())
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size))
+    return image
+
+
+@torch.no_grad()
+def tiny_vae_preview(vae, latents, max_size):
+    """Decode (1, C, h, w) transformer-space latents with a tiny autoencoder at preview size.
+
+    Latents are downsampled first so the decoder only produces about
+    max_size pixels on the long side.
+    """
+    latents = latents[:1] / vae.config.scaling_factor + getattr(vae.config, "shift_factor", 0.0)
+    height, width = latents.shape[-2:]
+    scale = max_size / (8 * max(height, width))
+    if scale < 1:
+        latents = F.interpolate(latents, size=(max(1, round(height * scale)), max(1, round(width * scale))), mode="bilinear")
+    image = vae.decode(latents.to(vae.device, vae.dtype), return_dict=False)[0][0]
+    return _to_image(image, max_size)
+
+
+def preview_data_url(image):
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=70)
+    return "data:image/jpeg;base64," + base64.b64encode(buffered.getbuffer()).decode()
+
+
+def preview_callback(decode, steps, every, on_preview):
+    """callback_on_step_end that emits a decoded preview every `every` steps (not on the last one).
+
+    decode(pipe, latents) turns the pipeline's latents into a PIL image.
+    """
+    def callback(pipe, i, t, callback_kwargs):
+        step = i + 1
+        if step % every == 0 and step < steps:
+            image = decode(pipe, callback_kwargs["latents"])
+            on_preview({
+                "status": "preview",
+                "step": step,
+                "total_steps": steps,
+                "preview": preview_data_url(image),
+            })
+        return {}
+    return callback
+
+
+def chain_callbacks(*callbacks):
+    """One callback_on_step_end that runs each given callback (None entries are skipped) in order.
+
+    Each callback sees the tensors the ones before it returned, and the
+    merged outputs go back to the pipeline.
+    """
+    callbacks = [callback for callback in callbacks if callback is not None]
+    if len(callbacks) <= 1:
+        return callbacks[0] if callbacks else None
+    def callback(pipe, i, t, callback_kwargs):
+        outputs = {}
+        for step_callback in callbacks:
+            outputs.update(step_callback(pipe, i, t, {**callback_kwargs, **outputs}) or {})
+        return outputs
+    return callback
+
+
+class PreviewStream:
+    """Async-iterates the previews of a job started as fn(on_preview).
+
+    fn returns an awaitable; on_preview may be called from any thread (the
+    pipeline callback runs off the event loop). Iteration ends when the job
+    finishes, and `await stream.result()` gives its return value (or raises
+    its exception).
+    """
+
+    def __init__(self, fn):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._future = asyncio.ensure_future(fn(self._push))
+        self._future.add_done_callback(lambda _: self._queue.put_nowait(None))
+
+    def _push(self, preview):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, preview)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        preview = await self._queue.get()
+        if preview is None:
+            raise StopAsyncIteration
+        return preview
+
+    async def result(self):
+        return await self._future
@@ -1,17 +1,41 @@
 import torch
 import base64
 import io
-from diffusers import StableDiffusion3Pipeline, AutoencoderTiny
-from transformers import T5EncoderModel, BitsAndBytesConfig
+import os
+from diffusers import AutoencoderKL, AutoencoderTiny, FlowMatchEulerDiscreteScheduler, SD3Transformer2DModel, StableDiffusion3Pipeline
+from transformers import BitsAndBytesConfig, CLIPTextModelWithProjection, CLIPTokenizer, T5EncoderModel, T5TokenizerFast
 from PIL import Image
-from utils import upload_to_r2
+from uploader import image_options, submit_image
+from result_cache import cache_key, normalize_prompt
+from prompt_cache import PromptCache
+from placement import GB, place_pipeline
+from loader import load_components, weight_files
+from previews import chain_callbacks, preview_callback, preview_settings, tiny_vae_preview
+from decode import Decoder, decode_quality
+from early_exit import EarlyExit, early_exit_tolerance
+from cancellation import CancelGroup, CancelToken, JobCancelled, release_on_cancel
+from step_cache import StepCache, step_cache_threshold
+from batcher import batch_limit, denoising, vram_budget_gb
 import uuid
 from datetime import datetime, timedelta
 from nanoid import generate
 class SD3Generator:
+    MODEL_ID = "stabilityai/stable-diffusion-3-medium-diffusers"
+    # Activation headroom at the default resolution, GB
+    WORKING_GB = 4
+    # Rough activation + VAE decode memory per megapixel of batch, fp16 with CFG
+    GB_PER_MEGAPIXEL = 1.0
+
     def __init__(self):
         self.pipe = None
         self.initialized = False
+        self.placement = None
+        self.load_timings = {}
+        self.tiny_vae = None
+        self.decoder = None
+        self.step_cache = None
+        self.prompt_cache = PromptCache()
+        self.batch_budget_gb = 0.0
     
     def initialize(self):
         """Initialize the SD3 model with optimizations for both memory and speed."""
@@ -23,97 +47,263 @@ class SD3Generator:
         sd3_model_path = "/models/sd3-medium"
         taesd3_path = "/models/taesd3"
         
-        # Memory optimization approach 1: Use 8-bit quantization for T5 encoder
-        try:
-            # Setup quantization config
-            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
-            
-            # Create pipeline with the quantized T5 encoder and device_map to handle placement
-            self.pipe = StableDiffusion3Pipeline.from_pretrained(
-                sd3_model_path,
-                quantization_config={"text_encoder_3": quantization_config},
-                torch_dtype=torch.float16,
-                device_map="auto"  # Let diffusers handle device placement
-            )
-            
-            # Speed optimization: Use tiny autoencoder
-            self.pipe.vae = AutoencoderTiny.from_pretrained(
-                taesd3_path, 
-                torch_dtype=torch.float16
-            )
-            
-            # Only apply memory format to non-quantized components
-            if hasattr(self.pipe, "transformer") and not getattr(self.pipe.transformer, "is_quantized", False):
-                self.pipe.transformer.to(memory_format=torch.channels_last)
-            
-            if hasattr(self.pipe, "vae") and not getattr(self.pipe.vae, "is_quantized", False):
-                self.pipe.vae.to(memory_format=torch.channels_last)
-            
-        except Exception as e:
-            print(f"Failed to load with quantization: {e}")
-            print("Falling back to simpler model configuration")
-            
-            # Memory optimization approach 2: Use without T5 encoder
-            self.pipe = StableDiffusion3Pipeline.from_pretrained(
-                sd3_model_path,
-                text_encoder_3=None,  # Remove T5 encoder
-                tokenizer_3=None,
-                torch_dtype=torch.float16
-            )
-            
-            self.pipe.to("cuda")
-            self.pipe.vae = AutoencoderTiny.from_pretrained(
-                taesd3_path, 
-                torch_dtype=torch.float16
-            ).to("cuda")
+        def subfolder(cls, name, **kwargs):
+            return lambda: cls.from_pretrained(sd3_model_path, subfolder=name, **kwargs)
+
+        # Memory optimization: 8-bit T5 encoder. If quantization isn't available
+        # only the T5 encoder is dropped; the other components are unaffected
+        def load_text_encoder_3():
+            try:
+                return T5EncoderModel.from_pretrained(
+                    sd3_model_path,
+                    subfolder="text_encoder_3",
+                    quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                    torch_dtype=torch.float16,
+                )
+            except Exception as e:
+                print(f"Failed to load the T5 encoder with quantization: {e}")
+                print("Falling back to the CLIP encoders only")
+                return None
+
+        # Load the components concurrently. The taesd3 tiny autoencoder is kept
+        # next to the full VAE for fast decodes (the default) and previews
+        components, self.load_timings = load_components(
+            {
+                "transformer": subfolder(SD3Transformer2DModel, "transformer", torch_dtype=torch.float16),
+                "text_encoder_3": load_text_encoder_3,
+                "text_encoder": subfolder(CLIPTextModelWithProjection, "text_encoder", torch_dtype=torch.float16),
+                "text_encoder_2": subfolder(CLIPTextModelWithProjection, "text_encoder_2", torch_dtype=torch.float16),
+                "vae": subfolder(AutoencoderKL, "vae", torch_dtype=torch.float16),
+                "tiny_vae": lambda: AutoencoderTiny.from_pretrained(taesd3_path, torch_dtype=torch.float16),
+            },
+            light={
+                "tokenizer": subfolder(CLIPTokenizer, "tokenizer"),
+                "tokenizer_2": subfolder(CLIPTokenizer, "tokenizer_2"),
+                "tokenizer_3": subfolder(T5TokenizerFast, "tokenizer_3"),
+                "scheduler": subfolder(FlowMatchEulerDiscreteScheduler, "scheduler"),
+            },
+            prefetch=weight_files(
+                taesd3_path,
+                *(os.path.join(sd3_model_path, name) for name in ("transformer", "text_encoder_3", "text_encoder", "text_encoder_2", "vae")),
+            ),
+        )
+        if components["text_encoder_3"] is None:
+            components["tokenizer_3"] = None
+        tiny_vae = components.pop("tiny_vae")
+        self.pipe = StableDiffusion3Pipeline(**components)
+
+        # Only apply memory format to non-quantized components
+        for module in (self.pipe.transformer, self.pipe.vae, tiny_vae):
+            if not getattr(module, "is_quantized", False):
+                module.to(memory_format=torch.channels_last)
+        
+        # Keep as much resident as the card allows; quantized encoders are already placed
+        self.placement = place_pipeline(
+            self.pipe,
+            working_gb=self.WORKING_GB,
+            priority=("transformer", "vae", "text_encoder", "text_encoder_2", "text_encoder_3"),
+            pinned=[name for name, c in self.pipe.components.items() if getattr(c, "is_quantized", False)],
+            denoiser="transformer",
+            steps=20,
+        )
+        
+        # A few MB: always resident, so fast decodes and previews never wait for offloaded weights
+        self.tiny_vae = tiny_vae.to(self.pipe._execution_device)
+        self.decoder = Decoder(self.pipe.vae, self.tiny_vae, self.pipe.image_processor)
+        self.step_cache = StepCache(self.pipe.transformer)
         
+        # The largest offloaded component still has to fit next to the batch while it runs
+        self.batch_budget_gb = vram_budget_gb(reserved_gb=self.placement.offload_peak_bytes / GB)
         self.initialized = True
         
-    def generate(self, input_data):
-        """Generate an image based on the input and return as base64 string."""
+    def cache_key(self, input_data):
+        """Result-cache key for a seeded request, or None when the output isn't deterministic."""
+        if input_data.get("seed") is None:
+            return None
+        params = self._params(input_data)
+        params["prompt"] = normalize_prompt(params["prompt"])
+        params["negative_prompt"] = normalize_prompt(params["negative_prompt"])
+        params.update(params.pop("encode_options"))
+        return cache_key(self.MODEL_ID, params)
+
+    def encode_prompt(self, prompt):
+        """(prompt_embeds, pooled_prompt_embeds) for one prompt, from the LRU cache when possible.
+
+        Negative prompts go through the same encoders, so they are cached the
+        same way (the constant empty one is encoded once per worker).
+        """
+        key = PromptCache.key(self.MODEL_ID, prompt)
+        def encode():
+            prompt_embeds, _, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+                prompt=prompt,
+                prompt_2=None,
+                prompt_3=None,
+                do_classifier_free_guidance=False,
+            )
+            return prompt_embeds, pooled_prompt_embeds
+        return self.prompt_cache.get_or_encode(key, encode, device=self.pipe._execution_device)
+
+    def warmup(self, width, height, steps):
+        """One throwaway generation at this size, so kernels and allocator are primed; nothing is uploaded."""
         if not self.initialized:
             self.initialize()
-        
-        # Extract parameters from input data
-        prompt = input_data.get("prompt", "A photo of a cat")
-        negative_prompt = input_data.get("negative_prompt", "")
-        height = input_data.get("height", 768)
-        width = input_data.get("width", 768)
-        steps = input_data.get("num_inference_steps", 20)
-        guidance_scale = input_data.get("guidance_scale", 5.0)
-        img_format = input_data.get("image_format", "png")
-        if img_format not in ["png", "jpeg", "jpg"]:
-            raise ValueError("Invalid image format. Supported formats are 'png' and 'jpg'.")
-        
-        # Generate the image
-        image = self.pipe(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
+        prompt_embeds, pooled_prompt_embeds = self.encode_prompt("A photo of a cat")
+        negative_prompt_embeds, negative_pooled_prompt_embeds = self.encode_prompt("")
+        self.pipe(
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
             num_inference_steps=steps,
             height=height,
             width=width,
-            guidance_scale=guidance_scale,
-        ).images[0]
+            guidance_scale=5.0,
+            generator=torch.Generator("cpu").manual_seed(0),
+        )
+
+    def _params(self, input_data):
+        """Generation parameters for one request, with defaults applied."""
+        return {
+            "prompt": input_data.get("prompt", "A photo of a cat"),
+            "negative_prompt": input_data.get("negative_prompt", ""),
+            "height": input_data.get("height", 768),
+            "width": input_data.get("width", 768),
+            "steps": input_data.get("num_inference_steps", 20),
+            "guidance_scale": input_data.get("guidance_scale", 5.0),
+            "seed": input_data.get("seed", None),
+            "image_format": input_data.get("image_format", "png"),
+            "decode_quality": decode_quality(input_data, "fast"),
+            "step_cache": step_cache_threshold(input_data),
+            "early_exit": early_exit_tolerance(input_data),
+            "encode_options": image_options(input_data),
+        }
+
+    def batch_key(self, input_data):
+        """Requests with equal keys can share one batched pipeline call."""
+        params = self._params(input_data)
+        return (
+            params["height"],
+            params["width"],
+            params["steps"],
+            params["guidance_scale"],
+            params["decode_quality"],
+            params["step_cache"],
+            params["early_exit"],
+        )
+
+    def max_batch_size(self, height, width):
+        """Images of this size that fit into the VRAM left after loading the model."""
+        if not self.initialized:
+            self.initialize()
+        return batch_limit(self.batch_budget_gb, self.GB_PER_MEGAPIXEL, height, width)
+
+    def generate(self, input_data, on_preview=None, cancel=None, on_uploaded=None):
+        """Generate an image based on the input; returns its URL, the steps run and the steps the step cache skipped.
+
+        When on_preview is given it is called with a low-resolution preview
+        every `preview_every` denoising steps.
+        """
+        result = self.generate_batch([input_data], on_preview=on_preview, cancel=cancel, on_uploaded=[on_uploaded])[0]
+        if isinstance(result, JobCancelled):
+            raise result
+        return result
+
+    @release_on_cancel()
+    def generate_batch(self, inputs, on_preview=None, cancel=None, on_uploaded=None):
+        """Generate one image per input in a single pipeline call; returns (URL, steps run, skipped steps) per input.
+
+        All inputs must share a batch_key. Each sample gets its own generator,
+        so a seeded request produces the same image whether or not it was batched.
+        Raises JobCancelled as soon as `cancel` (a CancelToken) is cancelled:
+        checked on every denoising step, before decoding and before upload.
+        For a CancelGroup, each request's own token is checked before its
+        upload too; a cancelled request gets JobCancelled in place of its result.
+        on_uploaded, one callback (or None) per input, is called with the
+        input's URL once its image is actually in R2.
+        """
+        if not self.initialized:
+            self.initialize()
+        cancel = cancel or CancelToken()
+        cancel.check()
         
-        # Convert to base64
-        buffered = io.BytesIO()
-        now = datetime.now()
-        filename = f"gen-images/{now.month}/{now.day}/{generate(size=10)}/{uuid.uuid4()}.{img_format}"
+        # Extract parameters from input data
+        jobs = [self._params(input_data) for input_data in inputs]
+        height = jobs[0]["height"]
+        width = jobs[0]["width"]
+        steps = jobs[0]["steps"]
+        
+        # Set up per-sample generators if any seed is provided
+        generator = None
+        if any(job["seed"] is not None for job in jobs):
+            generator = []
+            for job in jobs:
+                sample_generator = torch.Generator("cpu")
+                if job["seed"] is not None:
+                    sample_generator.manual_seed(job["seed"])
+                else:
+                    sample_generator.seed()
+                generator.append(sample_generator)
         
+        # Object keys (and so the public URLs) are fixed before generation starts
+        now = datetime.now()
+        filenames = [
+            f"gen-images/{now.month}/{now.day}/{generate(size=10)}/{uuid.uuid4()}.{job['image_format']}"
+            for job in jobs
+        ]
         
-        if img_format == "png":
-            image.save(buffered, format="PNG")
-            content_type = "image/png"
-        elif img_format == "jpeg" or img_format == "jpg":
-            image.convert("RGB")
-            # Convert to RGB for JPEG
-            image.save(buffered, format="JPEG")
-            content_type = "image/jpeg"
+        # Low-resolution previews through the step-end callback
+        callback = None
+        if on_preview is not None:
+            preview_every, preview_size = preview_settings(inputs[0], default_every=5)
+            if preview_every:
+                def decode(pipe, latents):
+                    return tiny_vae_preview(self.tiny_vae, latents, preview_size)
+                callback = preview_callback(decode, steps, preview_every, on_preview)
         
+        # Text encoder outputs come from the prompt cache
+        embeds = [self.encode_prompt(job["prompt"]) for job in jobs]
+        negative_embeds = [self.encode_prompt(job["negative_prompt"]) for job in jobs]
+        print(f"Prompt cache: {self.prompt_cache.stats()}")
         
-        buffered.seek(0)
-        url = upload_to_r2(buffered.getvalue(), filename, content_type)
+        # Adaptive mode: stop once the prediction settles, within the requested steps
+        early_exit = EarlyExit(jobs[0]["early_exit"], steps) if jobs[0]["early_exit"] else None
         
-        # img_str = base64.b64encode(buffered.getvalue()).decode()
+        # Denoise (reusing the transformer's residual on steps the step cache
+        # skips), then decode the batch with the VAE chosen by decode_quality.
+        # Only a failure in the pipeline call has the batch retried one request at a time
+        with self.step_cache.run(jobs[0]["step_cache"], steps) as cached, denoising():
+            latents = self.pipe(
+                prompt_embeds=torch.cat([prompt_embeds for prompt_embeds, _ in embeds]),
+                pooled_prompt_embeds=torch.cat([pooled for _, pooled in embeds]),
+                negative_prompt_embeds=torch.cat([prompt_embeds for prompt_embeds, _ in negative_embeds]),
+                negative_pooled_prompt_embeds=torch.cat([pooled for _, pooled in negative_embeds]),
+                num_inference_steps=steps,
+                height=height,
+                width=width,
+                guidance_scale=jobs[0]["guidance_scale"],
+                generator=generator,
+                callback_on_step_end=chain_callbacks(cancel.step_callback, callback, early_exit),
+                output_type="latent",
+            ).images
+        if jobs[0]["step_cache"]:
+            print(f"Step cache: {cached.stats()}; total: {self.step_cache.stats()}")
+        steps_used = early_exit.steps_used if early_exit else steps
+        if early_exit:
+            print(f"Early exit: {early_exit.stats()}")
+        cancel.check()
+        images = self.decoder.decode(latents, jobs[0]["decode_quality"])
+        print(f"Decode: {self.decoder.stats()}")
+        cancel.check()
         
-        return url
\ No newline at end of file
+        # Encoded straight into R2, no intermediate BytesIO copy; nothing is
+        # uploaded for a request cancelled while the rest of its batch ran
+        tokens = cancel.tokens if isinstance(cancel, CancelGroup) else [cancel] * len(jobs)
+        on_uploaded = on_uploaded or [None] * len(jobs)
+        return [
+            JobCancelled(token.reason) if token.cancelled else (
+                submit_image(image, filename, job["image_format"], on_uploaded=notify, **job["encode_options"]),
+                steps_used,
+                cached.skipped,
+            )
+            for image, filename, job, token, notify in zip(images, filenames, jobs, tokens, on_uploaded)
+        ]
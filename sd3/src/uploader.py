@@ -0,0 +1,564 @@
+import atexit
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.client import Config
+from PIL import features
+
+# One S3 client per worker process. boto3 clients are thread-safe once built,
+# so every upload reuses the same credentials, endpoint resolution and
+# urllib3 connection pool instead of paying for a new TLS handshake per image.
+_client = None
+_client_lock = threading.Lock()
+
+
+def _client_config():
+    """Build the botocore config from the R2_* tuning env variables."""
+    return Config(
+        signature_version='s3v4',
+        max_pool_connections=int(os.getenv('R2_MAX_POOL_CONNECTIONS', '16')),
+        tcp_keepalive=os.getenv('R2_TCP_KEEPALIVE', '1') == '1',
+        connect_timeout=float(os.getenv('R2_CONNECT_TIMEOUT', '5')),
+        read_timeout=float(os.getenv('R2_READ_TIMEOUT', '60')),
+        retries={
+            'max_attempts': int(os.getenv('R2_MAX_ATTEMPTS', '3')),
+            'mode': 'standard',
+        },
+    )
+
+
+def get_r2_client():
+    """Return the shared R2 client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                session = boto3.session.Session()
+                _client = session.client(
+                    's3',
+                    region_name='auto',
+                    endpoint_url=os.getenv('R2_ENDPOINT_URL'),
+                    aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
+                    aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
+                    config=_client_config(),
+                )
+    return _client
+
+
+def reset_r2_client():
+    """Drop the shared client so the next upload rebuilds it (e.g. after rotating keys)."""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def public_url(filename):
+    return f"{os.getenv('PUBLIC_URL')}/{filename}"
+
+
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+# AVIF needs a Pillow build with libavif (the Pillow >= 11.2 wheels have it)
+if features.check("avif"):
+    IMAGE_FORMATS["avif"] = ("AVIF", "image/avif")
+
+SUPPORTED_FORMATS = list(IMAGE_FORMATS)
+
+
+def image_options(input_data):
+    """Validate a job's output format and encoder inputs, returning the encoder options.
+
+    quality (1-100) applies to jpeg, webp and avif, compress_level (0-9) to
+    png, and lossless switches webp to its lossless mode.
+    """
+    img_format = input_data.get("image_format", "png")
+    if img_format not in IMAGE_FORMATS:
+        raise ValueError(f"Invalid image format. Supported formats are {', '.join(SUPPORTED_FORMATS)}.")
+    quality = input_data.get("quality")
+    if quality is not None and (not isinstance(quality, int) or not 1 <= quality <= 100):
+        raise ValueError("Invalid quality. Must be an integer between 1 and 100.")
+    compress_level = input_data.get("compress_level")
+    if compress_level is not None and (not isinstance(compress_level, int) or not 0 <= compress_level <= 9):
+        raise ValueError("Invalid compress_level. Must be an integer between 0 and 9.")
+    return {
+        "quality": quality,
+        "compress_level": compress_level,
+        "lossless": bool(input_data.get("lossless", False)),
+    }
+
+
+def save_options(pil_format, quality=None, compress_level=None, lossless=False):
+    """PIL save() keyword arguments for the requested encoder options; unset ones keep PIL's defaults."""
+    options = {}
+    if pil_format == "PNG" and compress_level is not None:
+        options["compress_level"] = compress_level
+    if pil_format in ("JPEG", "WEBP", "AVIF") and quality is not None:
+        # For lossless webp, quality is the compression effort
+        options["quality"] = quality
+    if pil_format == "WEBP" and lossless:
+        options["lossless"] = True
+    return options
+
+
+def _object_args(filename, content_type):
+    expires_at = (datetime.utcnow() + timedelta(hours=24)).isoformat()
+    return {
+        "Bucket": os.getenv('R2_BUCKET_NAME'),
+        "Key": filename,
+        "ContentType": content_type,
+        "Metadata": {"expires-at": expires_at},
+        "ACL": 'public-read',
+    }
+
+
+# === Upload function ===
+def upload_to_r2(image_bytes, filename, content_type):
+    get_r2_client().put_object(Body=image_bytes, **_object_args(filename, content_type))
+    return public_url(filename)
+
+
+class StreamingUpload:
+    """Write-only file object that streams an encoder's output into R2.
+
+    Output smaller than R2_MULTIPART_THRESHOLD is sent with a single
+    put_object straight from the write buffer. Once the threshold is crossed
+    a multipart upload is started and every R2_MULTIPART_PART_SIZE bytes go
+    out as a part while the encoder is still running, so the full encoded
+    image is never held (or copied) in memory.
+    """
+
+    def __init__(self, filename, content_type):
+        self.filename = filename
+        self.content_type = content_type
+        self.threshold = int(os.getenv('R2_MULTIPART_THRESHOLD', str(5 * 1024 * 1024)))
+        # R2 and S3 reject non-final parts under 5 MiB
+        self.part_size = max(int(os.getenv('R2_MULTIPART_PART_SIZE', str(5 * 1024 * 1024))), 5 * 1024 * 1024)
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._client = get_r2_client()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        if self._upload_id is None and len(self._buffer) >= self.threshold:
+            response = self._client.create_multipart_upload(**_object_args(self.filename, self.content_type))
+            self._upload_id = response["UploadId"]
+        if self._upload_id is not None:
+            while len(self._buffer) >= self.part_size:
+                # Hand the buffer itself to upload_part and keep only the
+                # (small) overflow, instead of slicing out a copy of the part
+                part, self._buffer = self._buffer, self._buffer[self.part_size:]
+                del part[self.part_size:]
+                self._send_part(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Finish the upload once the encoder is done writing."""
+        if self._upload_id is None:
+            self._client.put_object(Body=self._buffer, **_object_args(self.filename, self.content_type))
+        else:
+            if self._buffer or not self._parts:
+                self._send_part(self._buffer)
+            self._client.complete_multipart_upload(
+                Bucket=os.getenv('R2_BUCKET_NAME'),
+                Key=self.filename,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        self._buffer = bytearray()
+
+    def abort(self):
+        if self._upload_id is not None:
+            self._client.abort_multipart_upload(
+                Bucket=os.getenv('R2_BUCKET_NAME'),
+                Key=self.filename,
+                UploadId=self._upload_id,
+            )
+        self._buffer = bytearray()
+
+    def _send_part(self, body):
+        part_number = len(self._parts) + 1
+        response = self._client.upload_part(
+            Bucket=os.getenv('R2_BUCKET_NAME'),
+            Key=self.filename,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+
+def encode_image(image, fp, img_format, **options):
+    """Encode a PIL image into a path or file object; returns the content type."""
+    pil_format, content_type = IMAGE_FORMATS[img_format]
+    if pil_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(fp, format=pil_format, **save_options(pil_format, **options))
+    return content_type
+
+
+def upload_image(image, filename, img_format, **options):
+    """Encode a PIL image directly into R2 and return its public URL."""
+    stream = StreamingUpload(filename, IMAGE_FORMATS[img_format][1])
+    try:
+        encode_image(image, stream, img_format, **options)
+        stream.close()
+    except Exception:
+        stream.abort()
+        raise
+    return public_url(filename)
+
+
+def _default_spool_dir():
+    # A network volume outlives the container; fall back to local disk
+    if os.path.isdir("/runpod-volume"):
+        return "/runpod-volume/r2-spool"
+    return "/tmp/r2-spool"
+
+
+class UploadSpool:
+    """On-disk queue of failed uploads, retried in the background.
+
+    Each entry is the encoded image (<id>.bin) plus a JSON record with the
+    object key, content type, attempt count and next retry time, so pending
+    uploads survive a handler restart and are picked up again by start().
+    Retries back off exponentially with full jitter; entries older than the
+    24 h object expiry are dropped.
+
+    Workers can share the directory (a network volume): an entry is claimed
+    by atomically renaming its record before it is uploaded or dropped, so
+    only one worker handles it, and an entry gone missing was taken by
+    another. Claims older than R2_SPOOL_CLAIM_SECONDS, left by a worker that
+    died mid-upload, are released again.
+    """
+
+    def __init__(self, directory=None, base_delay=None, max_delay=None, max_age=None, claim_timeout=None):
+        self.directory = directory or os.getenv('R2_SPOOL_DIR') or _default_spool_dir()
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv('R2_RETRY_BASE_SECONDS', '2'))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('R2_RETRY_MAX_SECONDS', '300'))
+        self.max_age = max_age if max_age is not None else float(os.getenv('R2_SPOOL_MAX_AGE_HOURS', '24')) * 3600
+        self.claim_timeout = claim_timeout if claim_timeout is not None else float(os.getenv('R2_SPOOL_CLAIM_SECONDS', '600'))
+        self.worker = os.getenv('RUNPOD_POD_ID') or uuid.uuid4().hex[:12]
+        self.retried = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, image, filename, img_format, **options):
+        """Encode `image` into the spool and schedule its upload."""
+        os.makedirs(self.directory, exist_ok=True)
+        entry_id = uuid.uuid4().hex
+        content_type = encode_image(image, self._data_path(entry_id), img_format, **options)
+        now = time.time()
+        self._write_record(entry_id, {
+            "filename": filename,
+            "content_type": content_type,
+            "attempts": 0,
+            "created": now,
+            "next_attempt": now,
+        })
+        self.start()
+        self._wake.set()
+
+    def pending(self):
+        if not os.path.isdir(self.directory):
+            return 0
+        return sum(1 for name in os.listdir(self.directory) if name.endswith((".json", ".claim")))
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="r2-spool-retry", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def retry_due(self):
+        """Try every entry whose backoff has elapsed; returns when the next one is due (or None)."""
+        if not os.path.isdir(self.directory):
+            return None
+        next_due = None
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".claim"):
+                self._release_stale_claim(name)
+                continue
+            if not name.endswith(".json"):
+                continue
+            entry_id = name[:-len(".json")]
+            record = self._read_record(os.path.join(self.directory, name))
+            if record is None:
+                continue
+            now = time.time()
+            expired = now - record["created"] > self.max_age
+            if not expired and record["next_attempt"] > now:
+                next_due = min(next_due or record["next_attempt"], record["next_attempt"])
+                continue
+            claim = self._claim(entry_id)
+            # Another worker took the entry since it was listed
+            record = self._read_record(claim) if claim else None
+            if record is None:
+                continue
+            if expired:
+                print(f"Dropping spooled upload of {record['filename']}: older than the object expiry")
+                self._remove(entry_id, claim)
+                self.dropped += 1
+                continue
+            try:
+                with open(self._data_path(entry_id), "rb") as body:
+                    upload_to_r2(body, record["filename"], record["content_type"])
+            except FileNotFoundError:
+                # Its image is gone (removed by a worker that uploaded it): nothing left to retry
+                self._remove(entry_id, claim)
+            except Exception as e:
+                record["attempts"] += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** record["attempts"]))
+                record["next_attempt"] = time.time() + delay
+                self._write_record(entry_id, record)
+                _unlink(claim)
+                next_due = min(next_due or record["next_attempt"], record["next_attempt"])
+                print(f"Retry {record['attempts']} of {record['filename']} failed: {e}; next in {delay:.1f}s")
+            else:
+                self._remove(entry_id, claim)
+                self.retried += 1
+                print(f"Uploaded spooled {record['filename']} after {record['attempts'] + 1} attempts")
+        return next_due
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                next_due = self.retry_due()
+            except Exception as e:
+                # Keep the thread alive: a bad pass must not stop every later retry
+                print(f"Upload spool retry pass failed: {e}")
+                next_due = None
+            timeout = 60 if next_due is None else max(0.05, next_due - time.time())
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _data_path(self, entry_id):
+        return os.path.join(self.directory, f"{entry_id}.bin")
+
+    def _write_record(self, entry_id, record):
+        path = os.path.join(self.directory, f"{entry_id}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(record, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _read_record(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _claim(self, entry_id):
+        """Renames the entry's record to a claim of this worker; None if another worker got there first."""
+        claim = os.path.join(self.directory, f"{entry_id}.{int(time.time())}.{self.worker}.claim")
+        try:
+            os.rename(os.path.join(self.directory, f"{entry_id}.json"), claim)
+        except FileNotFoundError:
+            return None
+        return claim
+
+    def _release_stale_claim(self, name):
+        entry_id, claimed = name.split(".")[:2]
+        if time.time() - int(claimed) > self.claim_timeout:
+            try:
+                os.rename(os.path.join(self.directory, name), os.path.join(self.directory, f"{entry_id}.json"))
+            except FileNotFoundError:
+                pass
+
+    def _remove(self, entry_id, claim):
+        _unlink(claim)
+        _unlink(self._data_path(entry_id))
+
+
+def _unlink(path):
+    # Already removed by whichever worker handled the entry
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+spool = UploadSpool()
+
+
+def upload_or_spool(image, filename, img_format, **options):
+    """Upload an image, spooling it for background retries if R2 is unavailable.
+
+    Returns (public_url, uploaded). The URL is the same either way, it just
+    may not resolve until the spooled upload goes through.
+    """
+    try:
+        return upload_image(image, filename, img_format, **options), True
+    except Exception as e:
+        print(f"Upload of {filename} failed ({e}), spooling for retry")
+        spool.add(image, filename, img_format, **options)
+        return public_url(filename), False
+
+
+_upload_pool = None
+
+
+def upload_images(images, filenames, img_format, **options):
+    """Encode and upload several images concurrently.
+
+    Unlike submit_image this waits for every upload. Returns the URLs in
+    order and whether all of them were uploaded (False means some are
+    spooled and still pending).
+    """
+    global _upload_pool
+    with _client_lock:
+        if _upload_pool is None:
+            _upload_pool = ThreadPoolExecutor(
+                max_workers=int(os.getenv('R2_UPLOAD_WORKERS', '4')),
+                thread_name_prefix="r2-encode",
+            )
+    futures = [
+        _upload_pool.submit(upload_or_spool, image, filename, img_format, **options)
+        for image, filename in zip(images, filenames)
+    ]
+    results = [future.result() for future in futures]
+    return [url for url, _ in results], all(uploaded for _, uploaded in results)
+
+
+class UploadQueue:
+    """Bounded queue of generated images drained by background upload threads.
+
+    submit() returns the public URL straight away, so the caller can hand the
+    result back and start the next generation while encoding and the upload
+    round trip happen here. A full queue blocks submit(), which keeps memory
+    bounded. on_uploaded(url) is called from the upload thread once the
+    object is actually in R2, never for an upload that was spooled or failed.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or int(os.getenv('R2_UPLOAD_WORKERS', '4'))
+        max_pending = max_pending or int(os.getenv('R2_UPLOAD_QUEUE_SIZE', '32'))
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self.uploaded = 0
+        self.spooled = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._drain, name=f"r2-upload-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, image, filename, img_format, on_uploaded=None, **options):
+        """Accept an image for encoding and upload and return its public URL."""
+        if self._closed:
+            raise RuntimeError("Upload queue is shut down")
+        self.start()
+        self._queue.put((image, filename, img_format, on_uploaded, options))
+        return public_url(filename)
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def flush(self):
+        """Block until every accepted image has been uploaded or spooled."""
+        self._queue.join()
+
+    def shutdown(self):
+        """Stop accepting work, drain everything already accepted, stop the threads."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        self.flush()
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                image, filename, img_format, on_uploaded, options = item
+                try:
+                    url, uploaded = upload_or_spool(image, filename, img_format, **options)
+                    with self._lock:
+                        if uploaded:
+                            self.uploaded += 1
+                        else:
+                            self.spooled += 1
+                except Exception as e:
+                    with self._lock:
+                        self.failed += 1
+                    print(f"Background upload of {filename} failed and could not be spooled: {e}")
+                    continue
+                if uploaded and on_uploaded is not None:
+                    _notify(on_uploaded, url)
+            finally:
+                self._queue.task_done()
+
+
+def _notify(on_uploaded, url):
+    try:
+        on_uploaded(url)
+    except Exception as e:
+        print(f"Upload callback for {url} failed: {e}")
+
+
+upload_queue = UploadQueue()
+
+
+def submit_image(image, filename, img_format, on_uploaded=None, **options):
+    """Upload in the background when R2_ASYNC_UPLOAD is on (default), otherwise inline.
+
+    In the background case encoding also happens on the upload threads, off
+    the generation path. Either way on_uploaded(url) is only called once the
+    object is in R2 (e.g. to cache the URL), not when the upload was spooled.
+    """
+    if os.getenv('R2_ASYNC_UPLOAD', '1') == '1':
+        return upload_queue.submit(image, filename, img_format, on_uploaded=on_uploaded, **options)
+    url, uploaded = upload_or_spool(image, filename, img_format, **options)
+    if uploaded and on_uploaded is not None:
+        _notify(on_uploaded, url)
+    return url
+
+
+# Pick up uploads spooled by a previous run of this worker
+if spool.pending():
+    spool.start()
+
+# Flush at interpreter exit so no accepted image is lost. runpod's own
+# SIGTERM handler ends the worker loop, and the process then exits normally.
+atexit.register(upload_queue.shutdown)
@@ -1,5 +1,5 @@
 import torch
-from diffusers import StableDiffusionXLPipeline
+from diffusers import StableDiffusionXLImg2ImgPipeline, StableDiffusionXLPipeline
 
 
 def fetch_pretrained_model(model_class, model_name, **kwargs):
@@ -40,9 +40,21 @@ def download_model_weights():
     )
     
     print("✓ SDXL base model downloaded successfully")
+
+    # The refiner's second text encoder and VAE are the base's; passing them
+    # skips downloading a second copy
+    refiner = fetch_pretrained_model(
+        StableDiffusionXLImg2ImgPipeline,
+        "stabilityai/stable-diffusion-xl-refiner-1.0",
+        text_encoder_2=pipe.text_encoder_2,
+        vae=pipe.vae,
+        **common_args,
+    )
+
+    print("✓ SDXL refiner downloaded successfully")
     
     # Clean up to save space during build
-    del pipe
+    del pipe, refiner
     torch.cuda.empty_cache() if torch.cuda.is_available() else None
     
     print("✓ Model weights cached for runtime use")
@@ -1,27 +1,60 @@
 import os
-import io
 import time
 
 import torch
-from diffusers import StableDiffusionXLPipeline
+from diffusers import StableDiffusionXLImg2ImgPipeline, StableDiffusionXLPipeline
 
 
 import runpod
 from runpod.serverless.utils.rp_validator import validate
-from utils import upload_to_r2
+from uploader import image_options, upload_images
 import uuid
 from nanoid import generate
 from datetime import datetime
 from utils import calculate_cost
 from schemas import INPUT_SCHEMA
+from result_cache import ResultCache, cache_key, normalize_prompt
+from placement import place_pipeline
+from warmup import warmup_buckets
+from torch_compile import compile_enabled, compile_with_warmup
+from decode import GB_PER_MEGAPIXEL, apply_decode_plan, free_decode_bytes, plan_decode
+from schedulers import SCHEDULERS, SchedulerRegistry
+from image_fetch import ByteLRU, ImageFetchError, ImageFetcher, image_latents
+from cancellation import CANCELLED, CancelToken, CancelWatcher, JobCancelled, job_deadline, release_memory
 
 torch.cuda.empty_cache()
 
+MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+REFINER_ID = "stabilityai/stable-diffusion-xl-refiner-1.0"
+
+# num_images budgets are measured at this size and scaled by pixel count
+BUDGET_RESOLUTION = 1024 * 1024
+
+# Inputs that change the generated images, and so key the result cache
+# (prompts and the img2img input are added normalized)
+RESULT_KEY_FIELDS = (
+    "height", "width", "seed", "scheduler", "num_inference_steps", "guidance", "num_images", "high_noise_frac",
+    "image_format", "quality", "compress_level", "lossless",
+)
+
 
 class SimpleModelHandler:
-    def __init__(self):
-        self.pipeline = None
-        self.load_model()
+    """The SDXL base (and refiner) pipelines, loaded from the image unless given."""
+
+    def __init__(self, pipeline=None, refiner=None):
+        self.pipeline = pipeline
+        self.refiner = refiner
+        self.placement = None
+        self.schedulers = SchedulerRegistry(pipeline.scheduler.config) if pipeline else None
+        # VAE latents of img2img inputs, so edits of the same image skip the encode
+        self.latent_cache = ByteLRU(int(float(os.getenv("LATENT_CACHE_MB", "256")) * 2**20))
+        self.max_images = 1
+        self.images_cap = int(os.getenv("SDXL_MAX_IMAGES", "8"))
+        if pipeline is None:
+            self.load_model()
+        if compile_enabled():
+            compile_with_warmup(self.pipeline.unet, self.warmup, warmup_buckets(default="1024x1024x2"))
+        self.measure_image_budget()
 
     def load_model(self):
         """Load SDXL pipeline for text-to-image generation"""
@@ -29,12 +62,36 @@ class SimpleModelHandler:
         start_time = time.time()
         
         self.pipeline = StableDiffusionXLPipeline.from_pretrained(
-            "stabilityai/stable-diffusion-xl-base-1.0", 
+            MODEL_ID,
             torch_dtype=torch.bfloat16,
             local_files_only=True,
             use_safetensors=True,
             add_watermarker=False,
-        ).to("cuda")
+        )
+        self.schedulers = SchedulerRegistry(self.pipeline.scheduler.config)
+        
+        # The refiner reuses the base's second text encoder and VAE (the same
+        # weights), so only its UNet is an extra copy in memory
+        if os.getenv("SDXL_REFINER", "1") == "1":
+            self.refiner = StableDiffusionXLImg2ImgPipeline.from_pretrained(
+                REFINER_ID,
+                text_encoder_2=self.pipeline.text_encoder_2,
+                vae=self.pipeline.vae,
+                torch_dtype=torch.bfloat16,
+                local_files_only=True,
+                use_safetensors=True,
+                add_watermarker=False,
+            )
+        
+        # Keep as much resident as the card allows; offload only what doesn't fit
+        self.placement = place_pipeline(
+            self.pipeline,
+            working_gb=4,
+            priority=("unet", "vae", "refiner_unet", "text_encoder", "text_encoder_2"),
+            denoiser="unet",
+            steps=INPUT_SCHEMA["num_inference_steps"]["default"],
+            extra={"refiner_unet": self.refiner.unet} if self.refiner else None,
+        )
         
         # # Enable memory efficient attention
         # self.pipeline.enable_xformers_memory_efficient_attention()
@@ -42,8 +99,90 @@ class SimpleModelHandler:
         load_time = time.time() - start_time
         print(f"Model loaded in {load_time:.2f} seconds")
 
+    @torch.inference_mode()
+    def warmup(self, width, height, steps):
+        """One throwaway generation at this size, so kernels (and the compiled UNet) are primed."""
+        self.pipeline(
+            prompt="warmup",
+            height=height,
+            width=width,
+            num_inference_steps=steps,
+            generator=torch.Generator("cpu").manual_seed(0),
+        )
+
+    def pipeline_for(self, scheduler, img2img=False, refiner=False):
+        """The loaded pipeline (img2img, or the refiner) with its own copy of the named scheduler; the model weights are shared, not copied."""
+        pipeline_class = StableDiffusionXLImg2ImgPipeline if img2img or refiner else StableDiffusionXLPipeline
+        return pipeline_class.from_pipe(
+            self.refiner if refiner else self.pipeline,
+            scheduler=self.schedulers.get(scheduler),
+            torch_dtype=torch.bfloat16,
+        )
+
+    @torch.inference_mode()
+    def probe(self, num_images, size=1024):
+        """One generation of num_images at size x size with a single step per UNet.
+
+        With the refiner loaded it runs the ensemble of experts, base then
+        refiner, so the probe peaks where a high_noise_frac request would.
+        """
+        if self.refiner is None:
+            self.pipeline(
+                prompt="vram probe", height=size, width=size, num_inference_steps=1, num_images_per_prompt=num_images,
+            )
+            return
+        latents = self.pipeline(
+            prompt="vram probe", height=size, width=size, num_inference_steps=2, num_images_per_prompt=num_images,
+            denoising_end=0.5, output_type="latent",
+        ).images
+        self.refiner(
+            prompt="vram probe", image=latents, num_inference_steps=2, num_images_per_prompt=num_images,
+            denoising_start=0.5,
+        )
+
+    @torch.inference_mode()
+    def measure_image_budget(self):
+        """Measure peak VRAM for one and two 1024x1024 images and derive the num_images ceiling.
+
+        The difference between the two probe runs is the marginal cost of one
+        more image in the batch (latents, attention activations of both UNets
+        and the VAE decode); whatever VRAM is left after the one-image peak,
+        minus a safety margin, is divided by it.
+        """
+        if os.getenv("SDXL_MEASURE_VRAM", "1") != "1" or not torch.cuda.is_available():
+            self.max_images = int(os.getenv("SDXL_DEFAULT_MAX_IMAGES", "2"))
+            return
+
+        peaks = []
+        for num_images in (1, 2):
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+            self.probe(num_images)
+            peaks.append(torch.cuda.max_memory_allocated())
+        torch.cuda.empty_cache()
 
-MODELS = SimpleModelHandler()
+        per_image = max(peaks[1] - peaks[0], 1)
+        total = torch.cuda.get_device_properties(0).total_memory
+        margin = float(os.getenv("SDXL_VRAM_MARGIN_GB", "2")) * 1024 ** 3
+        headroom = total - margin - peaks[0]
+        self.max_images = max(1, min(self.images_cap, 1 + int(headroom // per_image)))
+        print(
+            f"VRAM per extra 1024x1024 image: {per_image / 1024 ** 3:.2f} GB, "
+            f"one-image peak {peaks[0] / 1024 ** 3:.2f} GB -> num_images <= {self.max_images}"
+        )
+
+    def images_allowed(self, width, height):
+        """num_images ceiling for a resolution, scaling the 1024x1024 budget by pixel count."""
+        return max(1, min(self.images_cap, int(self.max_images * BUDGET_RESOLUTION / (width * height))))
+
+
+# Loaded when the worker starts (see the bottom of this file)
+MODELS = None
+RESULT_CACHE = ResultCache()
+# img2img inputs: pooled downloads, decoded images cached by URL and ETag
+FETCHER = ImageFetcher()
+# Cancels the token of a running job once it is cancelled upstream (CANCEL_POLL_SECONDS)
+WATCHER = CancelWatcher()
 
 
 @torch.inference_mode()
@@ -51,7 +190,6 @@ def generate_image(job):
     """Generate image from text prompt"""
     
     job_input = job["input"]
-    img_format = job_input.get("image_format", "png")
 
     # Input validation
     validated_input = validate(job_input, INPUT_SCHEMA)
@@ -59,64 +197,175 @@ def generate_image(job):
         return {"error": validated_input["errors"]}
     
     job_input = validated_input["validated_input"]
+    img_format = job_input["image_format"]
+
+    # rp_validator skips constraints for values matching the default's type,
+    # so the format is checked explicitly
+    try:
+        image_options(job_input)
+    except ValueError as err:
+        return {"error": str(err)}
+    if job_input["scheduler"] not in SCHEDULERS:
+        return {"error": f"scheduler must be one of {', '.join(SCHEDULERS)}"}
+    high_noise_frac = job_input["high_noise_frac"]
+    if high_noise_frac is not None:
+        if not 0 < high_noise_frac < 1:
+            return {"error": "high_noise_frac must be between 0 and 1"}
+        if MODELS.refiner is None:
+            return {"error": "high_noise_frac needs the refiner, which this worker doesn't load (SDXL_REFINER=0)"}
+    num_images = job_input["num_images"]
+    images_allowed = MODELS.images_allowed(job_input["width"], job_input["height"])
+    if not 0 < num_images <= images_allowed:
+        return {"error": f"num_images must be between 1 and {images_allowed} at {job_input['width']}x{job_input['height']}"}
+
+    source = None
+    if job_input["image_url"]:
+        if not 0 < job_input["strength"] <= 1:
+            return {"error": "strength must be between 0 and 1"}
+        try:
+            source = FETCHER.fetch_sync(job_input["image_url"])
+        except ImageFetchError as err:
+            return {"error": str(err)}
+        print(f"Image fetch: {FETCHER.stats()}")
+
+    # Seeded requests are deterministic: reuse the URLs of an identical earlier job
+    result_key = None
+    if job_input["seed"] is not None and RESULT_CACHE.enabled:
+        result_key = cache_key(MODEL_ID, {
+            **{name: job_input[name] for name in RESULT_KEY_FIELDS},
+            "prompt": normalize_prompt(job_input["prompt"]),
+            "negative_prompt": normalize_prompt(job_input["negative_prompt"]),
+            # The input's content, not just its URL
+            "image": list(source.key) if source else None,
+            "strength": job_input["strength"] if source else None,
+        })
+        cached_urls = RESULT_CACHE.get(result_key)
+        print(f"Result cache: {RESULT_CACHE.stats()}")
+        if cached_urls:
+            return {
+                "image_url": cached_urls[0],
+                "image_urls": cached_urls,
+                "generation_time": "0.00s",
+                "cost": calculate_cost(num_images),
+                "seed": job_input["seed"],
+                "cached": True,
+            }
 
     # Set random seed if not provided
     if job_input["seed"] is None:
         job_input["seed"] = int.from_bytes(os.urandom(2), "big")
 
     # Setup generator
-    generator = torch.Generator("cuda").manual_seed(job_input["seed"])
+    generator = torch.Generator("cuda" if torch.cuda.is_available() else "cpu").manual_seed(job_input["seed"])
+    # The `deadline` input, else JOB_TIMEOUT_SECONDS from now
+    token = CancelToken(job_deadline(job_input))
 
     # Generate image
     try:
         start_time = time.time()
+
+        # Decode the whole batch, one image at a time or in tiles, whichever fits
+        # next to the resident UNet; the pipeline's own VAE decode reads these flags
+        decode_plan = plan_decode(
+            num_images, job_input["height"], job_input["width"], GB_PER_MEGAPIXEL["full"], free_decode_bytes()
+        )
+        apply_decode_plan(MODELS.pipeline.vae, *decode_plan)
+        print(f"Decode strategy: {decode_plan[0]}")
         
-        images = MODELS.pipeline(
-            prompt=job_input["prompt"],
-            negative_prompt=job_input.get("negative_prompt", ""),
-            height=job_input.get("height", 1024),
-            width=job_input.get("width", 1024),
-            num_inference_steps=job_input.get("num_inference_steps", 30),
-            guidance_scale=job_input.get("guidance", 7.5),
-            num_images_per_prompt=job_input.get("num_images", 1),
-            generator=generator,
-        ).images
+        # A private scheduler per job, so no stepping state is shared between requests
+        pipeline = MODELS.pipeline_for(job_input["scheduler"], img2img=source is not None)
+        if source is None:
+            inputs = {"height": job_input["height"], "width": job_input["width"]}
+        else:
+            # Starts from the input image's latents, cached across edits of the same image
+            inputs = {
+                "image": image_latents(
+                    MODELS.pipeline.vae, MODELS.pipeline.image_processor, source,
+                    job_input["height"], job_input["width"],
+                    device=pipeline._execution_device, cache=MODELS.latent_cache,
+                ),
+                "strength": job_input["strength"],
+            }
+            print(f"Latent cache: {MODELS.latent_cache.stats()}")
+        # Checked on every denoising step, so a cancelled job or one past its
+        # deadline stops there; the last check runs right before the VAE decode
+        with WATCHER.watch(job.get("id"), token):
+            images = pipeline(
+                **inputs,
+                prompt=job_input["prompt"],
+                negative_prompt=job_input.get("negative_prompt", ""),
+                num_inference_steps=job_input.get("num_inference_steps", 30),
+                guidance_scale=job_input.get("guidance", 7.5),
+                num_images_per_prompt=num_images,
+                generator=generator,
+                # Ensemble of experts: the base stops at high_noise_frac of the
+                # schedule and hands its latents to the refiner, which finishes it
+                denoising_end=high_noise_frac,
+                output_type="pil" if high_noise_frac is None else "latent",
+                callback_on_step_end=token.step_callback,
+            ).images
+            if high_noise_frac is not None:
+                images = MODELS.pipeline_for(job_input["scheduler"], refiner=True)(
+                    prompt=job_input["prompt"],
+                    negative_prompt=job_input.get("negative_prompt", ""),
+                    image=images,
+                    num_inference_steps=job_input.get("num_inference_steps", 30),
+                    denoising_start=high_noise_frac,
+                    guidance_scale=job_input.get("guidance", 7.5),
+                    num_images_per_prompt=num_images,
+                    generator=generator,
+                    callback_on_step_end=token.step_callback,
+                ).images
+        # Nothing is uploaded for a job that was cancelled while it decoded
+        token.check()
 
         generation_time = time.time() - start_time
         print(f"Image generated in {generation_time:.2f} seconds")
 
+    except JobCancelled as err:
+        # Free the interrupted job's activations now, not when the next job allocates
+        release_memory(err)
+        return {
+            "status": CANCELLED,
+            "message": str(err),
+        }
     except RuntimeError as err:
         return {
             "error": f"Generation failed: {err}",
             "refresh_worker": True,
         }
 
-    # Save and upload image
+    # Encode and upload every image concurrently
     try:
-        img = images[0]
-        buffered = io.BytesIO()
-        
-        # Generate filename
         now = datetime.now()
-        filename = f"gen-images/{now.month}/{now.day}/{generate(size=10)}/{uuid.uuid4()}.{img_format}"
-        
-        # Save with format
-        if img_format == "png":
-            img.save(buffered, format="PNG")
-            content_type = "image/png"
-        elif img_format in ["jpeg", "jpg"]:
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            img.save(buffered, format="JPEG", quality=95)
-            content_type = "image/jpeg"
+        filenames = [
+            f"gen-images/{now.month}/{now.day}/{generate(size=10)}/{uuid.uuid4()}.{img_format}"
+            for _ in images
+        ]
         
-        buffered.seek(0)
-        url = upload_to_r2(buffered.getvalue(), filename, content_type)
+        quality = job_input["quality"]
+        if quality is None and img_format in ["jpeg", "jpg"]:
+            quality = 95
+        # A failed upload is spooled and retried in the background; the URLs
+        # stay valid and the client sees upload_status "pending"
+        urls, uploaded = upload_images(
+            images,
+            filenames,
+            img_format,
+            quality=quality,
+            compress_level=job_input["compress_level"],
+            lossless=job_input["lossless"],
+        )
+        # Spooled URLs don't resolve yet, so only a fully uploaded result is cached
+        if result_key and uploaded:
+            RESULT_CACHE.put(result_key, urls)
         
         return {
-            "image_url": url,
+            "image_url": urls[0],
+            "image_urls": urls,
+            "upload_status": "uploaded" if uploaded else "pending",
             "generation_time": f"{generation_time:.2f}s",
-            "cost": calculate_cost(job_input.get("num_images", 1)),
+            "cost": calculate_cost(len(urls)),
             "seed": job_input["seed"]
         }
 
@@ -124,4 +373,6 @@ def generate_image(job):
         return {"error": f"Upload failed: {err}"}
 
 
-runpod.serverless.start({"handler": generate_image})
\ No newline at end of file
+if __name__ == "__main__":
+    MODELS = SimpleModelHandler()
+    runpod.serverless.start({"handler": generate_image})
\ No newline at end of file
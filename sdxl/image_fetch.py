@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import torch
+from PIL import Image
+
+
+class ImageFetchError(ValueError):
+    """The input image could not be downloaded or decoded."""
+
+
+def public_address(host):
+    """True for an IP address on the public internet: not private, loopback, link-local (cloud metadata) or reserved."""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+class PublicResolver(aiohttp.abc.AbstractResolver):
+    """Resolves a hostname to its public addresses only, so no name can point the fetcher at internal services.
+
+    The connection goes to an address checked here, so a name that
+    re-resolves to a private one between checks (DNS rebinding) is caught too.
+    """
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addresses = [a for a in await self._resolver.resolve(host, port, family) if public_address(a["host"])]
+        if not addresses:
+            raise socket.gaierror(socket.EAI_NONAME, f"{host} does not resolve to a public address")
+        return addresses
+
+    async def close(self):
+        await self._resolver.close()
+
+
+async def _reject_private_ip(request, handler):
+    # IP literals skip the resolver: a client middleware sees every request, redirects included
+    host = request.url.host or ""
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        pass  # a hostname: PublicResolver checks what it resolves to
+    else:
+        if not public_address(host):
+            raise ImageFetchError(f"image_url points to a non-public address ({host})")
+    return await handler(request)
+
+
+class ByteLRU:
+    """Thread-safe LRU whose entries are evicted once their total size exceeds max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+@torch.no_grad()
+def image_latents(vae, image_processor, source, height, width, device, cache=None):
+    """VAE latents of a FetchedImage at height x width, scaled and shifted the way img2img pipelines take them.
+
+    The distribution's mode is used rather than a sample, so latents are a
+    function of the image alone and can be cached: `cache` (a ByteLRU) keeps
+    them on the CPU by content key and size.
+    """
+    key = (source.key, height, width)
+    latents = cache.get(key) if cache is not None else None
+    if latents is None:
+        pixels = image_processor.preprocess(source.image, height=height, width=width)
+        latents = vae.encode(pixels.to(device, vae.dtype)).latent_dist.mode()
+        latents = (latents - (getattr(vae.config, "shift_factor", None) or 0.0)) * vae.config.scaling_factor
+        if cache is not None:
+            cache.put(key, latents.cpu(), latents.numel() * latents.element_size())
+    return latents.to(device)
+
+
+class FetchedImage:
+    """A decoded RGB input image. `key` identifies its content: URL and ETag, else a digest of the bytes."""
+
+    def __init__(self, image, key, cached):
+        self.image = image
+        self.key = key
+        self.cached = cached
+
+
+class ImageFetcher:
+    """Downloads input images (img2img) through one pooled aiohttp session.
+
+    The session lives on its own event loop thread, so fetch() can be
+    awaited from any loop and fetch_sync() called from sync handlers.
+    Downloads are capped at IMAGE_FETCH_MAX_MB (default 20) and
+    IMAGE_FETCH_TIMEOUT seconds (default 15), images at
+    IMAGE_FETCH_MAX_PIXELS (default 4096x4096), and decoding runs on a
+    thread pool, off the event loop. Only public addresses are fetched, also
+    after redirects: hosts resolving to private, loopback or link-local
+    addresses (e.g. cloud metadata) are rejected, unless
+    IMAGE_FETCH_ALLOW_PRIVATE=1 (sources inside a private network).
+
+    Decoded images are kept in an LRU of IMAGE_CACHE_MB (default 256) keyed
+    by URL. A cached image with an ETag is revalidated with If-None-Match,
+    so an unchanged source costs a 304 and no download or decode.
+    """
+
+    def __init__(self, max_bytes=None, timeout=None, max_pixels=None, connections=None, cache_bytes=None, allow_private=None):
+        self.max_bytes = max_bytes or int(float(os.getenv("IMAGE_FETCH_MAX_MB", "20")) * 2**20)
+        self.timeout = timeout or float(os.getenv("IMAGE_FETCH_TIMEOUT", "15"))
+        self.max_pixels = max_pixels or int(os.getenv("IMAGE_FETCH_MAX_PIXELS", str(4096 * 4096)))
+        self.connections = connections or int(os.getenv("IMAGE_FETCH_CONNECTIONS", "16"))
+        self.cache = ByteLRU(cache_bytes or int(float(os.getenv("IMAGE_CACHE_MB", "256")) * 2**20))
+        if allow_private is None:
+            allow_private = os.getenv("IMAGE_FETCH_ALLOW_PRIVATE", "0") == "1"
+        self.allow_private = allow_private
+        self.downloads = 0
+        self.revalidated = 0
+        self.bytes_downloaded = 0
+        self._decode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-decode")
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="image-fetch", daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    async def fetch(self, url):
+        """The image at `url` as a FetchedImage; raises ImageFetchError."""
+        future = asyncio.run_coroutine_threadsafe(self._fetch(url), self._start())
+        return await asyncio.wrap_future(future)
+
+    def fetch_sync(self, url):
+        return asyncio.run_coroutine_threadsafe(self._fetch(url), self._start()).result()
+
+    async def _fetch(self, url):
+        if not url.startswith(("http://", "https://")):
+            raise ImageFetchError("image_url must be an http(s) URL")
+        if self._session is None:
+            private = self.allow_private
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections, resolver=None if private else PublicResolver()),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                middlewares=() if private else (_reject_private_ip,),
+            )
+        cached = self.cache.get(url)
+        headers = {"If-None-Match": cached.key[1]} if cached is not None else {}
+        try:
+            async with self._session.get(url, headers=headers) as response:
+                if response.status == 304 and cached is not None:
+                    self.revalidated += 1
+                    return FetchedImage(cached.image, cached.key, cached=True)
+                if response.status != 200:
+                    raise ImageFetchError(f"Could not fetch image_url: HTTP {response.status}")
+                if (response.content_length or 0) > self.max_bytes:
+                    raise ImageFetchError(f"image_url is larger than {self.max_bytes / 2**20:g} MB")
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(2**16):
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        raise ImageFetchError(f"image_url is larger than {self.max_bytes / 2**20:g} MB")
+                etag = response.headers.get("ETag")
+        except asyncio.TimeoutError:
+            raise ImageFetchError(f"Timed out fetching image_url after {self.timeout:g}s") from None
+        except aiohttp.ClientError as e:
+            raise ImageFetchError(f"Could not fetch image_url: {e}") from None
+        self.downloads += 1
+        self.bytes_downloaded += len(data)
+        image = await asyncio.get_running_loop().run_in_executor(self._decode_pool, self._decode, bytes(data))
+        key = (url, etag) if etag else ("sha256", hashlib.sha256(data).hexdigest())
+        fetched = FetchedImage(image, key, cached=False)
+        if etag:
+            # Without a validator a changed source can't be detected, so it isn't kept
+            self.cache.put(url, fetched, image.width * image.height * 3)
+        return fetched
+
+    def _decode(self, data):
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                # Checked from the header, before the pixels are decoded
+                if image.width * image.height > self.max_pixels:
+                    raise ImageFetchError(f"image_url is larger than {self.max_pixels} pixels")
+                return image.convert("RGB")
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ImageFetchError(f"image_url is not a readable image: {e}") from None
+
+    def stats(self):
+        return {
+            "downloads": self.downloads,
+            "revalidated": self.revalidated,
+            "bytes_downloaded": self.bytes_downloaded,
+            "cache": self.cache.stats(),
+        }
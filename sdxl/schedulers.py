@@ -0,0 +1,53 @@
+import copy
+
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    HeunDiscreteScheduler,
+    KDPM2AncestralDiscreteScheduler,
+    KDPM2DiscreteScheduler,
+    LMSDiscreteScheduler,
+    PNDMScheduler,
+    UniPCMultistepScheduler,
+)
+
+# Request name: (scheduler class, overrides of the pipeline's scheduler config)
+SCHEDULERS = {
+    "DDIM": (DDIMScheduler, {}),
+    "PNDM": (PNDMScheduler, {}),
+    "K_EULER": (EulerDiscreteScheduler, {}),
+    "K_EULER_ANCESTRAL": (EulerAncestralDiscreteScheduler, {}),
+    "K_DPM_2": (KDPM2DiscreteScheduler, {}),
+    "K_DPM_2_ANCESTRAL": (KDPM2AncestralDiscreteScheduler, {}),
+    "KLMS": (LMSDiscreteScheduler, {}),
+    "HeunDiscrete": (HeunDiscreteScheduler, {}),
+    "DPMSolverMultistep": (DPMSolverMultistepScheduler, {}),
+    "DPM++ 2M": (DPMSolverMultistepScheduler, {}),
+    "DPM++ 2M Karras": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}),
+    "KarrasDPM": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True}),
+    "DPM++ 2M SDE Karras": (
+        DPMSolverMultistepScheduler, {"algorithm_type": "sde-dpmsolver++", "use_karras_sigmas": True}
+    ),
+    "UniPC": (UniPCMultistepScheduler, {}),
+}
+
+
+class SchedulerRegistry:
+    """Every scheduler in SCHEDULERS, built once from the pipeline's scheduler config.
+
+    Schedulers keep per-run state (timesteps, step index, multistep
+    history), so get() hands each request its own copy of the prototype.
+    """
+
+    def __init__(self, config):
+        self._schedulers = {
+            name: scheduler_class.from_config(config, **overrides)
+            for name, (scheduler_class, overrides) in SCHEDULERS.items()
+        }
+
+    def get(self, name):
+        if name not in self._schedulers:
+            raise ValueError(f"Invalid scheduler {name!r}. Must be one of {', '.join(self._schedulers)}.")
+        return copy.deepcopy(self._schedulers[name])
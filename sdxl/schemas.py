@@ -1,3 +1,5 @@
+from uploader import SUPPORTED_FORMATS
+
 INPUT_SCHEMA = {
     'prompt': {
         'type': str,
@@ -7,7 +9,24 @@ INPUT_SCHEMA = {
         'type': str,
         'required': False,
         'default': 'png',
-        'constraints': lambda fmt: fmt in ['png', 'jpg', 'jpeg']
+        'constraints': lambda fmt: fmt in SUPPORTED_FORMATS
+    },
+    'quality': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda quality: quality is None or 1 <= quality <= 100
+    },
+    'compress_level': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda level: level is None or 0 <= level <= 9
+    },
+    'lossless': {
+        'type': bool,
+        'required': False,
+        'default': False
     },
     'negative_prompt': {
         'type': str,
@@ -62,12 +81,17 @@ INPUT_SCHEMA = {
     'num_images': {
         'type': int,
         'required': False,
-        'default': 1,
-        'constraints': lambda img_count: 3 > img_count > 0
+        'default': 1
     },
     'high_noise_frac': {
         'type': float,
         'required': False,
         'default': None
     },
+    'deadline': {
+        'type': float,
+        'required': False,
+        'default': None,
+        'constraints': lambda deadline: deadline is None or deadline > 0
+    },
 }
\ No newline at end of file
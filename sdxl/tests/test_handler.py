@@ -0,0 +1,125 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import handler  # noqa: E402
+from image_fetch import FetchedImage  # noqa: E402
+from tiny_sdxl import tiny_sdxl_pipelines  # noqa: E402
+
+
+class StubFetcher:
+    def fetch_sync(self, url):
+        return FetchedImage(Image.new("RGB", (48, 48), (200, 40, 40)), (url, '"etag"'), False)
+
+    def stats(self):
+        return {}
+
+
+@pytest.fixture
+def models(monkeypatch):
+    """Installs tiny models as handler.MODELS, counting UNet calls per pipeline; uploads are recorded."""
+
+    def install(refiner=True):
+        base, refiner_pipeline = tiny_sdxl_pipelines(refiner=refiner)
+        models = handler.SimpleModelHandler(base, refiner_pipeline)
+        models.unet_calls = {"base": 0, "refiner": 0}
+        for name, pipeline in (("base", base), ("refiner", refiner_pipeline)):
+            if pipeline is not None:
+                pipeline.unet.register_forward_hook(
+                    lambda *args, name=name: models.unet_calls.__setitem__(name, models.unet_calls[name] + 1)
+                )
+        models.uploads = []
+
+        def upload_images(images, filenames, img_format, **options):
+            models.uploads.extend(images)
+            return [f"https://images.local/{name}" for name in filenames], True
+
+        monkeypatch.setattr(handler, "MODELS", models)
+        monkeypatch.setattr(handler, "upload_images", upload_images)
+        monkeypatch.setattr(handler, "FETCHER", StubFetcher())
+        monkeypatch.setattr(handler.RESULT_CACHE, "enabled", False)
+        return models
+
+    return install
+
+
+def job(**inputs):
+    return {"id": "job-1", "input": {
+        "prompt": "w1 w2", "height": 32, "width": 32, "num_inference_steps": 10, "seed": 1, "scheduler": "K_EULER",
+        **inputs,
+    }}
+
+
+def test_high_noise_frac_outside_0_1_is_rejected(models):
+    models = models()
+    for high_noise_frac in (0.0, 1.0, 1.5, -0.2):
+        assert handler.generate_image(job(high_noise_frac=high_noise_frac)) == {
+            "error": "high_noise_frac must be between 0 and 1"
+        }
+    assert models.unet_calls == {"base": 0, "refiner": 0}
+
+
+def test_without_the_refiner_high_noise_frac_is_rejected(models):
+    models = models(refiner=False)
+    result = handler.generate_image(job(high_noise_frac=0.8))
+    assert "SDXL_REFINER=0" in result["error"]
+
+    # The base alone still serves requests that don't ask for the refiner
+    result = handler.generate_image(job(num_images=2))
+    assert len(result["image_urls"]) == 2 and models.unet_calls["base"] == 10
+    assert [image.size for image in models.uploads] == [(32, 32)] * 2
+
+
+def test_base_hands_the_last_steps_to_the_refiner(models):
+    models = models()
+    result = handler.generate_image(job(high_noise_frac=0.8, num_images=2))
+
+    # The base denoises the first 80% of the schedule, the refiner the rest
+    assert models.unet_calls == {"base": 8, "refiner": 2}
+    assert len(result["image_urls"]) == 2 and [image.size for image in models.uploads] == [(32, 32)] * 2
+
+
+def test_img2img_runs_through_the_refiner(models):
+    models = models()
+    result = handler.generate_image(job(image_url="https://images.local/input.png", strength=0.5, high_noise_frac=0.8))
+
+    # strength 0.5 leaves the last 5 of 10 steps; the refiner still takes those past high_noise_frac
+    assert models.unet_calls["refiner"] == 2 and sum(models.unet_calls.values()) == 5
+    assert len(result["image_urls"]) == 1 and models.uploads[0].size == (32, 32)
+
+
+def test_num_images_budget_scales_with_pixel_count(models):
+    models = models()
+    # As measured for 1024x1024 on a card with room for four images
+    models.max_images, models.images_cap = 4, 8
+    assert models.images_allowed(1024, 1024) == 4
+    assert models.images_allowed(1024, 2048) == 2
+    assert models.images_allowed(1536, 1536) == 1
+    assert models.images_allowed(2048, 2048) == 1  # never below one
+    assert models.images_allowed(512, 512) == 8  # capped by SDXL_MAX_IMAGES
+
+    result = handler.generate_image(job(height=1024, width=2048, num_images=3))
+    assert result == {"error": "num_images must be between 1 and 2 at 2048x1024"}
+    assert models.unet_calls == {"base": 0, "refiner": 0}
+
+
+def test_vram_probe_runs_through_the_refiner(models):
+    models = models()
+    models.probe(2, size=32)
+    assert models.unet_calls == {"base": 1, "refiner": 1}
+
+
+def test_result_with_a_pending_upload_is_not_cached(models, monkeypatch, tmp_path):
+    models = models()
+    monkeypatch.setattr(handler, "RESULT_CACHE", handler.ResultCache(path=str(tmp_path / "results.sqlite3")))
+    monkeypatch.setattr(handler, "upload_images", lambda images, filenames, *args, **kwargs: (filenames, False))
+    assert handler.generate_image(job())["upload_status"] == "pending"
+    assert handler.RESULT_CACHE.stats()["entries"] == 0
+
+    monkeypatch.setattr(handler, "upload_images", lambda images, filenames, *args, **kwargs: (filenames, True))
+    handler.generate_image(job())
+    assert handler.generate_image(job())["cached"] and models.unet_calls["base"] == 20
@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest  # noqa: E402
+import torch  # noqa: E402
+from diffusers import DPMSolverMultistepScheduler, EulerDiscreteScheduler  # noqa: E402
+
+from schedulers import SCHEDULERS, SchedulerRegistry  # noqa: E402
+
+# stable-diffusion-xl-base-1.0/scheduler/scheduler_config.json
+SDXL_SCHEDULER_CONFIG = {
+    "_class_name": "EulerDiscreteScheduler",
+    "beta_end": 0.012,
+    "beta_schedule": "scaled_linear",
+    "beta_start": 0.00085,
+    "clip_sample": False,
+    "interpolation_type": "linear",
+    "num_train_timesteps": 1000,
+    "prediction_type": "epsilon",
+    "sample_max_value": 1.0,
+    "set_alpha_to_one": False,
+    "skip_prk_steps": True,
+    "steps_offset": 1,
+    "timestep_spacing": "leading",
+    "trained_betas": None,
+    "use_karras_sigmas": False,
+}
+
+
+@pytest.fixture(scope="module")
+def registry():
+    return SchedulerRegistry(EulerDiscreteScheduler.from_config(SDXL_SCHEDULER_CONFIG).config)
+
+
+def test_requests_get_isolated_schedulers(registry):
+    first, second = registry.get("DPM++ 2M"), registry.get("DPM++ 2M")
+    assert isinstance(first, DPMSolverMultistepScheduler) and first is not second
+
+    # One request stepping its scheduler leaves the other's timesteps and multistep history alone
+    first.set_timesteps(4)
+    sample = torch.zeros(1, 4, 8, 8)
+    first.step(torch.ones_like(sample), first.timesteps[0], sample)
+    second.set_timesteps(30)
+    assert len(first.timesteps) == 4 and len(second.timesteps) == 30
+    assert first.step_index == 1 and second.step_index is None
+    fresh = registry.get("DPM++ 2M")
+    assert len(fresh.timesteps) == 1000 and fresh.step_index is None
+
+
+def test_every_name_builds_its_class_and_overrides(registry):
+    for name, (scheduler_class, overrides) in SCHEDULERS.items():
+        scheduler = registry.get(name)
+        assert type(scheduler) is scheduler_class
+        assert all(scheduler.config[key] == value for key, value in overrides.items())
+    assert registry.get("DPM++ 2M Karras").config.use_karras_sigmas
+    assert not registry.get("DPM++ 2M").config.use_karras_sigmas
+
+
+def test_unknown_scheduler_is_rejected(registry):
+    with pytest.raises(ValueError, match="Invalid scheduler 'K_EULER_FAST'"):
+        registry.get("K_EULER_FAST")
@@ -0,0 +1,73 @@
+"""
+Randomly initialized, CPU-sized SDXL base and refiner pipelines for offline tests.
+
+Same component layout as stable-diffusion-xl-base-1.0 and -refiner-1.0 (two
+CLIP text encoders, a text_time UNet, AutoencoderKL; the refiner sharing the
+second text encoder and the VAE) but tiny, with a word-level tokenizer built
+in memory, so nothing is downloaded.
+"""
+import torch
+from diffusers import (
+    AutoencoderKL,
+    EulerDiscreteScheduler,
+    StableDiffusionXLImg2ImgPipeline,
+    StableDiffusionXLPipeline,
+    UNet2DConditionModel,
+)
+from tokenizers import Tokenizer, models, normalizers, pre_tokenizers
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, PreTrainedTokenizerFast
+
+VOCAB_SIZE = 1000
+TIME_EMBED_DIM = 8
+PROJECTION_DIM = 32
+
+
+def word_tokenizer(max_length=77):
+    """Lowercasing whitespace tokenizer over the vocabulary w0 ... w996."""
+    words = ["<pad>", "<unk>", "</s>"] + [f"w{i}" for i in range(VOCAB_SIZE - 3)]
+    tokenizer = Tokenizer(models.WordLevel({word: i for i, word in enumerate(words)}, unk_token="<unk>"))
+    tokenizer.normalizer = normalizers.Lowercase()
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", unk_token="<unk>", eos_token="</s>", model_max_length=max_length,
+    )
+
+
+def tiny_unet(cross_attention_dim, time_ids):
+    return UNet2DConditionModel(
+        block_out_channels=(8, 16), layers_per_block=1, sample_size=16, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4), use_linear_projection=True, addition_embed_type="text_time",
+        addition_time_embed_dim=TIME_EMBED_DIM, transformer_layers_per_block=(1, 1),
+        # time ids (size, crop, target size or aesthetic score) plus the pooled text embedding
+        projection_class_embeddings_input_dim=time_ids * TIME_EMBED_DIM + PROJECTION_DIM,
+        cross_attention_dim=cross_attention_dim, norm_num_groups=4,
+    )
+
+
+def tiny_sdxl_pipelines(refiner=True, seed=0):
+    """(base, refiner) pipelines; refiner is None when refiner=False."""
+    torch.manual_seed(seed)
+    config = CLIPTextConfig(
+        vocab_size=VOCAB_SIZE, hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4,
+        max_position_embeddings=77, projection_dim=PROJECTION_DIM, bos_token_id=2, eos_token_id=2, pad_token_id=0,
+    )
+    text_encoder_2 = CLIPTextModelWithProjection(config)
+    vae = AutoencoderKL(
+        block_out_channels=(8, 16), in_channels=3, out_channels=3, latent_channels=4, norm_num_groups=4,
+        down_block_types=("DownEncoderBlock2D",) * 2, up_block_types=("UpDecoderBlock2D",) * 2,
+    )
+    scheduler = EulerDiscreteScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", steps_offset=1, timestep_spacing="leading",
+    )
+    base = StableDiffusionXLPipeline(
+        vae=vae, text_encoder=CLIPTextModel(config), text_encoder_2=text_encoder_2, tokenizer=word_tokenizer(),
+        tokenizer_2=word_tokenizer(), unet=tiny_unet(64, time_ids=6), scheduler=scheduler, add_watermarker=False,
+    )
+    if not refiner:
+        return base, None
+    return base, StableDiffusionXLImg2ImgPipeline(
+        vae=vae, text_encoder=None, text_encoder_2=text_encoder_2, tokenizer=None, tokenizer_2=word_tokenizer(),
+        unet=tiny_unet(32, time_ids=5), scheduler=scheduler, requires_aesthetics_score=True,
+        force_zeros_for_empty_prompt=False, add_watermarker=False,
+    )